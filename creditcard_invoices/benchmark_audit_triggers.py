@@ -0,0 +1,84 @@
+import argparse
+from datetime import datetime
+
+from manage_invoices import (
+    logger,
+    get_db_connection,
+    db_timezone
+)
+from benchmark_write_engines import (
+    fetch_benchmark_cards,
+    build_synthetic_changes,
+    run_engine_benchmark
+)
+
+# --- Benchmark das triggers de auditoria de faturas ---
+# Mede a vazão das escritas em lote de faturas com a auditoria por linha (FOR EACH ROW) e
+# por instrução (FOR EACH STATEMENT, com tabelas de transição). Cada modo é instalado dentro
+# da própria transação do benchmark e desfeito no rollback, sem alterar o banco.
+
+drop_invoice_audit_triggers = """
+    DROP TRIGGER IF EXISTS trigger_audit_creditcard_invoices ON transactions.creditcard_invoices;
+    DROP TRIGGER IF EXISTS trigger_audit_creditcard_invoices_insert ON transactions.creditcard_invoices;
+    DROP TRIGGER IF EXISTS trigger_audit_creditcard_invoices_update ON transactions.creditcard_invoices;
+    DROP TRIGGER IF EXISTS trigger_audit_creditcard_invoices_delete ON transactions.creditcard_invoices;
+"""
+
+audit_modes = {
+    "row": drop_invoice_audit_triggers + """
+        CREATE TRIGGER trigger_audit_creditcard_invoices
+        AFTER INSERT OR UPDATE OR DELETE ON transactions.creditcard_invoices
+        FOR EACH ROW EXECUTE FUNCTION public.log_transactions_audit('creditcard_invoices_id');
+    """,
+    "statement": drop_invoice_audit_triggers + """
+        CREATE TRIGGER trigger_audit_creditcard_invoices_insert
+        AFTER INSERT ON transactions.creditcard_invoices
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION public.log_transactions_audit_statement('creditcard_invoices_id');
+        CREATE TRIGGER trigger_audit_creditcard_invoices_update
+        AFTER UPDATE ON transactions.creditcard_invoices
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION public.log_transactions_audit_statement('creditcard_invoices_id');
+        CREATE TRIGGER trigger_audit_creditcard_invoices_delete
+        AFTER DELETE ON transactions.creditcard_invoices
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE FUNCTION public.log_transactions_audit_statement('creditcard_invoices_id');
+    """
+}
+
+def main():
+    """Compara a vazão das escritas em lote de faturas com cada modo de auditoria."""
+    parser = argparse.ArgumentParser(description="Benchmark das triggers de auditoria de faturas.")
+    parser.add_argument("--cards", type=int, default=500, help="Quantidade de cartões de referência.")
+    parser.add_argument("--months", type=int, default=25, help="Faturas sintéticas por cartão.")
+    parser.add_argument("--rounds", type=int, default=3, help="Repetições por modo.")
+    parser.add_argument("--engine", default="values", help="Motor de escrita de manage_invoices usado.")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        now_brt = datetime.now(db_timezone).replace(tzinfo=None)
+        cards = fetch_benchmark_cards(conn, args.cards)
+        conn.rollback()
+        if not cards:
+            logger.info("Nenhum cartão encontrado para o benchmark.")
+            return
+
+        for round_index in range(1, args.rounds + 1):
+            for mode_name, mode_sql in audit_modes.items():
+                inserts, updates = build_synthetic_changes(conn, cards, args.months, now_brt)
+                with conn.cursor() as cur:
+                    cur.execute(mode_sql)
+                # As triggers instaladas acima são desfeitas pelo rollback do benchmark do motor
+                timings = run_engine_benchmark(conn, args.engine, inserts, updates, now_brt)
+                total = sum(timings.values())
+                logger.info(f"Rodada {round_index} - auditoria '{mode_name}': {len(inserts)} faturas | "
+                            f"inserção {timings['insert']:.3f}s, atualização {timings['update']:.3f}s, "
+                            f"exclusão {timings['delete']:.3f}s, total {total:.3f}s "
+                            f"({len(inserts) * 3 / total:.0f} linhas/s).")
+    finally:
+        conn.close()
+        logger.info("Conexão com o banco de dados fechada.")
+
+if __name__ == "__main__":
+    main()
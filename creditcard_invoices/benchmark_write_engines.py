@@ -0,0 +1,130 @@
+import argparse
+import time
+from datetime import datetime, date, timedelta
+from dateutil.relativedelta import relativedelta
+import psycopg2.extras
+
+from manage_invoices import (
+    logger,
+    get_db_connection,
+    allocate_ids,
+    invoice_id_sequence,
+    write_engines,
+    db_timezone
+)
+
+# --- Benchmark dos motores de escrita de faturas ---
+# Executa inserção, atualização e exclusão de faturas sintéticas (em períodos distantes,
+# sem conflito com faturas reais) com cada motor e desfaz tudo com rollback ao final.
+
+benchmark_start_period = date(2999, 1, 1)
+
+def fetch_benchmark_cards(conn, card_count: int) -> list:
+    """Busca cartões existentes para servirem de referência às faturas sintéticas."""
+    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        cur.execute("""
+            SELECT user_creditcards_id, user_creditcards_user_id
+            FROM core.user_creditcards
+            ORDER BY user_creditcards_id
+            LIMIT %s;
+        """, (card_count,))
+        return cur.fetchall()
+
+def build_synthetic_changes(conn, cards: list, months: int, now_brt: datetime) -> tuple:
+    """Monta inserções e atualizações sintéticas para os cartões informados."""
+    inserts = []
+    updates = []
+    with conn.cursor() as cur:
+        new_ids = iter(allocate_ids(
+            cur, invoice_id_sequence, 'transactions.creditcard_invoices', 'creditcard_invoices_id', 'F',
+            len(cards) * months
+        ))
+    conn.rollback()
+    for card in cards:
+        for offset in range(months):
+            period_dt = benchmark_start_period + relativedelta(months=offset)
+            invoice_id = next(new_ids)
+            due_dt = period_dt + timedelta(days=9)
+            inserts.append({
+                'creditcard_invoices_id': invoice_id,
+                'creditcard_invoices_user_creditcard_id': card['user_creditcards_id'],
+                'creditcard_invoices_user_id': card['user_creditcards_user_id'],
+                'creditcard_invoices_creation_datetime': now_brt,
+                'creditcard_invoices_opening_date': period_dt - timedelta(days=20),
+                'creditcard_invoices_closing_date': period_dt,
+                'creditcard_invoices_due_date': due_dt,
+                'creditcard_invoices_statement_period': period_dt.strftime('%Y-%m'),
+                'creditcard_invoices_amount': 0.00,
+                'creditcard_invoices_paid_amount': 0.00,
+                'creditcard_invoices_payment_date': due_dt,
+                'creditcard_invoices_status': 'Aberta',
+                'creditcard_invoices_file_url': None,
+                'creditcard_invoices_last_update': now_brt
+            })
+            updates.append({
+                'creditcard_invoices_id': invoice_id,
+                'creditcard_invoices_opening_date': period_dt - timedelta(days=19),
+                'creditcard_invoices_closing_date': period_dt + timedelta(days=1),
+                'creditcard_invoices_due_date': due_dt + timedelta(days=1),
+                'creditcard_invoices_last_update': now_brt
+            })
+    return inserts, updates
+
+def run_engine_benchmark(conn, engine_name: str, inserts: list, updates: list, now_brt: datetime) -> dict:
+    """Mede o tempo de cada fase de escrita de um motor e desfaz as alterações."""
+    write_engine = write_engines[engine_name]
+    timings = {}
+    try:
+        with conn.cursor() as cur:
+            t0 = time.perf_counter()
+            write_engine(cur, inserts, [], now_brt)
+            timings['insert'] = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            write_engine(cur, [], updates, now_brt)
+            timings['update'] = time.perf_counter() - t0
+
+            # Os motores não excluem faturas (ver cleanup_inactive_card_invoices): a exclusão
+            # das faturas sintéticas usa o mesmo DELETE para todos os motores
+            t0 = time.perf_counter()
+            cur.execute(
+                "DELETE FROM transactions.creditcard_invoices WHERE creditcard_invoices_id = ANY(%s);",
+                ([inv['creditcard_invoices_id'] for inv in inserts],)
+            )
+            timings['delete'] = time.perf_counter() - t0
+    finally:
+        conn.rollback()
+    return timings
+
+def main():
+    """Compara os motores de escrita de faturas disponíveis em manage_invoices."""
+    parser = argparse.ArgumentParser(description="Benchmark dos motores de escrita de faturas.")
+    parser.add_argument("--cards", type=int, default=500, help="Quantidade de cartões de referência.")
+    parser.add_argument("--months", type=int, default=25, help="Faturas sintéticas por cartão.")
+    parser.add_argument("--rounds", type=int, default=3, help="Repetições por motor.")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        now_brt = datetime.now(db_timezone).replace(tzinfo=None)
+        cards = fetch_benchmark_cards(conn, args.cards)
+        conn.rollback()
+        if not cards:
+            logger.info("Nenhum cartão encontrado para o benchmark.")
+            return
+
+        for round_index in range(1, args.rounds + 1):
+            for engine_name in write_engines:
+                inserts, updates = build_synthetic_changes(conn, cards, args.months, now_brt)
+                timings = run_engine_benchmark(conn, engine_name, inserts, updates, now_brt)
+                total = sum(timings.values())
+                logger.info(f"Rodada {round_index} - motor '{engine_name}': {len(inserts)} faturas | "
+                            f"inserção {timings['insert']:.3f}s, atualização {timings['update']:.3f}s, "
+                            f"exclusão {timings['delete']:.3f}s, total {total:.3f}s "
+                            f"({len(inserts) * 3 / total:.0f} linhas/s).")
+    finally:
+        conn.close()
+        logger.info("Conexão com o banco de dados fechada.")
+
+if __name__ == "__main__":
+    main()
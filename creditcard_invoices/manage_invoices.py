@@ -1,15 +1,29 @@
 import os
+import sys
 import psycopg2
 import psycopg2.extras
-import random
+import psycopg2.pool
 import logging
-import math
 from datetime import datetime, timedelta, date
 from dateutil.relativedelta import relativedelta
 import pytz
-import holidays
 from dotenv import load_dotenv
 import time
+import threading
+import queue
+import io
+import csv
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Código compartilhado entre os scripts de automação (pasta shared)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "shared"))
+from job_common import (
+    BusinessDayCalendar,
+    prepare_business_calendar,
+    calculate_invoice_dates,
+    AdaptiveBatchSizer,
+    allocate_ids
+)
 
 # --- Configuração de logging ---
 logging.basicConfig(
@@ -28,6 +42,14 @@ db_host = os.getenv("DB_HOST", "localhost")
 db_port = os.getenv("DB_PORT", "5432")
 
 lookahead_months = 25
+invoice_workers = int(os.getenv("INVOICE_WORKERS", "1"))
+invoice_pipeline_depth = int(os.getenv("INVOICE_PIPELINE_DEPTH", "0"))
+invoice_mode = os.getenv("INVOICE_MODE", "full").strip().lower()
+invoice_write_engine = os.getenv("INVOICE_WRITE_ENGINE", "values").strip().lower()
+invoice_batch_target_seconds = float(os.getenv("INVOICE_BATCH_TARGET_SECONDS", "10"))
+invoice_batch_max_rows = int(os.getenv("INVOICE_BATCH_MAX_ROWS", "100000"))
+invoice_job_name = 'manage_invoices'
+invoice_id_sequence = 'transactions.creditcard_invoices_id_seq'
 db_timezone_str = 'America/Sao_Paulo'
 db_timezone = pytz.timezone(db_timezone_str)
 
@@ -49,85 +71,241 @@ def get_db_connection() -> psycopg2.extensions.connection:
         logger.error(f"Erro ao conectar ao banco de dados: {e}")
         raise
 
+def get_db_connection_pool(max_connections: int) -> psycopg2.pool.ThreadedConnectionPool:
+    """Cria e retorna um pool de conexões limitado para o processamento paralelo."""
+    try:
+        pool = psycopg2.pool.ThreadedConnectionPool(
+            1,
+            max_connections,
+            dbname=db_name,
+            user=db_user,
+            password=db_password,
+            host=db_host,
+            port=db_port
+        )
+        logger.info(f"Pool de conexões com o banco de dados criado (máximo: {max_connections}).")
+        return pool
+    except psycopg2.Error as e:
+        logger.error(f"Erro ao criar pool de conexões com o banco de dados: {e}")
+        raise
+
 # --- Utilitários ---
 
-def generate_invoice_id() -> str:
-    """Gera um ID único no formato NNN-NNN-NNN-NNN-NNN-F."""
-    parts = [f"{random.randint(0, 999):03d}" for _ in range(5)]
-    return "-".join(parts) + "-F"
+class InvoiceScheduleCache:
+    """
+    Cache de cronogramas de faturas por configuração de cobrança do cartão.
 
-def is_business_day(target_date: date, holidays_obj) -> bool:
-    """Verifica se a data é um dia útil (não fim de semana nem feriado)."""
-    if target_date.weekday() >= 5:
-        return False
-    if target_date in holidays_obj:
-        return False
-    return True
+    Cartões com a mesma tripla (dia de vencimento, dias até o fechamento, adiamento para
+    dia útil) compartilham o mesmo cronograma de abertura/fechamento/vencimento. Cada
+    cronograma é calculado uma única vez por execução e reutilizado entre cartões e lotes.
+    """
+
+    def __init__(self, business_calendar: BusinessDayCalendar):
+        self.business_calendar = business_calendar
+        self._schedules = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def schedule_key(card_details: dict, start_period_dt: date, months_ahead: int) -> tuple:
+        """Monta a chave do cronograma a partir da configuração de cobrança do cartão."""
+        return (
+            card_details['user_creditcards_due_day'],
+            card_details['user_creditcards_closing_day'],
+            bool(card_details.get('creditcards_postpone_due_date_to_business_day', True)),
+            start_period_dt.strftime('%Y-%m'),
+            months_ahead
+        )
+
+    def get_schedule(self, card_details: dict, start_period_dt: date, months_ahead: int) -> list:
+        """
+        Retorna o cronograma de faturas para a configuração do cartão.
+
+        Cada item contém o período e as datas calculadas (ou o erro ocorrido no cálculo).
+        A data de abertura do primeiro período considera que não há fechamento anterior.
+        """
+        key = self.schedule_key(card_details, start_period_dt, months_ahead)
+        with self._lock:
+            schedule = self._schedules.get(key)
+            if schedule is not None:
+                self.hits += 1
+                return schedule
+            self.misses += 1
 
-def get_next_business_day(target_date: date, holidays_obj) -> date:
-    """Retorna a data fornecida ou o próximo dia útil subsequente."""
-    adjusted_date = target_date
-    while not is_business_day(adjusted_date, holidays_obj):
-        adjusted_date += timedelta(days=1)
-    return adjusted_date
+        schedule = []
+        last_closing_date = None
+        curr_period_date = start_period_dt
+        for _ in range(months_ahead):
+            entry = {"period": curr_period_date.strftime('%Y-%m'), "dates": None, "error": None}
+            try:
+                entry["dates"] = calculate_invoice_dates(
+                    card_details, curr_period_date.year, curr_period_date.month,
+                    last_closing_date, self.business_calendar
+                )
+                if entry["dates"]["closing"]:
+                    last_closing_date = entry["dates"]["closing"]
+            except Exception as e:
+                entry["error"] = e
+            schedule.append(entry)
+            curr_period_date += relativedelta(months=1)
 
-def calculate_invoice_dates(card_details: dict, target_year: int, target_month: int, last_closing_date, holidays_obj) -> dict:
+        with self._lock:
+            return self._schedules.setdefault(key, schedule)
+
+    def log_stats(self):
+        """Registra as estatísticas de acerto do cache de cronogramas."""
+        total = self.hits + self.misses
+        hit_rate = (self.hits / total * 100) if total else 0.0
+        logger.info(f"Cache de cronogramas: {len(self._schedules)} configurações distintas, "
+                    f"{self.hits} acertos, {self.misses} falhas ({hit_rate:.2f}% de acerto).")
+
+# --- Operações com o banco de dados ---
+
+card_details_select = """
+    SELECT
+        uc.user_creditcards_id,
+        uc.user_creditcards_user_id,
+        uc.user_creditcards_creditcard_id,
+        uc.user_creditcards_closing_day,
+        uc.user_creditcards_due_day,
+        uc.user_creditcards_status,
+        cc.creditcards_postpone_due_date_to_business_day
+    FROM core.user_creditcards uc
+    JOIN core.creditcards cc ON uc.user_creditcards_creditcard_id = cc.creditcards_id
+"""
+
+active_card_details_page_query = card_details_select + """
+    WHERE uc.user_creditcards_status
+      AND uc.user_creditcards_id > %s
+    ORDER BY uc.user_creditcards_id
+    LIMIT %s;
+"""
+
+def estimate_card_count(conn) -> int:
     """
-    Calcula as datas de abertura, fechamento e vencimento de uma fatura.
+    Estima o total de cartões dos usuários a partir das estatísticas do catálogo.
+
+    Evita uma varredura completa apenas para dimensionar os lotes; recorre ao COUNT(*)
+    quando a tabela ainda não possui estatísticas coletadas.
     """
-    due_day = card_details['user_creditcards_due_day']
-    days_between_due_closing = card_details['user_creditcards_closing_day']
-    postpone = card_details.get('creditcards_postpone_due_date_to_business_day', True)
+    with conn.cursor() as cur:
+        cur.execute("SELECT reltuples::bigint FROM pg_class WHERE oid = 'core.user_creditcards'::regclass;")
+        row = cur.fetchone()
+        estimate = row[0] if row else 0
+        if estimate is None or estimate <= 0:
+            cur.execute("SELECT COUNT(*) FROM core.user_creditcards;")
+            estimate = cur.fetchone()[0]
+    return estimate
 
-    try:
-        nominal_due_date = date(target_year, target_month, due_day)
-    except ValueError:
-        last_day_of_month = (date(target_year, target_month, 1) + relativedelta(months=1) - timedelta(days=1)).day
-        logger.warning(f"Dia de vencimento {due_day} inválido para {target_year}-{target_month:02d} para user_card {card_details['user_creditcards_id']}. Usando último dia: {last_day_of_month}.")
-        nominal_due_date = date(target_year, target_month, last_day_of_month)
-
-    effective_due_date = get_next_business_day(nominal_due_date, holidays_obj)
-    reference_date_for_closing = effective_due_date if postpone else nominal_due_date
-    closing_date = reference_date_for_closing - timedelta(days=days_between_due_closing)
-
-    if last_closing_date:
-        opening_date = last_closing_date + timedelta(days=1)
-    else:
-        estimated_previous_closing = closing_date - relativedelta(months=1)
-        opening_date = estimated_previous_closing + timedelta(days=1)
+def iter_card_detail_batches(conn, batch_sizer, card_ids: list = None):
+    """
+    Gera lotes ordenados de detalhes de cartões ativos.
 
-    return {
-        "opening": opening_date,
-        "closing": closing_date,
-        "due": effective_due_date
-    }
+    Sem lista de IDs, percorre core.user_creditcards com paginação por chave (keyset) sobre
+    user_creditcards_id, mantendo a memória constante. Com lista de IDs (modo incremental),
+    busca os detalhes dos IDs informados em fatias. O tamanho de cada lote é lido do
+    controlador adaptativo no momento da busca.
+    """
+    if card_ids is not None:
+        start = 0
+        while start < len(card_ids):
+            batch_ids = card_ids[start:start + batch_sizer.size]
+            start += len(batch_ids)
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                card_details = fetch_card_details(cur, batch_ids)
+            conn.commit()
+            if not card_details:
+                logger.warning(f"Nenhum detalhe encontrado para o lote de user_card_ids: {batch_ids}")
+                continue
+            yield card_details
+        return
 
-# --- Operações com o banco de dados ---
+    last_card_id = ''
+    while True:
+        batch_size = batch_sizer.size
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+            cur.execute(active_card_details_page_query, (last_card_id, batch_size))
+            card_details = cur.fetchall()
+        # Encerra a transação de leitura para não mantê-la aberta durante o processamento
+        conn.commit()
+        if not card_details:
+            return
+        last_card_id = card_details[-1]['user_creditcards_id']
+        yield card_details
+        if len(card_details) < batch_size:
+            return
 
-def fetch_all_card_ids(conn) -> list:
-    """Busca todos os IDs de cartões de crédito dos usuários."""
-    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-        cur.execute("SELECT user_creditcards_id FROM core.user_creditcards ORDER BY user_creditcards_id;")
+def fetch_db_timestamp(conn) -> datetime:
+    """Retorna o instante atual segundo o relógio do banco de dados."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT CURRENT_TIMESTAMP;")
+        return cur.fetchone()[0]
+
+def fetch_job_watermark(conn, job_name: str):
+    """Busca a marca d'água (início da última execução bem-sucedida) do job, se existir."""
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT job_watermarks_last_run FROM core.job_watermarks WHERE job_watermarks_job_name = %s;",
+            (job_name,)
+        )
+        row = cur.fetchone()
+    return row[0] if row else None
+
+def save_job_watermark(conn, job_name: str, run_started_at: datetime):
+    """Persiste a marca d'água do job com o instante de início da execução concluída."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO core.job_watermarks (job_watermarks_job_name, job_watermarks_last_run, job_watermarks_last_update)
+            VALUES (%s, %s, CURRENT_TIMESTAMP)
+            ON CONFLICT (job_watermarks_job_name) DO UPDATE
+            SET job_watermarks_last_run = EXCLUDED.job_watermarks_last_run,
+                job_watermarks_last_update = CURRENT_TIMESTAMP;
+        """, (job_name, run_started_at))
+    conn.commit()
+    logger.info(f"Marca d'água do job {job_name} atualizada para {run_started_at}.")
+
+def fetch_changed_card_ids(conn, since: datetime, end_period_str: str) -> list:
+    """
+    Busca os IDs dos cartões que precisam ser reprocessados desde a marca d'água.
+
+    Inclui cartões ativos cujas configurações (user_creditcards/creditcards) mudaram ou que
+    não possuem a fatura do último período do horizonte. Cartões inativos são tratados por
+    cleanup_inactive_card_invoices.
+    """
+    query = """
+        SELECT uc.user_creditcards_id
+        FROM core.user_creditcards uc
+        JOIN core.creditcards cc ON uc.user_creditcards_creditcard_id = cc.creditcards_id
+        WHERE uc.user_creditcards_status
+          AND (
+              uc.user_creditcards_last_update > %(since)s
+              OR cc.creditcards_last_update > %(since)s
+              OR NOT EXISTS (
+                  SELECT 1
+                  FROM transactions.creditcard_invoices inv
+                  WHERE inv.creditcard_invoices_user_creditcard_id = uc.user_creditcards_id
+                    AND inv.creditcard_invoices_statement_period = %(end_period)s
+              )
+          )
+        ORDER BY uc.user_creditcards_id;
+    """
+    params = {"since": since, "end_period": end_period_str}
+    with conn.cursor() as cur:
+        cur.execute(query, params)
         rows = cur.fetchall()
-    return [row['user_creditcards_id'] for row in rows]
+    logger.info(f"{len(rows)} cartões com alterações desde {since} selecionados para processamento incremental.")
+    return [row[0] for row in rows]
 
 def fetch_card_details(cursor, card_ids_batch: list) -> list:
-    """Busca detalhes dos cartões de crédito de um lote."""
+    """Busca detalhes dos cartões de crédito ativos de um lote."""
     if not card_ids_batch:
         return []
     try:
-        query = """
-            SELECT
-                uc.user_creditcards_id,
-                uc.user_creditcards_user_id,
-                uc.user_creditcards_creditcard_id,
-                uc.user_creditcards_closing_day,
-                uc.user_creditcards_due_day,
-                uc.user_creditcards_status,
-                cc.creditcards_postpone_due_date_to_business_day
-            FROM core.user_creditcards uc
-            JOIN core.creditcards cc ON uc.user_creditcards_creditcard_id = cc.creditcards_id
-            WHERE uc.user_creditcards_id = ANY(%s);
+        query = card_details_select + """
+            WHERE uc.user_creditcards_status
+              AND uc.user_creditcards_id = ANY(%s)
+            ORDER BY uc.user_creditcards_id;
         """
         cursor.execute(query, (list(card_ids_batch),))
         return cursor.fetchall()
@@ -135,29 +313,30 @@ def fetch_card_details(cursor, card_ids_batch: list) -> list:
         logger.error(f"Erro ao buscar detalhes do lote de user_creditcards: {e}")
         return []
 
+existing_invoices_query = """
+    SELECT
+        creditcard_invoices_id,
+        creditcard_invoices_user_creditcard_id,
+        creditcard_invoices_statement_period,
+        creditcard_invoices_opening_date,
+        creditcard_invoices_closing_date,
+        creditcard_invoices_due_date,
+        creditcard_invoices_status,
+        creditcard_invoices_amount,
+        creditcard_invoices_file_url
+    FROM transactions.creditcard_invoices
+    WHERE creditcard_invoices_user_creditcard_id = ANY(%s)
+      AND creditcard_invoices_statement_period >= %s
+      AND creditcard_invoices_statement_period <= %s;
+"""
+
 def fetch_existing_invoices(cursor, card_ids_batch: list, start_period_str: str, end_period_str: str) -> dict:
     """Busca faturas existentes para o lote de cartões no período."""
     invoices = {}
     if not card_ids_batch:
         return invoices
     try:
-        query = """
-            SELECT
-                creditcard_invoices_id,
-                creditcard_invoices_user_creditcard_id,
-                creditcard_invoices_statement_period,
-                creditcard_invoices_opening_date,
-                creditcard_invoices_closing_date,
-                creditcard_invoices_due_date,
-                creditcard_invoices_status,
-                creditcard_invoices_amount,
-                creditcard_invoices_file_url
-            FROM transactions.creditcard_invoices
-            WHERE creditcard_invoices_user_creditcard_id = ANY(%s)
-              AND creditcard_invoices_statement_period >= %s
-              AND creditcard_invoices_statement_period <= %s;
-        """
-        cursor.execute(query, (list(card_ids_batch), start_period_str, end_period_str))
+        cursor.execute(existing_invoices_query, (list(card_ids_batch), start_period_str, end_period_str))
         for row in cursor.fetchall():
             key = (row['creditcard_invoices_user_creditcard_id'], row['creditcard_invoices_statement_period'])
             invoices[key] = row
@@ -166,14 +345,64 @@ def fetch_existing_invoices(cursor, card_ids_batch: list, start_period_str: str,
         logger.error(f"Erro ao buscar faturas existentes do lote: {e}")
         return {}
 
-def execute_db_changes(cursor, inserts: list, updates: list, deletes: set, now_brt: datetime):
-    """Executa operações de inserção, atualização e exclusão em lote no banco de dados."""
+def cleanup_inactive_card_invoices(conn, start_period_str: str, end_period_str: str, today: date) -> dict:
+    """
+    Exclui, em um único comando, as faturas futuras sem valor de todos os cartões inativos.
+
+    A decisão é tomada no próprio banco (faturas do período de análise com vencimento futuro
+    e valor de até 1 centavo) e a contagem de exclusões por cartão é retornada e registrada.
+    """
+    query = """
+        WITH deleted AS (
+            DELETE FROM transactions.creditcard_invoices AS inv
+            USING core.user_creditcards AS uc
+            WHERE inv.creditcard_invoices_user_creditcard_id = uc.user_creditcards_id
+              AND NOT uc.user_creditcards_status
+              AND inv.creditcard_invoices_statement_period >= %s
+              AND inv.creditcard_invoices_statement_period <= %s
+              AND inv.creditcard_invoices_due_date > %s
+              AND ABS(COALESCE(inv.creditcard_invoices_amount, 0)) <= 0.01
+            RETURNING inv.creditcard_invoices_user_creditcard_id
+        )
+        SELECT creditcard_invoices_user_creditcard_id, COUNT(*)
+        FROM deleted
+        GROUP BY creditcard_invoices_user_creditcard_id
+        ORDER BY creditcard_invoices_user_creditcard_id;
+    """
     try:
-        if deletes:
-            delete_query = "DELETE FROM transactions.creditcard_invoices WHERE creditcard_invoices_id = ANY(%s);"
-            cursor.execute(delete_query, (list(deletes),))
-            logger.info(f"{cursor.rowcount} faturas marcadas para exclusão (serão efetivadas no commit).")
+        with conn.cursor() as cur:
+            cur.execute(query, (start_period_str, end_period_str, today))
+            deleted_by_card = {card_id: count for card_id, count in cur.fetchall()}
+        conn.commit()
+    except psycopg2.Error as e:
+        logger.error(f"Erro ao excluir faturas de cartões inativos: {e}")
+        raise
+
+    for card_id, count in deleted_by_card.items():
+        logger.info(f"{count} faturas excluídas do user_card inativo {card_id}.")
+    logger.info(f"Limpeza de cartões inativos concluída: {sum(deleted_by_card.values())} faturas "
+                f"excluídas de {len(deleted_by_card)} cartões.")
+    return deleted_by_card
+
+def assign_invoice_ids(cursor, inserts: list):
+    """Atribui às faturas planejadas para inserção IDs reservados em bloco."""
+    pending = [inv for inv in inserts if inv['creditcard_invoices_id'] is None]
+    if not pending:
+        return
+    new_ids = allocate_ids(
+        cursor, invoice_id_sequence, 'transactions.creditcard_invoices', 'creditcard_invoices_id', 'F', len(pending)
+    )
+    for invoice, new_id in zip(pending, new_ids):
+        invoice['creditcard_invoices_id'] = new_id
 
+def execute_db_changes(cursor, inserts: list, updates: list, now_brt: datetime):
+    """
+    Executa operações de inserção e atualização em lote no banco de dados.
+
+    Exclusões não passam por aqui: as faturas de cartões inativos são removidas por
+    cleanup_inactive_card_invoices.
+    """
+    try:
         if inserts:
             insert_query = """
                 INSERT INTO transactions.creditcard_invoices (
@@ -229,21 +458,149 @@ def execute_db_changes(cursor, inserts: list, updates: list, deletes: set, now_b
         logger.error(f"Erro durante a preparação das operações de banco no lote: {e}")
         raise
 
+invoice_staging_columns = [
+    'change_type',
+    'creditcard_invoices_id', 'creditcard_invoices_user_creditcard_id',
+    'creditcard_invoices_user_id', 'creditcard_invoices_creation_datetime',
+    'creditcard_invoices_opening_date', 'creditcard_invoices_closing_date',
+    'creditcard_invoices_due_date', 'creditcard_invoices_statement_period',
+    'creditcard_invoices_amount', 'creditcard_invoices_paid_amount',
+    'creditcard_invoices_payment_date', 'creditcard_invoices_status',
+    'creditcard_invoices_file_url', 'creditcard_invoices_last_update'
+]
+
+def ensure_invoice_staging_table(cursor):
+    """Cria (se necessário) a tabela temporária de staging das mudanças de faturas da sessão."""
+    cursor.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS invoice_changes_staging (
+            change_type char(1) NOT NULL,
+            creditcard_invoices_id character varying(50) NOT NULL,
+            creditcard_invoices_user_creditcard_id character varying(50),
+            creditcard_invoices_user_id character varying(50),
+            creditcard_invoices_creation_datetime timestamp,
+            creditcard_invoices_opening_date date,
+            creditcard_invoices_closing_date date,
+            creditcard_invoices_due_date date,
+            creditcard_invoices_statement_period text,
+            creditcard_invoices_amount numeric(15, 2),
+            creditcard_invoices_paid_amount numeric(15, 2),
+            creditcard_invoices_payment_date date,
+            creditcard_invoices_status text,
+            creditcard_invoices_file_url text,
+            creditcard_invoices_last_update timestamp
+        ) ON COMMIT DELETE ROWS;
+    """)
+
+def copy_invoice_changes_to_staging(cursor, inserts: list, updates: list, now_brt: datetime) -> int:
+    """Envia as mudanças do lote via COPY para a tabela temporária de staging."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for inv in inserts:
+        writer.writerow(['I'] + [inv[column] for column in invoice_staging_columns[1:]])
+    for upd in updates:
+        writer.writerow([
+            'U', upd['creditcard_invoices_id'], None, None, None,
+            upd['creditcard_invoices_opening_date'], upd['creditcard_invoices_closing_date'],
+            upd['creditcard_invoices_due_date'], None, None, None, None, None, None, now_brt
+        ])
+    buffer.seek(0)
+    cursor.copy_expert(
+        f"COPY invoice_changes_staging ({', '.join(invoice_staging_columns)}) FROM STDIN WITH (FORMAT csv);",
+        buffer
+    )
+    return len(inserts) + len(updates)
+
+def execute_db_changes_copy(cursor, inserts: list, updates: list, now_brt: datetime):
+    """
+    Executa as operações do lote via COPY para staging e comandos set-based.
+
+    Alternativa a execute_db_changes: as mudanças são transmitidas com COPY para uma
+    tabela temporária e aplicadas com um INSERT e um UPDATE (mantendo as proteções de
+    fatura 'Aberta' e sem arquivo anexado).
+    """
+    try:
+        ensure_invoice_staging_table(cursor)
+        staged = copy_invoice_changes_to_staging(cursor, inserts, updates, now_brt)
+        logger.info(f"{staged} mudanças de faturas enviadas via COPY para staging.")
+
+        if inserts:
+            cursor.execute("""
+                INSERT INTO transactions.creditcard_invoices (
+                    creditcard_invoices_id, creditcard_invoices_user_creditcard_id,
+                    creditcard_invoices_user_id, creditcard_invoices_creation_datetime,
+                    creditcard_invoices_opening_date, creditcard_invoices_closing_date,
+                    creditcard_invoices_due_date, creditcard_invoices_statement_period,
+                    creditcard_invoices_amount, creditcard_invoices_paid_amount,
+                    creditcard_invoices_payment_date, creditcard_invoices_status,
+                    creditcard_invoices_file_url, creditcard_invoices_last_update
+                )
+                SELECT
+                    stg.creditcard_invoices_id, stg.creditcard_invoices_user_creditcard_id,
+                    stg.creditcard_invoices_user_id, stg.creditcard_invoices_creation_datetime,
+                    stg.creditcard_invoices_opening_date, stg.creditcard_invoices_closing_date,
+                    stg.creditcard_invoices_due_date, stg.creditcard_invoices_statement_period,
+                    stg.creditcard_invoices_amount, stg.creditcard_invoices_paid_amount,
+                    stg.creditcard_invoices_payment_date, stg.creditcard_invoices_status::transactions.invoice_status,
+                    stg.creditcard_invoices_file_url, stg.creditcard_invoices_last_update
+                FROM invoice_changes_staging AS stg
+                WHERE stg.change_type = 'I';
+            """)
+            logger.info(f"{cursor.rowcount} faturas marcadas para inserção.")
+
+        if updates:
+            cursor.execute("""
+                UPDATE transactions.creditcard_invoices AS inv
+                SET
+                    creditcard_invoices_opening_date = stg.creditcard_invoices_opening_date,
+                    creditcard_invoices_closing_date = stg.creditcard_invoices_closing_date,
+                    creditcard_invoices_due_date = stg.creditcard_invoices_due_date,
+                    creditcard_invoices_last_update = stg.creditcard_invoices_last_update
+                FROM invoice_changes_staging AS stg
+                WHERE stg.change_type = 'U'
+                  AND inv.creditcard_invoices_id = stg.creditcard_invoices_id
+                  AND inv.creditcard_invoices_status = 'Aberta'::transactions.invoice_status
+                  AND inv.creditcard_invoices_file_url IS NULL;
+            """)
+            logger.info(f"{cursor.rowcount} faturas marcadas para atualização.")
+
+        cursor.execute("TRUNCATE invoice_changes_staging;")
+
+    except psycopg2.Error as e:
+        logger.error(f"Erro durante a aplicação via staging das operações de banco no lote: {e}")
+        raise
+
+write_engines = {
+    'values': execute_db_changes,
+    'copy': execute_db_changes_copy
+}
+
+def get_write_engine(engine_name: str):
+    """Retorna a função de escrita de faturas correspondente ao motor configurado."""
+    if engine_name not in write_engines:
+        raise ValueError(f"Motor de escrita de faturas inválido: {engine_name}. Opções: {', '.join(write_engines)}.")
+    return write_engines[engine_name]
+
 # --- Lógica de negócio ---
 
 def calculate_batch_size(total_cards: int) -> int:
-    """Calcula o tamanho do lote como 5% do total, respeitando mínimo de 250 e máximo de 1250."""
+    """Calcula o tamanho inicial do lote como 5% do total, respeitando mínimo de 250 e máximo de 1250."""
     size = max(250, min(1250, int(total_cards * 0.05)))
     logger.info(f"Tamanho do lote definido para {size} ({min(size/total_cards,1)*100:.2f}% do total de {total_cards}).")
     return size
 
-def prepare_holidays(now_brt: datetime, months_ahead: int):
-    """Prepara e retorna objeto de feriados nacionais para o período de interesse."""
-    current_year = now_brt.year
-    years_for_holidays = list(range(current_year - 1, current_year + (months_ahead // 12) + 2))
-    br_holidays = holidays.BR(years=years_for_holidays)
-    logger.info(f"Cache de feriados preparado para anos: {years_for_holidays}")
-    return br_holidays
+def index_invoices_by_card(existing_invoices: dict) -> dict:
+    """
+    Agrupa as faturas do lote por cartão, ordenadas por período.
+
+    Retorna um dicionário user_card_id -> lista de (período, fatura) em ordem crescente,
+    permitindo que cada cartão percorra apenas as próprias faturas.
+    """
+    invoices_by_card = {}
+    for (card_id, period), invoice_data in existing_invoices.items():
+        invoices_by_card.setdefault(card_id, []).append((period, invoice_data))
+    for card_invoices in invoices_by_card.values():
+        card_invoices.sort(key=lambda item: item[0])
+    return invoices_by_card
 
 def prepare_changes_for_batch(
     card_details_batch: list,
@@ -251,51 +608,40 @@ def prepare_changes_for_batch(
     start_period_dt: date,
     now_brt: datetime,
     months_ahead: int,
-    br_holidays
+    schedule_cache: InvoiceScheduleCache
 ):
-    """Processa um lote de cartões e determina as mudanças necessárias em faturas."""
+    """
+    Processa um lote de cartões ativos e determina as inserções e atualizações necessárias em faturas.
+
+    A exclusão de faturas de cartões inativos é feita à parte por cleanup_inactive_card_invoices.
+    """
     inserts_batch = []
     updates_batch_dict = {}
-    deletes_batch_set = set()
     
     # Dicionário para rastrear modificações nos closing_dates e propagar para invoices subsequentes
     modified_closing_dates = {}
 
+    # Índice por cartão, construído uma única vez para todo o lote
+    invoices_by_card = index_invoices_by_card(existing_invoices)
+    start_period_str = start_period_dt.strftime('%Y-%m')
+
     for card in card_details_batch:
         card_id = card['user_creditcards_id']
         user_id = card['user_creditcards_user_id']
-        is_active = card['user_creditcards_status']
-
-        if not is_active:
-            for key, invoice_data in existing_invoices.items():
-                inv_card_id, _ = key
-                if inv_card_id == card_id:
-                    due_date_obj = invoice_data.get('creditcard_invoices_due_date')
-                    amount = invoice_data.get('creditcard_invoices_amount', 0.00)
-                    if due_date_obj and due_date_obj > now_brt.date() and math.isclose(amount or 0.00, 0.0, abs_tol=0.01):
-                        deletes_batch_set.add(invoice_data['creditcard_invoices_id'])
-            continue
+        card_invoices = invoices_by_card.get(card_id, [])
 
         last_closing_date = None
-        past_periods = sorted([
-            p for uc_id, p in existing_invoices.keys()
-            if uc_id == card_id and p < start_period_dt.strftime('%Y-%m')
-        ])
+        past_periods = [p for p, _ in card_invoices if p < start_period_str]
         if past_periods:
             last_period_key = (card_id, past_periods[-1])
             last_closing_date = existing_invoices[last_period_key].get('creditcard_invoices_closing_date')
 
-        curr_period_date = start_period_dt
-
-        periods_sorted = sorted([
-            p for (uc_id, p) in existing_invoices.keys() if uc_id == card_id
-        ])
+        periods_sorted = [p for p, _ in card_invoices]
         first_target_invoice_key = None
         previous_invoice_key = None
 
-        for idx, period in enumerate(periods_sorted):
+        for idx, (period, invoice) in enumerate(card_invoices):
             key = (card_id, period)
-            invoice = existing_invoices[key]
             status_val = invoice.get('creditcard_invoices_status')
             file_url = invoice.get('creditcard_invoices_file_url')
             due_date = invoice.get('creditcard_invoices_due_date')
@@ -314,37 +660,33 @@ def prepare_changes_for_batch(
             if prev_closing_date:
                 opening_date_override = prev_closing_date + timedelta(days=1)
 
-        for _ in range(months_ahead):
-            target_year = curr_period_date.year
-            target_month = curr_period_date.month
-            statement_period = curr_period_date.strftime('%Y-%m')
+        schedule = schedule_cache.get_schedule(card, start_period_dt, months_ahead)
+        for scheduled in schedule:
+            statement_period = scheduled["period"]
 
-            try:
-                calculated_dates = calculate_invoice_dates(
-                    card, target_year, target_month, last_closing_date, br_holidays
-                )
-                opening_dt = calculated_dates["opening"]
-                closing_dt = calculated_dates["closing"]
-                due_dt = calculated_dates["due"]
+            if scheduled["error"] is not None:
+                logger.error(f"Erro no cálculo de datas para user_card {card_id} período {statement_period}: {scheduled['error']}")
+                continue
 
-                if first_target_invoice_key == (card_id, statement_period) and opening_date_override:
-                    opening_dt = opening_date_override
+            opening_dt = scheduled["dates"]["opening"]
+            closing_dt = scheduled["dates"]["closing"]
+            due_dt = scheduled["dates"]["due"]
 
-                if closing_dt:
-                    last_closing_date = closing_dt
+            # O cronograma compartilhado assume ausência de fechamento anterior
+            if last_closing_date:
+                opening_dt = last_closing_date + timedelta(days=1)
+                last_closing_date = None
 
-            except Exception as e:
-                logger.error(f"Erro no cálculo de datas para user_card {card_id} período {statement_period}: {e}")
-                curr_period_date += relativedelta(months=1)
-                continue
+            if first_target_invoice_key == (card_id, statement_period) and opening_date_override:
+                opening_dt = opening_date_override
 
             invoice_key = (card_id, statement_period)
             existing_invoice_data = existing_invoices.get(invoice_key)
 
             if existing_invoice_data is None:
-                new_id = generate_invoice_id()
+                # ID reservado em bloco na escrita do lote (assign_invoice_ids)
                 inserts_batch.append({
-                    'creditcard_invoices_id': new_id,
+                    'creditcard_invoices_id': None,
                     'creditcard_invoices_user_creditcard_id': card_id,
                     'creditcard_invoices_user_id': user_id,
                     'creditcard_invoices_creation_datetime': now_brt,
@@ -383,7 +725,6 @@ def prepare_changes_for_batch(
                                 'creditcard_invoices_due_date': due_dt,
                                 'creditcard_invoices_last_update': now_brt
                             }
-            curr_period_date += relativedelta(months=1)
 
     # Segunda etapa: propagar alterações de closing_date para opening_date das faturas subsequentes
     for (card_id, period), new_closing_date in modified_closing_dates.items():
@@ -418,80 +759,411 @@ def prepare_changes_for_batch(
                         'creditcard_invoices_last_update': now_brt
                     }
 
-    return inserts_batch, list(updates_batch_dict.values()), deletes_batch_set
+    return inserts_batch, list(updates_batch_dict.values())
 
-def process_batches(
-    conn,
-    all_card_ids: list,
-    batch_size: int,
-    months_ahead: int,
-    br_holidays,
-    now_brt: datetime
-):
-    """Processa todos os lotes de cartões, realizando as operações de faturas necessárias."""
+def build_period_range(now_brt: datetime, months_ahead: int) -> tuple:
+    """Calcula o período inicial e os limites (YYYY-MM) da janela de análise das faturas."""
     start_period_dt = now_brt.replace(day=1).date()
     end_period_dt = (start_period_dt + relativedelta(months=months_ahead - 1))
     start_period_str = start_period_dt.strftime('%Y-%m')
     end_period_str = end_period_dt.strftime('%Y-%m')
     logger.info(f"Período de análise das faturas: {start_period_str} a {end_period_str}")
+    return start_period_dt, start_period_str, end_period_str
 
-    total_batches = (len(all_card_ids) + batch_size - 1) // batch_size
+def new_batch_stats() -> dict:
+    """Retorna o acumulador de estatísticas de processamento dos lotes."""
+    return {"batches": 0, "cards": 0, "inserts": 0, "updates": 0}
 
-    for batch_index, start in enumerate(range(0, len(all_card_ids), batch_size), start=1):
-        t0 = time.time()
-        batch_ids = all_card_ids[start:start + batch_size]
-        logger.info(f"Processando lote {batch_index}/{total_batches} de cartões (tamanho: {len(batch_ids)})...")
+def merge_batch_stats(total_stats: dict, batch_stats: dict):
+    """Soma as estatísticas de um lote ao acumulador geral."""
+    for key, value in batch_stats.items():
+        total_stats[key] += value
 
-        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-            card_details = fetch_card_details(cur, batch_ids)
-            if not card_details:
-                logger.warning(f"Nenhum detalhe encontrado para o lote de user_card_ids: {batch_ids}")
-                continue
+def log_batch_stats(total_stats: dict, elapsed: float):
+    """Registra as estatísticas agregadas ao final do processamento."""
+    logger.info(f"Resumo: {total_stats['batches']} lotes, {total_stats['cards']} cartões, "
+                f"{total_stats['inserts']} inserções, {total_stats['updates']} atualizações "
+                f"em {elapsed:.2f}s.")
+
+def plan_and_write_batch(
+    conn,
+    batch_index: int,
+    card_details: list,
+    existing_invoices: dict,
+    fetch_seconds: float,
+    start_period_dt: date,
+    months_ahead: int,
+    schedule_cache: InvoiceScheduleCache,
+    batch_sizer: AdaptiveBatchSizer,
+    now_brt: datetime,
+    batch_observer=None
+) -> dict:
+    """
+    Planeja, escreve e commita um lote cujas faturas existentes já foram buscadas.
+
+    Se informado, batch_observer(card_details, existing_invoices, inserts) é chamado após o
+    commit, permitindo repassar o estado do lote a uma etapa seguinte sem relê-lo do banco.
+    """
+    t0 = time.time()
+    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        inserts, updates = prepare_changes_for_batch(
+            card_details, existing_invoices, start_period_dt, now_brt, months_ahead, schedule_cache
+        )
+        t_plan = time.time()
+
+        if inserts or updates:
+            assign_invoice_ids(cur, inserts)
+            get_write_engine(invoice_write_engine)(cur, inserts, updates, now_brt)
+            logger.info(f"Mudanças para o lote {batch_index} preparadas para commit.")
+        else:
+            logger.info(f"Nenhuma mudança necessária para o lote {batch_index}.")
+
+    conn.commit()
+    t_write = time.time()
+    logger.info(f"Lote {batch_index} commitado com sucesso em {fetch_seconds + t_write - t0:.2f}s.")
 
-            existing_invoices = fetch_existing_invoices(cur, batch_ids, start_period_str, end_period_str)
-            inserts, updates, deletes = prepare_changes_for_batch(
-                card_details, existing_invoices, start_period_dt, now_brt, months_ahead, br_holidays
+    if batch_observer is not None:
+        batch_observer(card_details, existing_invoices, inserts)
+
+    batch_sizer.record(
+        len(card_details),
+        {"busca": fetch_seconds, "planejamento": t_plan - t0, "escrita": t_write - t_plan},
+        len(existing_invoices) + len(inserts) + len(updates)
+    )
+
+    return {
+        "batches": 1,
+        "cards": len(card_details),
+        "inserts": len(inserts),
+        "updates": len(updates)
+    }
+
+def process_single_batch(
+    conn,
+    batch_index: int,
+    total_batches: int,
+    card_details: list,
+    start_period_dt: date,
+    start_period_str: str,
+    end_period_str: str,
+    months_ahead: int,
+    schedule_cache: InvoiceScheduleCache,
+    batch_sizer: AdaptiveBatchSizer,
+    now_brt: datetime,
+    batch_observer=None
+) -> dict:
+    """Processa e commita um único lote de cartões, retornando suas estatísticas."""
+    t0 = time.time()
+    batch_ids = [card['user_creditcards_id'] for card in card_details]
+    logger.info(f"Processando lote {batch_index}/~{total_batches} de cartões (tamanho: {len(batch_ids)})...")
+
+    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        existing_invoices = fetch_existing_invoices(cur, batch_ids, start_period_str, end_period_str)
+
+    return plan_and_write_batch(
+        conn, batch_index, card_details, existing_invoices, time.time() - t0,
+        start_period_dt, months_ahead, schedule_cache, batch_sizer, now_brt, batch_observer
+    )
+
+def process_batches(
+    conn,
+    card_batches,
+    total_batches: int,
+    batch_sizer: AdaptiveBatchSizer,
+    months_ahead: int,
+    business_calendar: BusinessDayCalendar,
+    now_brt: datetime,
+    batch_observer=None
+):
+    """Processa todos os lotes de cartões, realizando as operações de faturas necessárias."""
+    t0 = time.time()
+    start_period_dt, start_period_str, end_period_str = build_period_range(now_brt, months_ahead)
+
+    schedule_cache = InvoiceScheduleCache(business_calendar)
+    total_stats = new_batch_stats()
+
+    for batch_index, card_details in enumerate(card_batches, start=1):
+        batch_stats = process_single_batch(
+            conn, batch_index, total_batches, card_details, start_period_dt,
+            start_period_str, end_period_str, months_ahead, schedule_cache, batch_sizer, now_brt,
+            batch_observer
+        )
+        merge_batch_stats(total_stats, batch_stats)
+
+    schedule_cache.log_stats()
+    log_batch_stats(total_stats, time.time() - t0)
+    logger.info("Todos os lotes foram processados.")
+
+def process_batches_parallel(
+    pool,
+    card_batches,
+    total_batches: int,
+    batch_sizer: AdaptiveBatchSizer,
+    months_ahead: int,
+    business_calendar: BusinessDayCalendar,
+    now_brt: datetime,
+    workers: int,
+    batch_observer=None
+):
+    """
+    Processa os lotes de cartões em paralelo, um lote inteiro por worker.
+
+    Cada worker obtém uma conexão do pool, processa e commita o lote de forma independente
+    (os lotes possuem conjuntos disjuntos de cartões); batch_observer, se informado, deve ser
+    seguro para uso concorrente. No máximo 2 lotes por worker ficam
+    em espera, de modo que a leitura dos cartões acompanha o ritmo do processamento. Em caso
+    de erro, nenhum novo lote é enviado, os lotes ainda não iniciados são cancelados e o erro
+    é propagado após a conclusão dos lotes em andamento.
+    """
+    t0 = time.time()
+    start_period_dt, start_period_str, end_period_str = build_period_range(now_brt, months_ahead)
+
+    schedule_cache = InvoiceScheduleCache(business_calendar)
+    total_stats = new_batch_stats()
+    max_in_flight = workers * 2
+    logger.info(f"Processamento paralelo de ~{total_batches} lotes com {workers} workers.")
+
+    def run_batch(batch_index: int, card_details: list) -> dict:
+        conn = pool.getconn()
+        try:
+            return process_single_batch(
+                conn, batch_index, total_batches, card_details, start_period_dt,
+                start_period_str, end_period_str, months_ahead, schedule_cache, batch_sizer, now_brt,
+                batch_observer
             )
+        except Exception:
+            conn.rollback()
+            logger.warning(f"Rollback do lote {batch_index} realizado devido a erro.")
+            raise
+        finally:
+            pool.putconn(conn)
 
-            if inserts or updates or deletes:
-                execute_db_changes(cur, inserts, updates, deletes, now_brt)
-                logger.info(f"Mudanças para o lote {batch_index} preparadas para commit.")
-            else:
-                logger.info(f"Nenhuma mudança necessária para o lote {batch_index}.")
+    in_flight = {}
+    errors = []
 
-        conn.commit()
-        logger.info(f"Lote {batch_index} commitado com sucesso em {time.time() - t0:.2f}s.")
+    def collect(done_futures):
+        for future in done_futures:
+            batch_index = in_flight.pop(future)
+            if future.cancelled():
+                continue
+            try:
+                merge_batch_stats(total_stats, future.result())
+            except Exception as e:
+                if not errors:
+                    logger.error(f"Erro no lote {batch_index}; cancelando lotes pendentes: {e}")
+                    for pending in in_flight:
+                        pending.cancel()
+                errors.append(e)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch_index, card_details in enumerate(card_batches, start=1):
+            if len(in_flight) >= max_in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            if errors:
+                break
+            in_flight[executor.submit(run_batch, batch_index, card_details)] = batch_index
+        if in_flight:
+            done, _ = wait(in_flight)
+            collect(done)
+
+    schedule_cache.log_stats()
+    log_batch_stats(total_stats, time.time() - t0)
+    if errors:
+        raise errors[0]
+    logger.info("Todos os lotes foram processados.")
+
+def process_batches_pipelined(
+    conn,
+    prefetch_conn,
+    card_batches,
+    total_batches: int,
+    batch_sizer: AdaptiveBatchSizer,
+    months_ahead: int,
+    business_calendar: BusinessDayCalendar,
+    now_brt: datetime,
+    depth: int,
+    batch_observer=None
+):
+    """
+    Processa os lotes em pipeline, sobrepondo a busca do próximo lote ao processamento do atual.
+
+    Uma thread de pré-busca lê os cartões (card_batches deve usar prefetch_conn) e as faturas
+    existentes dos próximos lotes em uma conexão própria, mantendo no máximo `depth` lotes em
+    fila. A thread principal planeja, escreve e commita os lotes na ordem em que foram lidos.
+    """
+    t0 = time.time()
+    start_period_dt, start_period_str, end_period_str = build_period_range(now_brt, months_ahead)
+
+    schedule_cache = InvoiceScheduleCache(business_calendar)
+    total_stats = new_batch_stats()
+    prefetched = queue.Queue(maxsize=depth)
+    stop_event = threading.Event()
+    end_of_batches = object()
+    logger.info(f"Processamento em pipeline de ~{total_batches} lotes (profundidade: {depth}).")
+
+    def put(item) -> bool:
+        while not stop_event.is_set():
+            try:
+                prefetched.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def prefetch():
+        try:
+            for card_details in card_batches:
+                t_fetch = time.time()
+                batch_ids = [card['user_creditcards_id'] for card in card_details]
+                with prefetch_conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                    existing_invoices = fetch_existing_invoices(cur, batch_ids, start_period_str, end_period_str)
+                prefetch_conn.commit()
+                if not put((card_details, existing_invoices, time.time() - t_fetch)):
+                    return
+            put(end_of_batches)
+        except Exception as e:
+            put(e)
+
+    prefetch_thread = threading.Thread(target=prefetch, name="invoice-prefetch", daemon=True)
+    prefetch_thread.start()
+    try:
+        batch_index = 0
+        while True:
+            item = prefetched.get()
+            if item is end_of_batches:
+                break
+            if isinstance(item, Exception):
+                raise item
+            batch_index += 1
+            card_details, existing_invoices, fetch_seconds = item
+            logger.info(f"Processando lote {batch_index}/~{total_batches} de cartões (tamanho: {len(card_details)})...")
+            batch_stats = plan_and_write_batch(
+                conn, batch_index, card_details, existing_invoices, fetch_seconds,
+                start_period_dt, months_ahead, schedule_cache, batch_sizer, now_brt, batch_observer
+            )
+            merge_batch_stats(total_stats, batch_stats)
+    finally:
+        stop_event.set()
+        prefetch_thread.join()
 
+    schedule_cache.log_stats()
+    log_batch_stats(total_stats, time.time() - t0)
     logger.info("Todos os lotes foram processados.")
 
 # --- Execução principal ---
 
-def main():
-    """Função principal que executa o processo de gerenciamento de faturas."""
-    logger.info("Iniciando script de gerenciamento de faturas...")
-    conn = None
+def run_invoice_maintenance(conn, now_brt: datetime = None, business_calendar: BusinessDayCalendar = None,
+                            pool=None, batch_observer=None):
+    """
+    Executa a manutenção completa de faturas (limpeza, geração e atualização) na conexão informada.
+
+    Usada por main() e pelo orquestrador, que pode compartilhar o instante de referência,
+    o calendário de dias úteis, o pool de conexões (para os modos paralelo e em pipeline)
+    e receber o estado de cada lote por batch_observer. Recursos criados aqui são liberados
+    aqui; os recebidos permanecem sob responsabilidade de quem chamou.
+    """
+    own_pool = None
+    prefetch_conn = None
     try:
-        conn = get_db_connection()
-        now_brt = datetime.now(db_timezone).replace(tzinfo=None)
+        if now_brt is None:
+            now_brt = datetime.now(db_timezone).replace(tzinfo=None)
+        run_started_at = fetch_db_timestamp(conn)
+        _, start_period_str, end_period_str = build_period_range(now_brt, lookahead_months)
+        cleanup_inactive_card_invoices(conn, start_period_str, end_period_str, now_brt.date())
+
+        watermark = fetch_job_watermark(conn, invoice_job_name) if invoice_mode == 'incremental' else None
+        if watermark is None:
+            logger.info(f"Modo de reconciliação completa (modo configurado: {invoice_mode}).")
+            card_ids = None
+            total_cards = estimate_card_count(conn)
+        else:
+            logger.info(f"Modo incremental a partir da marca d'água {watermark}.")
+            card_ids = fetch_changed_card_ids(conn, watermark, end_period_str)
+            total_cards = len(card_ids)
+        conn.commit()
 
-        all_card_ids = fetch_all_card_ids(conn)
-        total_cards = len(all_card_ids)
         if total_cards == 0:
             logger.info("Nenhum cartão encontrado para processar.")
+            save_job_watermark(conn, invoice_job_name, run_started_at)
             return
 
         batch_size = calculate_batch_size(total_cards)
-        br_holidays = prepare_holidays(now_brt, lookahead_months)
-
-        process_batches(
-            conn,
-            all_card_ids,
-            batch_size,
-            lookahead_months,
-            br_holidays,
-            now_brt
+        get_write_engine(invoice_write_engine)
+        logger.info(f"Motor de escrita de faturas: {invoice_write_engine}.")
+        if business_calendar is None:
+            business_calendar = prepare_business_calendar(now_brt, lookahead_months)
+        total_batches = (total_cards + batch_size - 1) // batch_size
+        batch_sizer = AdaptiveBatchSizer(
+            batch_size, 50, 5000, invoice_batch_target_seconds, invoice_batch_max_rows
         )
 
+        if invoice_workers > 1:
+            card_batches = iter_card_detail_batches(conn, batch_sizer, card_ids)
+            if pool is None:
+                own_pool = pool = get_db_connection_pool(invoice_workers)
+            process_batches_parallel(
+                pool,
+                card_batches,
+                total_batches,
+                batch_sizer,
+                lookahead_months,
+                business_calendar,
+                now_brt,
+                invoice_workers,
+                batch_observer
+            )
+        elif invoice_pipeline_depth > 0:
+            prefetch_conn = pool.getconn() if pool is not None else get_db_connection()
+            card_batches = iter_card_detail_batches(prefetch_conn, batch_sizer, card_ids)
+            process_batches_pipelined(
+                conn,
+                prefetch_conn,
+                card_batches,
+                total_batches,
+                batch_sizer,
+                lookahead_months,
+                business_calendar,
+                now_brt,
+                invoice_pipeline_depth,
+                batch_observer
+            )
+        else:
+            card_batches = iter_card_detail_batches(conn, batch_sizer, card_ids)
+            process_batches(
+                conn,
+                card_batches,
+                total_batches,
+                batch_sizer,
+                lookahead_months,
+                business_calendar,
+                now_brt,
+                batch_observer
+            )
+
+        save_job_watermark(conn, invoice_job_name, run_started_at)
+
+    finally:
+        if prefetch_conn:
+            if pool is not None and own_pool is None:
+                prefetch_conn.rollback()
+                pool.putconn(prefetch_conn)
+                logger.info("Conexão de pré-busca devolvida ao pool.")
+            else:
+                prefetch_conn.close()
+                logger.info("Conexão de pré-busca com o banco de dados fechada.")
+        if own_pool:
+            own_pool.closeall()
+            logger.info("Pool de conexões com o banco de dados fechado.")
+
+def main():
+    """Função principal que executa o processo de gerenciamento de faturas."""
+    logger.info("Iniciando script de gerenciamento de faturas...")
+    conn = None
+    try:
+        conn = get_db_connection()
+        run_invoice_maintenance(conn)
+
     except psycopg2.Error as db_err:
         logger.error(f"Erro de banco de dados durante a execução: {db_err}")
         if conn:
@@ -0,0 +1,516 @@
+import os
+import sys
+import argparse
+import calendar
+import psycopg2
+import psycopg2.extras
+import logging
+from datetime import datetime, timedelta, date
+from dateutil.relativedelta import relativedelta
+import pytz
+from dotenv import load_dotenv
+
+# Código compartilhado entre os scripts de automação (pasta shared)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "shared"))
+from job_common import (
+    prepare_business_calendar,
+    calculate_invoice_dates,
+    allocate_ids
+)
+
+# --- Configuração de logging ---
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(module)s - %(funcName)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# --- Constantes e configuração ---
+load_dotenv()
+
+db_name = os.getenv("DB_NAME")
+db_user = os.getenv("DB_USER")
+db_password = os.getenv("DB_PASSWORD")
+db_host = os.getenv("DB_HOST", "localhost")
+db_port = os.getenv("DB_PORT", "5432")
+
+recurrence_horizon_months = int(os.getenv("RECURRENCE_HORIZON_MONTHS", "3"))
+recurrence_batch_rows = int(os.getenv("RECURRENCE_BATCH_ROWS", "20000"))
+# Gerar também ocorrências anteriores ao mês corrente (lançadas como Efetuado em faturas passadas)
+recurrence_backfill_history = os.getenv("RECURRENCE_BACKFILL_HISTORY", "false").strip().lower() == "true"
+transaction_id_sequence = 'transactions.creditcard_transactions_id_seq'
+db_timezone_str = 'America/Sao_Paulo'
+db_timezone = pytz.timezone(db_timezone_str)
+
+# Intervalo, em meses, de cada frequência mensal ou maior (Semanal é tratada em dias)
+frequency_step_months = {
+    'Mensal': 1,
+    'Bimestral': 2,
+    'Trimestral': 3,
+    'Semestral': 6,
+    'Anual': 12
+}
+weekly_step_days = 7
+
+# --- Conexão com o banco de dados ---
+
+def get_db_connection() -> psycopg2.extensions.connection:
+    """Estabelece e retorna uma conexão com o banco de dados."""
+    try:
+        conn = psycopg2.connect(
+            dbname=db_name,
+            user=db_user,
+            password=db_password,
+            host=db_host,
+            port=db_port
+        )
+        logger.info("Conexão com o banco de dados estabelecida.")
+        return conn
+    except psycopg2.Error as e:
+        logger.error(f"Erro ao conectar ao banco de dados: {e}")
+        raise
+
+# --- Utilitários ---
+
+def month_index(target_date: date) -> int:
+    """Retorna o número absoluto do mês da data (ano * 12 + mês - 1)."""
+    return target_date.year * 12 + target_date.month - 1
+
+def build_month_lengths(first_month_index: int, last_month_index: int) -> list:
+    """Pré-computa a quantidade de dias de cada mês do intervalo de índices absolutos."""
+    return [
+        calendar.monthrange(index // 12, index % 12 + 1)[1]
+        for index in range(first_month_index, last_month_index + 1)
+    ]
+
+# --- Expansão das recorrências ---
+
+def expand_weekly_recurrences(recurrences: list) -> list:
+    """
+    Expande as recorrências semanais em datas nominais de ocorrência.
+
+    As ocorrências são first_due_date + 7k; o intervalo de k de cada recorrência é obtido
+    por aritmética a partir da data inicial de geração e do fim (horizonte ou última data).
+    """
+    occurrences = []
+    for recurrence in recurrences:
+        first_due = recurrence['creditcard_recurrence_first_due_date']
+        start, end = recurrence['generation_start'], recurrence['generation_end']
+        first_k = max(0, -(-(start - first_due).days // weekly_step_days))
+        last_k = (end - first_due).days // weekly_step_days
+        for k in range(first_k, last_k + 1):
+            occurrences.append((recurrence, first_due + timedelta(days=weekly_step_days * k)))
+    return occurrences
+
+def expand_monthly_recurrences(recurrences: list, step_months: int, horizon: date) -> list:
+    """
+    Expande as recorrências de uma mesma frequência mensal (ou maior) em datas nominais.
+
+    A primeira ocorrência é first_due_date; as seguintes caem a cada step_months meses no
+    due_day, limitado ao último dia do mês. A tabela de dias por mês é calculada uma única
+    vez para todo o grupo e o intervalo de k de cada recorrência é obtido por aritmética.
+    """
+    if not recurrences:
+        return []
+    base_index = min(month_index(r['creditcard_recurrence_first_due_date']) for r in recurrences)
+    # Um intervalo além do horizonte: a busca da primeira ocorrência pode ultrapassá-lo
+    month_lengths = build_month_lengths(base_index, month_index(horizon) + step_months)
+
+    def occurrence_date(first_due: date, first_index: int, due_day: int, k: int) -> date:
+        if k == 0:
+            return first_due
+        index = first_index + step_months * k
+        return date(index // 12, index % 12 + 1, min(due_day, month_lengths[index - base_index]))
+
+    occurrences = []
+    for recurrence in recurrences:
+        first_due = recurrence['creditcard_recurrence_first_due_date']
+        due_day = recurrence['creditcard_recurrence_due_day']
+        start, end = recurrence['generation_start'], recurrence['generation_end']
+        first_index = month_index(first_due)
+
+        first_k = max(0, -(-(month_index(start) - first_index) // step_months))
+        if occurrence_date(first_due, first_index, due_day, first_k) < start:
+            first_k += 1
+        last_k = (month_index(end) - first_index) // step_months
+        # Inclusive k = 0: first_due_date pode ser posterior ao fim no mesmo mês
+        if last_k >= 0 and occurrence_date(first_due, first_index, due_day, last_k) > end:
+            last_k -= 1
+
+        for k in range(first_k, last_k + 1):
+            occurrences.append((recurrence, occurrence_date(first_due, first_index, due_day, k)))
+    return occurrences
+
+def expand_recurrences(recurrences: list, horizon: date) -> list:
+    """Agrupa as recorrências por frequência e expande cada grupo de uma só vez."""
+    groups = {}
+    for recurrence in recurrences:
+        groups.setdefault(recurrence['creditcard_recurrence_frequency'], []).append(recurrence)
+
+    occurrences = []
+    for frequency, group in groups.items():
+        if frequency == 'Semanal':
+            group_occurrences = expand_weekly_recurrences(group)
+        else:
+            group_occurrences = expand_monthly_recurrences(group, frequency_step_months[frequency], horizon)
+        logger.info(f"Frequência {frequency}: {len(group)} recorrências, {len(group_occurrences)} ocorrências.")
+        occurrences.extend(group_occurrences)
+    return occurrences
+
+def statement_period_for_date(recurrence: dict, target_date: date, business_calendar, closing_cache: dict) -> tuple:
+    """
+    Retorna o (ano, mês) da fatura do cartão que cobre a data: a primeira cujo fechamento
+    ocorre na data ou depois dela.
+
+    As datas de fechamento vêm de calculate_invoice_dates, com as mesmas regras de
+    manage_invoices (dia de vencimento, dias entre fechamento e vencimento e adiamento do
+    vencimento para dia útil), e são memorizadas por configuração de cobrança e mês.
+    """
+    billing_key = (
+        recurrence['user_creditcards_due_day'],
+        recurrence['user_creditcards_closing_day'],
+        bool(recurrence['creditcards_postpone_due_date_to_business_day'])
+    )
+    # O fechamento de um mês pode cair no mês anterior; a busca começa um mês antes da data
+    period_date = target_date.replace(day=1) - relativedelta(months=1)
+    while True:
+        cache_key = billing_key + (period_date.year, period_date.month)
+        closing_date = closing_cache.get(cache_key)
+        if closing_date is None:
+            closing_date = calculate_invoice_dates(
+                recurrence, period_date.year, period_date.month, None, business_calendar
+            )["closing"]
+            closing_cache[cache_key] = closing_date
+        if closing_date >= target_date:
+            return period_date.year, period_date.month
+        period_date += relativedelta(months=1)
+
+def build_occurrence_rows(occurrences: list, business_calendar, today: date) -> list:
+    """
+    Monta as linhas das ocorrências, com a data agendada e o status de cada uma.
+
+    Recorrências com adiamento têm a data ajustada para o próximo dia útil pelo calendário
+    pré-computado. Ocorrências até hoje são geradas como Efetuado e as futuras como
+    Pendente. O período da fatura calculado pelas datas de fechamento do cartão (ver
+    statement_period_for_date) é usado apenas quando não há fatura cadastrada cobrindo a data.
+    """
+    closing_cache = {}
+    rows = []
+    for recurrence, nominal_date in occurrences:
+        scheduled_date = nominal_date
+        if recurrence['creditcard_recurrence_postpone_to_business_day']:
+            scheduled_date = business_calendar.next_business_day(nominal_date)
+        statement_year, statement_month = statement_period_for_date(
+            recurrence, scheduled_date, business_calendar, closing_cache
+        )
+        rows.append((
+            recurrence['creditcard_recurrence_id'],
+            nominal_date,
+            scheduled_date,
+            'Efetuado' if scheduled_date <= today else 'Pendente',
+            statement_year,
+            statement_month
+        ))
+    return rows
+
+# --- Operações de banco de dados ---
+
+active_recurrences_query = """
+    SELECT
+        r.creditcard_recurrence_id,
+        r.creditcard_recurrence_frequency,
+        r.creditcard_recurrence_due_day,
+        r.creditcard_recurrence_first_due_date,
+        r.creditcard_recurrence_last_due_date,
+        r.creditcard_recurrence_postpone_to_business_day,
+        uc.user_creditcards_id,
+        uc.user_creditcards_due_day,
+        uc.user_creditcards_closing_day,
+        cc.creditcards_postpone_due_date_to_business_day,
+        last_occurrence.occurrence_date AS last_occurrence_date
+    FROM transactions.creditcard_recurrence r
+    JOIN core.user_creditcards uc ON uc.user_creditcards_id = r.creditcard_recurrence_user_card_id
+    JOIN core.creditcards cc ON cc.creditcards_id = uc.user_creditcards_creditcard_id
+    LEFT JOIN LATERAL (
+        SELECT MAX(ct.creditcard_transactions_recurrence_occurrence_date) AS occurrence_date
+        FROM transactions.creditcard_transactions ct
+        WHERE ct.creditcard_transactions_recurrence_id = r.creditcard_recurrence_id
+    ) last_occurrence ON TRUE
+    WHERE r.creditcard_recurrence_status = 'Ativo'
+      AND uc.user_creditcards_status
+      AND r.creditcard_recurrence_first_due_date <= LEAST(%(horizon)s, COALESCE(r.creditcard_recurrence_last_due_date, %(horizon)s))
+      AND (%(floor)s::date IS NULL OR COALESCE(r.creditcard_recurrence_last_due_date, %(horizon)s) >= %(floor)s::date)
+      AND (
+          last_occurrence.occurrence_date IS NULL
+          OR last_occurrence.occurrence_date < LEAST(%(horizon)s, COALESCE(r.creditcard_recurrence_last_due_date, %(horizon)s))
+      )
+    ORDER BY r.creditcard_recurrence_id;
+"""
+
+def fetch_active_recurrences(conn, horizon: date, generation_floor: date = None) -> list:
+    """
+    Busca as recorrências ativas de cartões ativos com ocorrências a gerar até o horizonte.
+
+    A geração de cada recorrência começa no dia seguinte à última ocorrência já gerada
+    (ou em first_due_date), de modo que ocorrências excluídas pelo usuário antes dela não
+    são recriadas e o custo acompanha apenas as novas ocorrências. Com generation_floor, a
+    geração não começa antes dessa data (ver run_recurrence_expansion).
+    """
+    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        cur.execute(active_recurrences_query, {"horizon": horizon, "floor": generation_floor})
+        rows = cur.fetchall()
+    conn.rollback()
+
+    recurrences = []
+    for row in rows:
+        recurrence = dict(row)
+        last_occurrence = recurrence['last_occurrence_date']
+        recurrence['generation_start'] = (
+            last_occurrence + timedelta(days=1) if last_occurrence else recurrence['creditcard_recurrence_first_due_date']
+        )
+        if generation_floor is not None:
+            recurrence['generation_start'] = max(recurrence['generation_start'], generation_floor)
+        recurrence['generation_end'] = min(horizon, recurrence['creditcard_recurrence_last_due_date'] or horizon)
+        recurrences.append(recurrence)
+    logger.info(f"{len(recurrences)} recorrências ativas com ocorrências a gerar até {horizon}.")
+    return recurrences
+
+def insert_occurrences_batch(cursor, occurrence_rows: list, now_brt: datetime) -> int:
+    """
+    Insere as transações de um lote de ocorrências em uma única instrução.
+
+    Os dados da recorrência, do cartão e da fatura que cobre a data agendada são obtidos no
+    próprio INSERT ... SELECT. A chave (recorrência, data nominal da ocorrência) torna a
+    inserção idempotente: ocorrências já geradas são ignoradas por ON CONFLICT DO NOTHING.
+    """
+    if not occurrence_rows:
+        return 0
+
+    new_ids = allocate_ids(
+        cursor, transaction_id_sequence, 'transactions.creditcard_transactions', 'creditcard_transactions_id', 'T',
+        len(occurrence_rows)
+    )
+    values_to_insert = [
+        (
+            transaction_id,
+            recurrence_id,
+            nominal_date,
+            scheduled_date,
+            datetime.combine(scheduled_date, datetime.min.time()),
+            status,
+            fallback_year,
+            fallback_month,
+            now_brt
+        ) for transaction_id, (recurrence_id, nominal_date, scheduled_date, status, fallback_year, fallback_month)
+        in zip(new_ids, occurrence_rows)
+    ]
+
+    insert_query = """
+        INSERT INTO transactions.creditcard_transactions (
+            creditcard_transactions_id,
+            creditcard_transactions_user_id,
+            creditcard_transactions_user_card_id,
+            creditcard_transactions_invoice_id,
+            creditcard_transactions_procedure,
+            creditcard_transactions_status,
+            creditcard_transactions_category_id,
+            creditcard_transactions_operator_id,
+            creditcard_transactions_description_id,
+            creditcard_transactions_is_recurrence,
+            creditcard_transactions_recurrence_id,
+            creditcard_transactions_recurrence_occurrence_date,
+            creditcard_transactions_schedule_datetime,
+            creditcard_transactions_implementation_datetime,
+            creditcard_transactions_statement_month,
+            creditcard_transactions_statement_year,
+            creditcard_transactions_is_installment,
+            creditcard_transactions_installment_count,
+            creditcard_transactions_base_value,
+            creditcard_transactions_fees_taxes,
+            creditcard_transactions_relevance_ir,
+            creditcard_transactions_last_update
+        )
+        SELECT
+            data.transaction_id,
+            uc.user_creditcards_user_id,
+            r.creditcard_recurrence_user_card_id,
+            inv.creditcard_invoices_id,
+            r.creditcard_recurrence_procedure,
+            data.status::transactions.status,
+            r.creditcard_recurrence_category_id,
+            r.creditcard_recurrence_operator_id,
+            r.creditcard_recurrence_description_id,
+            TRUE,
+            r.creditcard_recurrence_id,
+            data.occurrence_date,
+            data.scheduled_dt,
+            data.scheduled_dt,
+            (enum_range(NULL::transactions.month_enum))[
+                COALESCE(split_part(inv.creditcard_invoices_statement_period, '-', 2)::int, data.fallback_month)
+            ],
+            COALESCE(split_part(inv.creditcard_invoices_statement_period, '-', 1)::int, data.fallback_year),
+            FALSE,
+            1,
+            r.creditcard_recurrence_base_value,
+            r.creditcard_recurrence_fees_taxes,
+            r.creditcard_recurrence_relevance_ir,
+            data.last_updt
+        FROM (VALUES %s) AS data(transaction_id, recurrence_id, occurrence_date, scheduled_date, scheduled_dt,
+                                 status, fallback_year, fallback_month, last_updt)
+        JOIN transactions.creditcard_recurrence r ON r.creditcard_recurrence_id = data.recurrence_id
+        JOIN core.user_creditcards uc ON uc.user_creditcards_id = r.creditcard_recurrence_user_card_id
+        LEFT JOIN LATERAL (
+            SELECT creditcard_invoices_id, creditcard_invoices_statement_period
+            FROM transactions.creditcard_invoices
+            WHERE creditcard_invoices_user_creditcard_id = r.creditcard_recurrence_user_card_id
+              AND data.scheduled_date BETWEEN creditcard_invoices_opening_date AND creditcard_invoices_closing_date
+            ORDER BY creditcard_invoices_statement_period
+            LIMIT 1
+        ) inv ON TRUE
+        ON CONFLICT (creditcard_transactions_recurrence_id, creditcard_transactions_recurrence_occurrence_date)
+            WHERE creditcard_transactions_recurrence_id IS NOT NULL
+              AND creditcard_transactions_recurrence_occurrence_date IS NOT NULL
+        DO NOTHING;
+    """
+    try:
+        # page_size do tamanho do lote: uma única instrução INSERT por lote
+        psycopg2.extras.execute_values(
+            cursor, insert_query, values_to_insert,
+            template="(%s, %s, %s::date, %s::date, %s::timestamp, %s, %s::int, %s::int, %s::timestamp)",
+            page_size=len(values_to_insert)
+        )
+        return cursor.rowcount
+    except psycopg2.Error as e:
+        logger.error(f"Erro na inserção em lote de ocorrências de recorrências: {e}")
+        raise
+
+promote_due_occurrences_query = """
+    UPDATE transactions.creditcard_transactions ct
+    SET
+        creditcard_transactions_status = 'Efetuado',
+        creditcard_transactions_invoice_id = COALESCE(ct.creditcard_transactions_invoice_id, (
+            SELECT inv.creditcard_invoices_id
+            FROM transactions.creditcard_invoices inv
+            WHERE inv.creditcard_invoices_user_creditcard_id = ct.creditcard_transactions_user_card_id
+              AND ct.creditcard_transactions_schedule_datetime::date
+                  BETWEEN inv.creditcard_invoices_opening_date AND inv.creditcard_invoices_closing_date
+            ORDER BY inv.creditcard_invoices_statement_period
+            LIMIT 1
+        )),
+        creditcard_transactions_last_update = %(now)s
+    WHERE ct.creditcard_transactions_recurrence_occurrence_date IS NOT NULL
+      AND ct.creditcard_transactions_status = 'Pendente'
+      AND ct.creditcard_transactions_schedule_datetime <= %(now)s;
+"""
+
+def promote_due_occurrences(conn, now_brt: datetime) -> int:
+    """
+    Efetiva as ocorrências geradas como Pendente cuja data agendada já chegou.
+
+    A fatura é preenchida na mesma instrução quando ainda não havia fatura cadastrada
+    cobrindo a data no momento da geração.
+    """
+    try:
+        with conn.cursor() as cur:
+            cur.execute(promote_due_occurrences_query, {"now": now_brt})
+            promoted = cur.rowcount
+        conn.commit()
+        logger.info(f"{promoted} ocorrências pendentes efetivadas.")
+        return promoted
+    except psycopg2.Error as e:
+        conn.rollback()
+        logger.error(f"Erro ao efetivar ocorrências pendentes: {e}")
+        raise
+
+# --- Execução ---
+
+def build_horizon(now_brt: datetime, months_ahead: int) -> date:
+    """Retorna o último dia do mês que fica months_ahead meses após o mês corrente."""
+    return now_brt.date().replace(day=1) + relativedelta(months=months_ahead + 1) - timedelta(days=1)
+
+def run_recurrence_expansion(conn, now_brt: datetime = None, business_calendar=None, months_ahead: int = None,
+                             backfill_history: bool = None) -> int:
+    """
+    Gera as transações das recorrências ativas até o horizonte e retorna quantas foram inseridas.
+
+    Por padrão a geração começa no mês corrente: uma recorrência nova com first_due_date no
+    passado (ou uma execução após longa interrupção) não lança ocorrências como Efetuado em
+    faturas de meses anteriores. Com backfill_history (--backfill-history ou
+    RECURRENCE_BACKFILL_HISTORY=true), as ocorrências desde first_due_date são geradas.
+
+    Usada por main() e pelo orquestrador, que pode compartilhar o instante de referência e o
+    calendário de dias úteis (BusinessDayCalendar de shared/job_common).
+    """
+    if now_brt is None:
+        now_brt = datetime.now(db_timezone).replace(tzinfo=None)
+    if months_ahead is None:
+        months_ahead = recurrence_horizon_months
+    if backfill_history is None:
+        backfill_history = recurrence_backfill_history
+    horizon = build_horizon(now_brt, months_ahead)
+    generation_floor = None if backfill_history else now_brt.date().replace(day=1)
+
+    promote_due_occurrences(conn, now_brt)
+
+    recurrences = fetch_active_recurrences(conn, horizon, generation_floor)
+    if not recurrences:
+        logger.info("Nenhuma recorrência com ocorrências a gerar.")
+        return 0
+
+    if business_calendar is None:
+        business_calendar = prepare_business_calendar(now_brt, months_ahead)
+    occurrence_rows = build_occurrence_rows(expand_recurrences(recurrences, horizon), business_calendar, now_brt.date())
+    logger.info(f"{len(occurrence_rows)} ocorrências calculadas até {horizon}.")
+
+    total_inserted = 0
+    for start in range(0, len(occurrence_rows), recurrence_batch_rows):
+        batch_rows = occurrence_rows[start:start + recurrence_batch_rows]
+        try:
+            with conn.cursor() as cur:
+                inserted = insert_occurrences_batch(cur, batch_rows, now_brt)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        total_inserted += inserted
+        logger.info(f"Lote de {len(batch_rows)} ocorrências: {inserted} transações inseridas "
+                    f"({len(batch_rows) - inserted} já existentes).")
+
+    logger.info(f"Geração concluída: {total_inserted} transações recorrentes inseridas.")
+    return total_inserted
+
+def main():
+    """Função principal que gera as transações das recorrências de cartão de crédito."""
+    parser = argparse.ArgumentParser(description="Geração das transações de recorrências de cartão de crédito.")
+    parser.add_argument("--horizon-months", type=int, default=recurrence_horizon_months,
+                        help="Meses, após o corrente, até os quais as ocorrências são geradas.")
+    parser.add_argument("--backfill-history", action="store_true", default=recurrence_backfill_history,
+                        help="Gera também as ocorrências anteriores ao mês corrente.")
+    args = parser.parse_args()
+
+    logger.info("Iniciando script de geração de recorrências de cartão de crédito...")
+    conn = None
+    try:
+        conn = get_db_connection()
+        run_recurrence_expansion(conn, months_ahead=args.horizon_months, backfill_history=args.backfill_history)
+
+    except psycopg2.Error as db_err:
+        logger.error(f"Erro de banco de dados durante a execução: {db_err}")
+        if conn:
+            conn.rollback()
+            logger.warning("Rollback da transação atual (se houver) realizado devido a erro de DB.")
+    except Exception as e:
+        logger.exception(f"Erro inesperado durante a execução do script: {e}")
+        if conn:
+            try:
+                conn.rollback()
+                logger.warning("Rollback da transação atual (se houver) realizado devido a erro inesperado.")
+            except psycopg2.Error as rb_err:
+                logger.error(f"Erro ao tentar realizar rollback: {rb_err}")
+    finally:
+        if conn:
+            conn.close()
+            logger.info("Conexão com o banco de dados fechada.")
+
+if __name__ == "__main__":
+    main()
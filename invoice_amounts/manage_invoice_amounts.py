@@ -0,0 +1,372 @@
+import os
+import argparse
+import psycopg2
+import psycopg2.extras
+import logging
+from datetime import datetime, timedelta
+import pytz
+from dotenv import load_dotenv
+
+# --- Configuração de logging ---
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(module)s - %(funcName)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# --- Constantes e configuração ---
+load_dotenv()
+
+db_name = os.getenv("DB_NAME")
+db_user = os.getenv("DB_USER")
+db_password = os.getenv("DB_PASSWORD")
+db_host = os.getenv("DB_HOST", "localhost")
+db_port = os.getenv("DB_PORT", "5432")
+
+amounts_mode = os.getenv("AMOUNTS_MODE", "incremental").strip().lower()
+amounts_batch_size = int(os.getenv("AMOUNTS_BATCH_SIZE", "5000"))
+# Recuo da marca d'água quando há sessões cujo início de transação não pode ser inspecionado
+# em pg_stat_activity (sem pg_read_all_stats); ver fetch_safe_watermark
+amounts_watermark_overlap = timedelta(minutes=int(os.getenv("AMOUNTS_WATERMARK_OVERLAP_MINUTES", "10")))
+amounts_job_name = 'manage_invoice_amounts'
+db_timezone_str = 'America/Sao_Paulo'
+db_timezone = pytz.timezone(db_timezone_str)
+
+# --- Conexão com o banco de dados ---
+
+def get_db_connection() -> psycopg2.extensions.connection:
+    """Estabelece e retorna uma conexão com o banco de dados."""
+    try:
+        conn = psycopg2.connect(
+            dbname=db_name,
+            user=db_user,
+            password=db_password,
+            host=db_host,
+            port=db_port
+        )
+        logger.info("Conexão com o banco de dados estabelecida.")
+        return conn
+    except psycopg2.Error as e:
+        logger.error(f"Erro ao conectar ao banco de dados: {e}")
+        raise
+
+# --- Marca d'água ---
+
+def fetch_safe_watermark(conn) -> datetime:
+    """
+    Calcula a marca d'água desta execução, segura para transações ainda em andamento.
+
+    O changed_at do log de auditoria é o início da transação que fez a alteração
+    (CURRENT_TIMESTAMP), não o seu commit. A marca d'água é o menor instante entre o início
+    desta execução e o início da transação aberta mais antiga das demais sessões do banco:
+    como é calculada antes da leitura do log, toda alteração com changed_at anterior a ela já
+    estava commitada e é vista por esta execução. Sessões de outros usuários só expõem
+    xact_start com pg_read_all_stats; se alguma não puder ser inspecionada, a marca d'água
+    recua amounts_watermark_overlap.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT
+                LEAST(CURRENT_TIMESTAMP, MIN(xact_start)),
+                COUNT(*) FILTER (WHERE query = '<insufficient privilege>')
+            FROM pg_stat_activity
+            WHERE datname = current_database()
+              AND backend_type = 'client backend'
+              AND pid <> pg_backend_pid();
+        """)
+        watermark, hidden_sessions = cur.fetchone()
+    if hidden_sessions:
+        logger.warning(f"{hidden_sessions} sessões sem permissão de inspeção em pg_stat_activity; "
+                       f"marca d'água recuada em {amounts_watermark_overlap}.")
+        watermark -= amounts_watermark_overlap
+    return watermark
+
+def fetch_job_watermark(conn, job_name: str):
+    """Busca a marca d'água (início da última execução bem-sucedida) do job, se existir."""
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT job_watermarks_last_run FROM core.job_watermarks WHERE job_watermarks_job_name = %s;",
+            (job_name,)
+        )
+        row = cur.fetchone()
+    return row[0] if row else None
+
+def save_job_watermark(conn, job_name: str, watermark: datetime):
+    """Persiste a marca d'água do job calculada no início da execução concluída."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO core.job_watermarks (job_watermarks_job_name, job_watermarks_last_run, job_watermarks_last_update)
+            VALUES (%s, %s, CURRENT_TIMESTAMP)
+            ON CONFLICT (job_watermarks_job_name) DO UPDATE
+            SET job_watermarks_last_run = EXCLUDED.job_watermarks_last_run,
+                job_watermarks_last_update = CURRENT_TIMESTAMP;
+        """, (job_name, watermark))
+    conn.commit()
+    logger.info(f"Marca d'água do job {job_name} atualizada para {watermark}.")
+
+# --- Seleção das faturas ---
+
+touched_invoice_ids_query = """
+    WITH changes AS (
+        SELECT table_name, record_id, COALESCE(new_values, old_values) AS row_values
+        FROM auditoria.transactions_audit_log
+        WHERE changed_at >= %(since)s
+          AND table_name IN ('creditcard_transactions', 'creditcard_installments')
+    ),
+    previous_versions AS (
+        SELECT touched.table_name, previous.row_values
+        FROM (SELECT DISTINCT table_name, record_id FROM changes) touched
+        CROSS JOIN LATERAL (
+            SELECT COALESCE(log.new_values, log.old_values) AS row_values
+            FROM auditoria.transactions_audit_log log
+            WHERE log.table_name = touched.table_name
+              AND log.record_id = touched.record_id
+              AND log.changed_at < %(since)s
+            ORDER BY log.changed_at DESC
+            LIMIT 1
+        ) previous
+    ),
+    versions AS (
+        SELECT table_name, row_values FROM changes
+        UNION ALL
+        SELECT table_name, row_values FROM previous_versions
+    )
+    SELECT row_values ->> 'creditcard_transactions_invoice_id'
+    FROM versions
+    WHERE table_name = 'creditcard_transactions'
+    UNION
+    SELECT row_values ->> 'creditcard_installments_invoice_id'
+    FROM versions
+    WHERE table_name = 'creditcard_installments'
+    UNION
+    SELECT ci.creditcard_installments_invoice_id
+    FROM transactions.creditcard_installments ci
+    WHERE ci.creditcard_installments_transaction_id IN (
+        SELECT record_id FROM changes WHERE table_name = 'creditcard_transactions'
+    );
+"""
+
+def fetch_touched_invoice_ids(conn, since: datetime) -> list:
+    """
+    Busca as faturas afetadas por alterações de transações e parcelas desde a marca d'água.
+
+    Usa o log de auditoria do schema transactions, que registra inclusões, alterações e
+    exclusões (inclusive em cascata) com a fatura de cada linha em new_values/old_values,
+    e lido nas partições mensais a partir de since. Alterações de status de uma transação
+    parcelada alcançam as faturas de todas as suas parcelas.
+
+    Como o UPDATE registra apenas os novos valores, a fatura de origem de uma linha movida
+    para outra fatura vem da última versão do registro anterior a since (uma consulta por
+    registro alterado, pelo índice de table_name, record_id e changed_at). Registros sem
+    histórico anterior no log ficam para o modo completo.
+    """
+    with conn.cursor() as cur:
+        cur.execute(touched_invoice_ids_query, {"since": since})
+        invoice_ids = sorted(row[0] for row in cur.fetchall() if row[0] is not None)
+    logger.info(f"{len(invoice_ids)} faturas afetadas desde {since} selecionadas para recálculo incremental.")
+    return invoice_ids
+
+def iter_invoice_id_batches(conn, batch_size: int, invoice_ids: list = None):
+    """
+    Gera lotes ordenados de IDs de faturas.
+
+    Sem lista de IDs, percorre transactions.creditcard_invoices com paginação por chave
+    (keyset) sobre creditcard_invoices_id. Com lista de IDs (modo incremental), devolve a
+    lista em fatias.
+    """
+    if invoice_ids is not None:
+        for start in range(0, len(invoice_ids), batch_size):
+            yield invoice_ids[start:start + batch_size]
+        return
+
+    last_invoice_id = ''
+    while True:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT creditcard_invoices_id
+                FROM transactions.creditcard_invoices
+                WHERE creditcard_invoices_id > %s
+                ORDER BY creditcard_invoices_id
+                LIMIT %s;
+            """, (last_invoice_id, batch_size))
+            batch_ids = [row[0] for row in cur.fetchall()]
+        # Encerra a transação de leitura para não mantê-la aberta durante o processamento
+        conn.rollback()
+        if not batch_ids:
+            return
+        last_invoice_id = batch_ids[-1]
+        yield batch_ids
+        if len(batch_ids) < batch_size:
+            return
+
+# --- Cálculo e gravação dos valores ---
+
+invoice_amounts_query = """
+    WITH transaction_totals AS (
+        SELECT
+            ct.creditcard_transactions_invoice_id AS invoice_id,
+            SUM(ct.creditcard_transactions_total_effective) AS total_effective
+        FROM transactions.creditcard_transactions ct
+        WHERE ct.creditcard_transactions_invoice_id = ANY(%(invoice_ids)s)
+          AND ct.creditcard_transactions_is_installment = FALSE
+          AND ct.creditcard_transactions_status = 'Efetuado'
+        GROUP BY ct.creditcard_transactions_invoice_id
+    ),
+    installment_totals AS (
+        SELECT
+            ci.creditcard_installments_invoice_id AS invoice_id,
+            -SUM(ci.creditcard_installments_base_value + ci.creditcard_installments_fees_taxes) AS total_effective
+        FROM transactions.creditcard_installments ci
+        JOIN transactions.creditcard_transactions ct
+          ON ct.creditcard_transactions_id = ci.creditcard_installments_transaction_id
+        WHERE ci.creditcard_installments_invoice_id = ANY(%(invoice_ids)s)
+          AND ct.creditcard_transactions_status = 'Efetuado'
+        GROUP BY ci.creditcard_installments_invoice_id
+    )
+    SELECT
+        inv.creditcard_invoices_id,
+        inv.creditcard_invoices_amount AS current_amount,
+        -(COALESCE(tt.total_effective, 0) + COALESCE(it.total_effective, 0)) AS computed_amount
+    FROM transactions.creditcard_invoices inv
+    LEFT JOIN transaction_totals tt ON tt.invoice_id = inv.creditcard_invoices_id
+    LEFT JOIN installment_totals it ON it.invoice_id = inv.creditcard_invoices_id
+    WHERE inv.creditcard_invoices_id = ANY(%(invoice_ids)s)
+      AND inv.creditcard_invoices_amount IS DISTINCT FROM
+          -(COALESCE(tt.total_effective, 0) + COALESCE(it.total_effective, 0));
+"""
+
+def fetch_changed_invoice_amounts(cursor, invoice_ids: list) -> list:
+    """
+    Calcula, em uma única consulta agregada, o valor de cada fatura do lote.
+
+    O valor da fatura é o total a pagar: o oposto da soma dos valores efetivos (negativos
+    para débito, positivos para crédito) das transações à vista efetivadas associadas à
+    fatura e das parcelas nela lançadas de transações parceladas efetivadas. Transações
+    parceladas entram apenas por suas parcelas. Retorna somente as faturas cujo valor
+    gravado difere do calculado.
+    """
+    if not invoice_ids:
+        return []
+    cursor.execute(invoice_amounts_query, {"invoice_ids": list(invoice_ids)})
+    return cursor.fetchall()
+
+def execute_invoice_amount_updates(cursor, amount_changes: list, now_brt: datetime) -> int:
+    """
+    Grava os valores recalculados do lote em um único UPDATE ... FROM (VALUES ...).
+    """
+    if not amount_changes:
+        return 0
+
+    update_query = """
+        UPDATE transactions.creditcard_invoices AS inv
+        SET
+            creditcard_invoices_amount = data.amount,
+            creditcard_invoices_last_update = data.last_updt
+        FROM (VALUES %s) AS data(invoice_id, amount, last_updt)
+        WHERE inv.creditcard_invoices_id = data.invoice_id;
+    """
+    values_to_update = [
+        (
+            change['creditcard_invoices_id'],
+            change['computed_amount'],
+            now_brt
+        ) for change in amount_changes
+    ]
+    try:
+        # page_size do tamanho do lote: uma única instrução UPDATE por lote
+        psycopg2.extras.execute_values(
+            cursor, update_query, values_to_update,
+            template="(%s, %s::numeric, %s::timestamp)",
+            page_size=len(values_to_update)
+        )
+        return cursor.rowcount
+    except psycopg2.Error as e:
+        logger.error(f"Erro na atualização em lote dos valores de faturas: {e}")
+        raise
+
+def process_invoice_batch(conn, invoice_ids: list, now_brt: datetime) -> int:
+    """Recalcula e grava os valores de um lote de faturas em uma transação."""
+    try:
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+            amount_changes = fetch_changed_invoice_amounts(cur, invoice_ids)
+            updated = execute_invoice_amount_updates(cur, amount_changes, now_brt)
+        conn.commit()
+        return updated
+    except Exception:
+        conn.rollback()
+        raise
+
+def run_invoice_amounts(conn, now_brt: datetime = None, mode: str = None) -> int:
+    """
+    Recalcula os valores das faturas na conexão informada e retorna quantas foram alteradas.
+
+    No modo incremental, apenas as faturas afetadas desde a marca d'água são recalculadas;
+    sem marca d'água, ou no modo full, todas as faturas são percorridas. Usada por main() e
+    pelo orquestrador.
+
+    Os valores são eventualmente consistentes: alterações commitadas durante a execução podem
+    não ser vistas por ela, mas a marca d'água salva (fetch_safe_watermark) não avança além
+    do início de nenhuma transação que ainda estava aberta, e a execução seguinte as recalcula.
+    """
+    if now_brt is None:
+        now_brt = datetime.now(db_timezone).replace(tzinfo=None)
+    if mode is None:
+        mode = amounts_mode
+    run_watermark = fetch_safe_watermark(conn)
+
+    watermark = fetch_job_watermark(conn, amounts_job_name) if mode == 'incremental' else None
+    if watermark is None:
+        logger.info(f"Modo de recálculo completo (modo configurado: {mode}).")
+        invoice_ids = None
+    else:
+        logger.info(f"Modo incremental a partir da marca d'água {watermark}.")
+        invoice_ids = fetch_touched_invoice_ids(conn, watermark)
+    conn.commit()
+
+    total_updated = 0
+    total_invoices = 0
+    for batch_number, batch_ids in enumerate(iter_invoice_id_batches(conn, amounts_batch_size, invoice_ids), 1):
+        updated = process_invoice_batch(conn, batch_ids, now_brt)
+        total_invoices += len(batch_ids)
+        total_updated += updated
+        logger.info(f"Lote {batch_number}: {len(batch_ids)} faturas recalculadas, {updated} valores atualizados.")
+
+    save_job_watermark(conn, amounts_job_name, run_watermark)
+    logger.info(f"Recálculo concluído: {total_invoices} faturas verificadas, {total_updated} valores atualizados.")
+    return total_updated
+
+# --- Execução principal ---
+
+def main():
+    """Função principal que executa o recálculo dos valores das faturas de cartão de crédito."""
+    parser = argparse.ArgumentParser(description="Cálculo dos valores das faturas de cartão de crédito.")
+    parser.add_argument("--mode", choices=["incremental", "full"], default=amounts_mode,
+                        help="incremental (faturas afetadas desde a última execução) ou full (todas as faturas).")
+    args = parser.parse_args()
+
+    logger.info("Iniciando script de cálculo de valores de faturas...")
+    conn = None
+    try:
+        conn = get_db_connection()
+        run_invoice_amounts(conn, mode=args.mode)
+
+    except psycopg2.Error as db_err:
+        logger.error(f"Erro de banco de dados durante a execução: {db_err}")
+        if conn:
+            conn.rollback()
+            logger.warning("Rollback da transação atual (se houver) realizado devido a erro de DB.")
+    except Exception as e:
+        logger.exception(f"Erro inesperado durante a execução do script: {e}")
+        if conn:
+            try:
+                conn.rollback()
+                logger.warning("Rollback da transação atual (se houver) realizado devido a erro inesperado.")
+            except psycopg2.Error as rb_err:
+                logger.error(f"Erro ao tentar realizar rollback: {rb_err}")
+    finally:
+        if conn:
+            conn.close()
+            logger.info("Conexão com o banco de dados fechada.")
+
+if __name__ == "__main__":
+    main()
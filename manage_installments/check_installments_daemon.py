@@ -0,0 +1,243 @@
+import os
+import sys
+import queue
+import signal
+import argparse
+import threading
+import subprocess
+import time
+import psycopg2.extras
+
+from manage_installments import (
+    logger,
+    get_db_connection,
+    allocate_ids
+)
+
+# --- Verificação do modo daemon contra um PostgreSQL local ---
+# Sobe manage_installments.py --daemon em um subprocesso, insere uma transação parcelada
+# sintética (em período distante, sem conflito com dados reais) e confere que as parcelas
+# são criadas pelo micro-lote disparado pela notificação. Em seguida exclui uma parcela e
+# confere que ela é recriada. Ao final, remove a transação e as faturas sintéticas.
+
+daemon_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "manage_installments.py")
+transaction_id_sequence = 'transactions.creditcard_transactions_id_seq'
+harness_statement_year = 2999
+harness_installment_count = 3
+harness_base_value = 100.00
+harness_fees_taxes = 0.05
+
+def fetch_harness_card(conn) -> dict:
+    """Busca um cartão ativo para receber a transação sintética."""
+    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        cur.execute("""
+            SELECT user_creditcards_id, user_creditcards_user_id
+            FROM core.user_creditcards
+            WHERE user_creditcards_status
+            ORDER BY user_creditcards_id
+            LIMIT 1;
+        """)
+        card = cur.fetchone()
+    conn.rollback()
+    return card
+
+def start_daemon() -> tuple:
+    """
+    Inicia o daemon em um subprocesso e retorna o processo e a fila com as linhas de log.
+
+    A drenagem periódica é adiada para que as parcelas só possam ser criadas pelo caminho
+    de notificação (micro-lote).
+    """
+    env = dict(os.environ, INSTALLMENT_DAEMON_POLL_SECONDS="3600", INSTALLMENT_DAEMON_COALESCE_SECONDS="0.1")
+    process = subprocess.Popen(
+        [sys.executable, "-u", daemon_script, "--daemon"],
+        stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True, env=env
+    )
+    log_lines = queue.Queue()
+
+    def read_log():
+        for line in process.stderr:
+            log_lines.put(line.rstrip())
+
+    threading.Thread(target=read_log, daemon=True).start()
+    return process, log_lines
+
+def wait_for_log(log_lines: queue.Queue, markers: tuple, timeout: float, seen: list) -> bool:
+    """Aguarda uma linha de log do daemon contendo algum dos marcadores."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            line = log_lines.get(timeout=0.2)
+        except queue.Empty:
+            continue
+        seen.append(line)
+        if any(marker in line for marker in markers):
+            return True
+    return False
+
+def insert_harness_transaction(conn, card: dict, category_id: str, operator_id: str) -> str:
+    """Insere e commita a transação parcelada sintética; retorna seu ID."""
+    with conn.cursor() as cur:
+        transaction_id = allocate_ids(
+            cur, transaction_id_sequence, 'transactions.creditcard_transactions', 'creditcard_transactions_id', 'T', 1
+        )[0]
+        cur.execute("""
+            INSERT INTO transactions.creditcard_transactions (
+                creditcard_transactions_id,
+                creditcard_transactions_user_id,
+                creditcard_transactions_user_card_id,
+                creditcard_transactions_procedure,
+                creditcard_transactions_status,
+                creditcard_transactions_category_id,
+                creditcard_transactions_operator_id,
+                creditcard_transactions_description,
+                creditcard_transactions_implementation_datetime,
+                creditcard_transactions_statement_month,
+                creditcard_transactions_statement_year,
+                creditcard_transactions_is_installment,
+                creditcard_transactions_installment_count,
+                creditcard_transactions_base_value,
+                creditcard_transactions_fees_taxes
+            ) VALUES (
+                %s, %s, %s, 'Débito em Fatura', 'Efetuado', %s, %s, 'Verificação do modo daemon',
+                CURRENT_TIMESTAMP, 'Janeiro', %s, TRUE, %s, %s, %s
+            );
+        """, (
+            transaction_id, card['user_creditcards_user_id'], card['user_creditcards_id'], category_id, operator_id,
+            harness_statement_year, harness_installment_count, harness_base_value, harness_fees_taxes
+        ))
+    conn.commit()
+    return transaction_id
+
+def fetch_installment_summary(conn, transaction_id: str) -> tuple:
+    """Retorna a quantidade de parcelas, a soma dos valores e se a transação ainda está na fila."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT
+                COUNT(*),
+                COALESCE(SUM(creditcard_installments_base_value + creditcard_installments_fees_taxes), 0),
+                EXISTS (
+                    SELECT 1 FROM transactions.creditcard_installments_queue
+                    WHERE creditcard_installments_queue_transaction_id = %(id)s
+                )
+            FROM transactions.creditcard_installments
+            WHERE creditcard_installments_transaction_id = %(id)s;
+        """, {"id": transaction_id})
+        summary = cur.fetchone()
+    conn.rollback()
+    return summary
+
+def wait_for_installments(conn, transaction_id: str, timeout: float) -> tuple:
+    """Aguarda até que todas as parcelas existam e a transação saia da fila."""
+    deadline = time.time() + timeout
+    summary = fetch_installment_summary(conn, transaction_id)
+    while time.time() < deadline:
+        if summary[0] == harness_installment_count and not summary[2]:
+            break
+        time.sleep(0.1)
+        summary = fetch_installment_summary(conn, transaction_id)
+    return summary
+
+def check_summary(check_name: str, summary: tuple, elapsed: float, failures: list):
+    """Confere quantidade e soma das parcelas e registra o resultado."""
+    count, total, queued = summary
+    expected_total = round(harness_base_value + harness_fees_taxes, 2)
+    if count == harness_installment_count and round(float(total), 2) == expected_total and not queued:
+        logger.info(f"OK - {check_name}: {count} parcelas somando {total} em {elapsed:.2f}s.")
+    else:
+        logger.error(f"FALHA - {check_name}: {count} parcelas somando {total} (esperado "
+                     f"{harness_installment_count} somando {expected_total}); na fila: {queued}.")
+        failures.append(check_name)
+
+def cleanup_harness_rows(conn, transaction_id: str, card_id: str):
+    """Remove a transação sintética (com parcelas e fila) e as faturas criadas para ela."""
+    with conn.cursor() as cur:
+        if transaction_id:
+            cur.execute("DELETE FROM transactions.creditcard_transactions WHERE creditcard_transactions_id = %s;",
+                        (transaction_id,))
+        cur.execute("""
+            DELETE FROM transactions.creditcard_invoices inv
+            WHERE inv.creditcard_invoices_user_creditcard_id = %s
+              AND inv.creditcard_invoices_statement_period LIKE %s
+              AND NOT EXISTS (
+                  SELECT 1 FROM transactions.creditcard_installments ci
+                  WHERE ci.creditcard_installments_invoice_id = inv.creditcard_invoices_id
+              )
+              AND NOT EXISTS (
+                  SELECT 1 FROM transactions.creditcard_transactions ct
+                  WHERE ct.creditcard_transactions_invoice_id = inv.creditcard_invoices_id
+              );
+        """, (card_id, f"{harness_statement_year}-%"))
+        logger.info(f"Limpeza: {cur.rowcount} faturas sintéticas removidas.")
+    conn.commit()
+
+def main():
+    """Verifica, contra um PostgreSQL local, a criação de parcelas pelo modo daemon."""
+    parser = argparse.ArgumentParser(description="Verificação do modo daemon de manage_installments.")
+    parser.add_argument("--timeout", type=float, default=30, help="Segundos de espera por etapa.")
+    parser.add_argument("--category-id", default=None, help="Categoria da transação sintética (se obrigatória).")
+    parser.add_argument("--operator-id", default=None, help="Operador da transação sintética (se obrigatório).")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    card = fetch_harness_card(conn)
+    if card is None:
+        logger.error("Nenhum cartão ativo encontrado para a verificação.")
+        conn.close()
+        sys.exit(1)
+
+    failures = []
+    transaction_id = None
+    daemon, log_lines = start_daemon()
+    daemon_log = []
+    try:
+        ready = wait_for_log(log_lines, ("Nenhuma transação parcelada pendente", "Processamento concluído"),
+                             args.timeout, daemon_log)
+        if not ready:
+            raise RuntimeError("O daemon não concluiu a drenagem inicial da fila.")
+
+        # 1) Nova transação parcelada: parcelas criadas pelo micro-lote da notificação
+        t0 = time.time()
+        transaction_id = insert_harness_transaction(conn, card, args.category_id, args.operator_id)
+        summary = wait_for_installments(conn, transaction_id, args.timeout)
+        check_summary("transação parcelada inserida", summary, time.time() - t0, failures)
+
+        # 2) Parcela excluída: a trigger reenfileira a transação e o daemon recria a parcela
+        with conn.cursor() as cur:
+            cur.execute("""
+                DELETE FROM transactions.creditcard_installments
+                WHERE creditcard_installments_transaction_id = %s
+                  AND creditcard_installments_number = 2;
+            """, (transaction_id,))
+        conn.commit()
+        t0 = time.time()
+        summary = wait_for_installments(conn, transaction_id, args.timeout)
+        check_summary("parcela excluída recriada", summary, time.time() - t0, failures)
+    except Exception as e:
+        logger.error(f"FALHA - verificação interrompida: {e}")
+        failures.append("execução")
+        conn.rollback()
+    finally:
+        daemon.send_signal(signal.SIGTERM)
+        try:
+            daemon.wait(timeout=args.timeout)
+        except subprocess.TimeoutExpired:
+            daemon.kill()
+        wait_for_log(log_lines, ("modo daemon encerrado",), 1, daemon_log)
+        cleanup_harness_rows(conn, transaction_id, card['user_creditcards_id'])
+        conn.close()
+        logger.info("Conexão com o banco de dados fechada.")
+
+    micro_batches = sum("Micro-lote concluído" in line for line in daemon_log)
+    if micro_batches < 2:
+        logger.error(f"FALHA - esperados ao menos 2 micro-lotes no log do daemon, encontrados {micro_batches}.")
+        failures.append("micro-lotes")
+    if failures:
+        for line in daemon_log:
+            logger.info(f"[daemon] {line}")
+        logger.error(f"{len(failures)} verificação(ões) do modo daemon falharam.")
+        sys.exit(1)
+    logger.info("Modo daemon verificado: parcelas criadas e recriadas pelos micro-lotes notificados.")
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,29 @@
 import os
+import sys
 import psycopg2
 import psycopg2.extras
-import random
 import logging
-import math
 from datetime import datetime, date
+from decimal import Decimal
 from dateutil.relativedelta import relativedelta
 import pytz
 from dotenv import load_dotenv
 import time
+import threading
+from collections import OrderedDict
+import argparse
+import select
+import signal
+
+# Código compartilhado entre os scripts de automação (pasta shared)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "shared"))
+from job_common import (
+    BusinessDayCalendar,
+    prepare_business_calendar,
+    calculate_invoice_dates,
+    AdaptiveBatchSizer,
+    allocate_ids
+)
 
 # --- Configuração de logging ---
 logging.basicConfig(
@@ -26,6 +41,17 @@ db_password = os.getenv("DB_PASSWORD")
 db_host = os.getenv("DB_HOST", "localhost")
 db_port = os.getenv("DB_PORT", "5432")
 
+installment_batch_target_seconds = float(os.getenv("INSTALLMENT_BATCH_TARGET_SECONDS", "10"))
+installment_batch_max_rows = int(os.getenv("INSTALLMENT_BATCH_MAX_ROWS", "100000"))
+installment_invoice_cache_cards = int(os.getenv("INSTALLMENT_INVOICE_CACHE_CARDS", "5000"))
+installment_daemon_coalesce_seconds = float(os.getenv("INSTALLMENT_DAEMON_COALESCE_SECONDS", "0.25"))
+installment_daemon_poll_seconds = float(os.getenv("INSTALLMENT_DAEMON_POLL_SECONDS", "60"))
+installment_daemon_max_batch = int(os.getenv("INSTALLMENT_DAEMON_MAX_BATCH", "1000"))
+installment_calendar_months = int(os.getenv("INSTALLMENT_CALENDAR_MONTHS", "24"))
+installments_notify_channel = 'creditcard_installments_queue'
+installment_id_sequence = 'transactions.creditcard_installments_id_seq'
+invoice_id_sequence = 'transactions.creditcard_invoices_id_seq'
+
 db_timezone_str = 'America/Sao_Paulo'
 db_timezone = pytz.timezone(db_timezone_str)
 
@@ -49,14 +75,23 @@ def get_db_connection() -> psycopg2.extensions.connection:
 
 # --- Utilitários ---
 
-def generate_installment_id() -> str:
-    """Gera um ID único no formato NNN-NNN-NNN-NNN-NNN-P."""
-    parts = [f"{random.randint(0, 999):03d}" for _ in range(5)]
-    return "-".join(parts) + "-P"
+def invoice_status_for_dates(dates: dict, today: date) -> str:
+    """
+    Situação inicial de uma fatura criada sob demanda, derivada das suas datas.
+    
+    Faturas do período corrente em diante nascem 'Aberta', como em manage_invoices.py;
+    períodos já fechados nascem 'Fechada' e, com o vencimento passado sem pagamento,
+    'Vencida'.
+    """
+    if today <= dates["closing"]:
+        return 'Aberta'
+    if today <= dates["due"]:
+        return 'Fechada'
+    return 'Vencida'
 
 def calculate_batch_size(total_transactions: int) -> int:
     """
-    Calcula o tamanho do lote como 5% do total, respeitando mínimo de 100 e máximo de 1000.
+    Calcula o tamanho inicial do lote como 5% do total, respeitando mínimo de 100 e máximo de 1000.
     
     Um tamanho adequado de lote equilibra a eficiência de operações em massa com a pressão
     sobre o banco de dados e a memória.
@@ -75,250 +110,260 @@ def get_month_enum_from_date(target_date: date) -> str:
     }
     return month_names[target_date.month]
 
+def to_cents(value) -> int:
+    """Converte um valor monetário (Decimal, int ou float) em centavos inteiros."""
+    return int((Decimal(str(value)) * 100).to_integral_value())
+
 def distribute_value(total_value, n_installments):
     """
     Distribui um valor em n parcelas iguais sem erros de arredondamento.
     
     Implementa uma distribuição de valores que garante:
-    1. Todas as parcelas exceto a última têm o mesmo valor (arredondado para 2 casas decimais)
+    1. Todas as parcelas exceto a última têm o mesmo valor (total/n arredondado para 2 casas
+       decimais, meio-para-par, como o round() de Decimal)
     2. A última parcela compensa qualquer diferença de arredondamento
     3. A soma exata de todas as parcelas é igual ao valor total original
+    
+    Toda a aritmética é feita em centavos inteiros, sem float.
+    
+    :param total_value: Total (Decimal de colunas numeric(15,2), int ou float)
+    :param n_installments: Quantidade de parcelas (1 a 420)
+    :return: Lista com os valores (Decimal) das parcelas
     """
+    cent = Decimal('0.01')
     if n_installments <= 0:
         return []
     
+    total_cents = to_cents(total_value)
     if n_installments == 1:
-        return [total_value]
-        
-    # Valor por parcela com precisão alta para cálculos intermediários
-    base_value = total_value / n_installments
+        return [Decimal(total_cents) * cent]
     
-    # Arredondar para 2 casas decimais para as n-1 primeiras parcelas
-    parcels = [round(base_value, 2) for _ in range(n_installments - 1)]
+    # Divisão inteira com arredondamento meio-para-par, simétrica para valores negativos
+    quotient, remainder = divmod(abs(total_cents), n_installments)
+    if remainder * 2 > n_installments or (remainder * 2 == n_installments and quotient % 2 == 1):
+        quotient += 1
+    parcel_cents = quotient if total_cents >= 0 else -quotient
+    last_cents = total_cents - parcel_cents * (n_installments - 1)
     
-    # Calcular o valor da última parcela para compensar diferenças de arredondamento
-    last_parcel = round(total_value - sum(parcels), 2)
-    parcels.append(last_parcel)
-    
-    # Verificação de garantia (a soma deve ser exatamente igual ao total)
-    assert abs(sum(parcels) - total_value) < 0.0001, "Erro na distribuição de valores"
+    return [Decimal(parcel_cents) * cent] * (n_installments - 1) + [Decimal(last_cents) * cent]
+
+def calculate_batch_distributions(transactions: list) -> dict:
+    """
+    Calcula as distribuições de valor e de taxas das transações do lote.
     
-    return parcels
+    Retorna um dicionário {transaction_id: (valores_base, valores_taxas)}. Taxas zeradas
+    ou negativas não são distribuídas (todas as parcelas ficam com taxa 0).
+    """
+    distributions = {}
+    for tx in transactions:
+        count = tx['creditcard_transactions_installment_count']
+        fees = tx['creditcard_transactions_fees_taxes'] if tx['creditcard_transactions_fees_taxes'] > 0 else 0
+        distributions[tx['creditcard_transactions_id']] = (
+            distribute_value(tx['creditcard_transactions_base_value'], count),
+            distribute_value(fees, count)
+        )
+    return distributions
 
-def needs_installment_update(conn, transaction_id, total_value, total_fees) -> bool:
+def installment_update_required(
+    transaction_id,
+    expected_count: int,
+    parcelas_count: int,
+    soma_base,
+    soma_taxas,
+    has_update_alert: bool,
+    total_value,
+    total_fees
+) -> bool:
     """
-    Verifica se as parcelas de uma transação precisam ser atualizadas baseado no valor total.
+    Decide se as parcelas de uma transação precisam ser criadas ou atualizadas.
     
     Retorna True se:
     1. Não existirem parcelas para a transação
-    2. A soma das parcelas existentes for diferente do valor total da transação
+    2. O número de parcelas existentes for menor que o esperado
+    3. A soma das parcelas existentes for diferente do valor total da transação
        E pelo menos uma parcela tem creditcard_installments_update_alert = TRUE
     
-    Não faz a verificação ou atualização se todas as parcelas tiverem 
+    Não faz a verificação de valores se todas as parcelas tiverem 
     creditcard_installments_update_alert = FALSE.
     """
-    query_check_alert = """
-        SELECT 
-            COUNT(*) > 0 as has_update_alert
-        FROM transactions.creditcard_installments
-        WHERE creditcard_installments_transaction_id = %s
-          AND creditcard_installments_update_alert = TRUE
-    """
+    # Se não existem parcelas, precisa criar
+    if parcelas_count == 0:
+        return True
     
-    query_installments = """
-        SELECT 
-            COUNT(*) as parcelas_count,
-            COALESCE(SUM(creditcard_installments_base_value), 0) as soma_base,
-            COALESCE(SUM(creditcard_installments_fees_taxes), 0) as soma_taxas
-        FROM transactions.creditcard_installments
-        WHERE creditcard_installments_transaction_id = %s
-    """
+    # Se o número de parcelas é insuficiente, precisa completar
+    if parcelas_count < expected_count:
+        return True
+    
+    # Se nenhuma parcela tem update_alert = TRUE, não fazer atualização
+    if not has_update_alert:
+        return False
+    
+    # Calcular o total efetivo para comparação (sem levar em conta o sinal)
+    total_effective = abs(total_value + total_fees)
+    sum_effective = abs(soma_base + soma_taxas)
     
-    query_total_count = """
-        SELECT creditcard_transactions_installment_count
-        FROM transactions.creditcard_transactions
-        WHERE creditcard_transactions_id = %s
+    # Verificar diferença entre valor total e soma das parcelas
+    value_difference = abs(total_effective - sum_effective)
+    
+    # Margem de tolerância para erros de arredondamento (1 centavo por parcela)
+    tolerance = 0.01 * parcelas_count
+    
+    # Se a diferença for maior que a tolerância, precisa atualizar
+    if value_difference > tolerance:
+        logger.info(f"Transação {transaction_id} precisa de atualização. " 
+                   f"Diferença de valor: {value_difference}, parcela(s) com update_alert=TRUE")
+        return True
+    
+    return False
+
+# --- Operações com o banco de dados ---
+
+pending_installments_predicate = """
+    ct.creditcard_transactions_is_installment = TRUE
+    AND ct.creditcard_transactions_status = 'Efetuado'
+    AND (
+        -- Transações que não têm parcelas ou têm número insuficiente
+        NOT EXISTS (
+            SELECT 1 
+            FROM transactions.creditcard_installments ci
+            WHERE ci.creditcard_installments_transaction_id = ct.creditcard_transactions_id
+            GROUP BY ci.creditcard_installments_transaction_id
+            HAVING COUNT(*) = ct.creditcard_transactions_installment_count
+        )
+        OR 
+        -- Transações que têm diferença de valor entre a soma das parcelas e o valor total
+        -- E pelo menos uma parcela com update_alert = TRUE
+        EXISTS (
+            SELECT 1
+            FROM (
+                SELECT 
+                    COUNT(*) as parcelas_count,
+                    COALESCE(SUM(ci.creditcard_installments_base_value), 0) as soma_base,
+                    COALESCE(SUM(ci.creditcard_installments_fees_taxes), 0) as soma_taxas
+                FROM transactions.creditcard_installments ci
+                WHERE ci.creditcard_installments_transaction_id = ct.creditcard_transactions_id
+                GROUP BY ci.creditcard_installments_transaction_id
+            ) as sums
+            WHERE 
+                sums.parcelas_count = ct.creditcard_transactions_installment_count
+                AND (
+                    ABS(sums.soma_base + sums.soma_taxas - ABS(ct.creditcard_transactions_total_effective)) > (0.01 * sums.parcelas_count)
+                )
+        )
+        AND EXISTS (
+            SELECT 1 
+            FROM transactions.creditcard_installments ci
+            WHERE ci.creditcard_installments_transaction_id = ct.creditcard_transactions_id
+              AND ci.creditcard_installments_update_alert = TRUE
+        )
+    )
+"""
+
+def enable_installments_queue_bypass(conn):
     """
+    Marca a transação atual como escritora do script de parcelamentos.
     
+    As triggers de enfileiramento ignoram as escritas desta transação, evitando que as
+    parcelas criadas pelo próprio script recoloquem a transação na fila. A marcação equivale
+    a SET LOCAL e termina no commit ou rollback do lote, de modo que outras escritas na mesma
+    conexão (ex.: demais etapas do orquestrador) continuam enfileirando normalmente.
+    """
     with conn.cursor() as cur:
-        # Verificar transação
-        cur.execute(query_total_count, (transaction_id,))
-        total_count_result = cur.fetchone()
-        if total_count_result is None:
-            # Transação não encontrada
-            logger.warning(f"Transação {transaction_id} não encontrada ao verificar necessidade de atualização.")
-            return False
-        
-        total_expected_count = total_count_result[0]
-        
-        # Verificar parcelas existentes
-        cur.execute(query_installments, (transaction_id,))
-        result = cur.fetchone()
-        parcelas_count, soma_base, soma_taxas = result
-        
-        # Se não existem parcelas, precisa criar
-        if parcelas_count == 0:
-            return True
-        
-        # Se o número de parcelas é insuficiente, precisa completar
-        if parcelas_count < total_expected_count:
-            return True
-        
-        # Verificar se há pelo menos uma parcela com update_alert = TRUE
-        cur.execute(query_check_alert, (transaction_id,))
-        has_update_alert = cur.fetchone()[0]
-        
-        # Se nenhuma parcela tem update_alert = TRUE, não fazer atualização
-        if not has_update_alert:
-            return False
-        
-        # Calcular o total efetivo para comparação (sem levar em conta o sinal)
-        total_effective = abs(total_value + total_fees)
-        sum_effective = abs(soma_base + soma_taxas)
-        
-        # Verificar diferença entre valor total e soma das parcelas
-        value_difference = abs(total_effective - sum_effective)
-        
-        # Margem de tolerância para erros de arredondamento (1 centavo por parcela)
-        tolerance = 0.01 * parcelas_count
-        
-        # Se a diferença for maior que a tolerância, precisa atualizar
-        if value_difference > tolerance:
-            logger.info(f"Transação {transaction_id} precisa de atualização. " 
-                       f"Diferença de valor: {value_difference}, parcela(s) com update_alert=TRUE")
-            return True
-        
-        return False
+        cur.execute("SELECT set_config('sisfinance.installments_queue_bypass', 'on', true);")
 
-# --- Operações com o banco de dados ---
+def count_queued_transactions(conn) -> int:
+    """Conta as transações presentes na fila de trabalho de parcelamentos."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM transactions.creditcard_installments_queue;")
+        count = cur.fetchone()[0]
+    conn.commit()
+    logger.info(f"Total de {count} transações na fila de parcelamentos.")
+    return count
+
+queued_transactions_select = f"""
+    SELECT 
+        ct.creditcard_transactions_id,
+        ct.creditcard_transactions_user_id,
+        ct.creditcard_transactions_user_card_id,
+        ct.creditcard_transactions_implementation_datetime,
+        ct.creditcard_transactions_statement_month,
+        ct.creditcard_transactions_statement_year,
+        ct.creditcard_transactions_installment_count,
+        ct.creditcard_transactions_base_value,
+        ct.creditcard_transactions_fees_taxes,
+        ct.creditcard_transactions_description,
+        uc.user_creditcards_due_day,
+        uc.user_creditcards_closing_day,
+        ({pending_installments_predicate}) AS is_pending
+    FROM transactions.creditcard_installments_queue q
+    JOIN transactions.creditcard_transactions ct ON ct.creditcard_transactions_id = q.creditcard_installments_queue_transaction_id
+    JOIN core.user_creditcards uc ON ct.creditcard_transactions_user_card_id = uc.user_creditcards_id
+"""
+
+unprocessed_transactions_query = queued_transactions_select + """
+    WHERE NOT (q.creditcard_installments_queue_transaction_id = ANY(%s))
+    ORDER BY q.creditcard_installments_queue_enqueued_at, q.creditcard_installments_queue_transaction_id
+    LIMIT %s
+    FOR UPDATE OF q SKIP LOCKED
+"""
 
-def fetch_unprocessed_installment_transactions(conn, batch_start: int, batch_size: int) -> list:
+notified_transactions_query = queued_transactions_select + """
+    WHERE q.creditcard_installments_queue_transaction_id = ANY(%s)
+    ORDER BY q.creditcard_installments_queue_enqueued_at, q.creditcard_installments_queue_transaction_id
+    FOR UPDATE OF q SKIP LOCKED
+"""
+
+def fetch_unprocessed_installment_transactions(conn, retained_ids: list, batch_size: int) -> list:
     """
-    Busca transações de cartão de crédito parceladas que precisam ter parcelas processadas.
+    Retira o próximo lote de transações da fila de trabalho de parcelamentos.
     
-    Utiliza paginação (OFFSET/LIMIT) para processar em lotes, reduzindo o pico de memória
-    e permitindo paralelização em sistemas distribuídos.
+    As linhas da fila são bloqueadas com FOR UPDATE SKIP LOCKED até o commit do lote, de modo
+    que execuções concorrentes consomem lotes disjuntos. A regra de pendência é avaliada
+    apenas para as transações do lote (coluna is_pending). Transações mantidas na fila
+    nesta execução (retained_ids) não são buscadas novamente.
     """
-    query = """
-        SELECT 
-            ct.creditcard_transactions_id,
-            ct.creditcard_transactions_user_id,
-            ct.creditcard_transactions_user_card_id,
-            ct.creditcard_transactions_implementation_datetime,
-            ct.creditcard_transactions_statement_month,
-            ct.creditcard_transactions_statement_year,
-            ct.creditcard_transactions_installment_count,
-            ct.creditcard_transactions_base_value,
-            ct.creditcard_transactions_fees_taxes,
-            ct.creditcard_transactions_description,
-            uc.user_creditcards_due_day,
-            uc.user_creditcards_closing_day
-        FROM transactions.creditcard_transactions ct
-        JOIN core.user_creditcards uc ON ct.creditcard_transactions_user_card_id = uc.user_creditcards_id
-        WHERE ct.creditcard_transactions_is_installment = TRUE
-          AND ct.creditcard_transactions_status = 'Efetuado'
-          AND (
-              -- Transações que não têm parcelas ou têm número insuficiente
-              NOT EXISTS (
-                  SELECT 1 
-                  FROM transactions.creditcard_installments ci
-                  WHERE ci.creditcard_installments_transaction_id = ct.creditcard_transactions_id
-                  GROUP BY ci.creditcard_installments_transaction_id
-                  HAVING COUNT(*) = ct.creditcard_transactions_installment_count
-              )
-              OR 
-              -- Transações que têm diferença de valor entre a soma das parcelas e o valor total
-              -- E pelo menos uma parcela com update_alert = TRUE
-              EXISTS (
-                  SELECT 1
-                  FROM (
-                      SELECT 
-                          COUNT(*) as parcelas_count,
-                          COALESCE(SUM(ci.creditcard_installments_base_value), 0) as soma_base,
-                          COALESCE(SUM(ci.creditcard_installments_fees_taxes), 0) as soma_taxas
-                      FROM transactions.creditcard_installments ci
-                      WHERE ci.creditcard_installments_transaction_id = ct.creditcard_transactions_id
-                      GROUP BY ci.creditcard_installments_transaction_id
-                  ) as sums
-                  WHERE 
-                      sums.parcelas_count = ct.creditcard_transactions_installment_count
-                      AND (
-                          ABS(sums.soma_base + sums.soma_taxas - ABS(ct.creditcard_transactions_total_effective)) > (0.01 * sums.parcelas_count)
-                      )
-              )
-              AND EXISTS (
-                  SELECT 1 
-                  FROM transactions.creditcard_installments ci
-                  WHERE ci.creditcard_installments_transaction_id = ct.creditcard_transactions_id
-                    AND ci.creditcard_installments_update_alert = TRUE
-              )
-          )
-        ORDER BY ct.creditcard_transactions_implementation_datetime
-        OFFSET %s
-        LIMIT %s
+    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        cur.execute(unprocessed_transactions_query, (retained_ids, batch_size))
+        rows = cur.fetchall()
+        logger.info(f"Retiradas {len(rows)} transações da fila de parcelamentos (limit: {batch_size}).")
+        return rows
+
+def fetch_notified_installment_transactions(conn, transaction_ids: list) -> list:
     """
+    Retira da fila de parcelamentos apenas as transações informadas (micro-lote do daemon).
     
+    Mesmo bloqueio de fetch_unprocessed_installment_transactions: transações que já saíram
+    da fila ou estão bloqueadas por outra execução são ignoradas.
+    """
     with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-        cur.execute(query, (batch_start, batch_size))
+        cur.execute(notified_transactions_query, (transaction_ids,))
         rows = cur.fetchall()
-        logger.info(f"Buscados {len(rows)} transações parceladas para processamento no lote (offset: {batch_start}, limit: {batch_size}).")
+        logger.info(f"Retiradas {len(rows)} de {len(transaction_ids)} transações notificadas da fila de parcelamentos.")
         return rows
 
-def count_total_unprocessed_transactions(conn) -> int:
+def acknowledge_queued_transactions(conn, transaction_ids: list) -> set:
     """
-    Conta o total de transações parceladas pendentes para definir parâmetros de lote.
+    Remove da fila as transações do lote que deixaram de estar pendentes.
     
-    Separa a contagem da busca de dados para evitar múltiplas contagens durante
-    o processamento em lotes.
+    A regra de pendência é reavaliada após as escritas do lote; transações ainda pendentes
+    (ex.: parcelas sem fatura correspondente) permanecem na fila para a próxima execução.
+    Retorna o conjunto de IDs removidos.
     """
-    query = """
-        SELECT COUNT(*) 
-        FROM transactions.creditcard_transactions ct
-        WHERE ct.creditcard_transactions_is_installment = TRUE
-          AND ct.creditcard_transactions_status = 'Efetuado'
-          AND (
-              -- Transações que não têm parcelas ou têm número insuficiente
-              NOT EXISTS (
-                  SELECT 1 
-                  FROM transactions.creditcard_installments ci
-                  WHERE ci.creditcard_installments_transaction_id = ct.creditcard_transactions_id
-                  GROUP BY ci.creditcard_installments_transaction_id
-                  HAVING COUNT(*) = ct.creditcard_transactions_installment_count
-              )
-              OR 
-              -- Transações que têm diferença de valor entre a soma das parcelas e o valor total
-              -- E pelo menos uma parcela com update_alert = TRUE
-              EXISTS (
-                  SELECT 1
-                  FROM (
-                      SELECT 
-                          COUNT(*) as parcelas_count,
-                          COALESCE(SUM(ci.creditcard_installments_base_value), 0) as soma_base,
-                          COALESCE(SUM(ci.creditcard_installments_fees_taxes), 0) as soma_taxas
-                      FROM transactions.creditcard_installments ci
-                      WHERE ci.creditcard_installments_transaction_id = ct.creditcard_transactions_id
-                      GROUP BY ci.creditcard_installments_transaction_id
-                  ) as sums
-                  WHERE 
-                      sums.parcelas_count = ct.creditcard_transactions_installment_count
-                      AND (
-                          ABS(sums.soma_base + sums.soma_taxas - ABS(ct.creditcard_transactions_total_effective)) > (0.01 * sums.parcelas_count)
-                      )
-              )
-              AND EXISTS (
-                  SELECT 1 
-                  FROM transactions.creditcard_installments ci
-                  WHERE ci.creditcard_installments_transaction_id = ct.creditcard_transactions_id
-                    AND ci.creditcard_installments_update_alert = TRUE
-              )
-          )
+    if not transaction_ids:
+        return set()
+    
+    query = f"""
+        DELETE FROM transactions.creditcard_installments_queue q
+        USING transactions.creditcard_transactions ct
+        WHERE q.creditcard_installments_queue_transaction_id = ANY(%s)
+          AND ct.creditcard_transactions_id = q.creditcard_installments_queue_transaction_id
+          AND NOT ({pending_installments_predicate})
+        RETURNING q.creditcard_installments_queue_transaction_id
     """
     
     with conn.cursor() as cur:
-        cur.execute(query)
-        count = cur.fetchone()[0]
-        logger.info(f"Total de {count} transações parceladas pendentes de processamento.")
-        return count
+        cur.execute(query, (transaction_ids,))
+        return {row[0] for row in cur.fetchall()}
 
 def fetch_existing_installments(conn, transaction_ids: list) -> dict:
     """
@@ -353,62 +398,364 @@ def fetch_existing_installments(conn, transaction_ids: list) -> dict:
         logger.info(f"Encontradas {sum(len(v) for v in existing_installments.values())} parcelas existentes para o lote atual.")
         return existing_installments
 
-def find_or_create_invoices(conn, installment_periods: dict) -> dict:
+transactions_needing_update_query = """
+    SELECT 
+        ct.creditcard_transactions_id,
+        ct.creditcard_transactions_installment_count,
+        COUNT(ci.creditcard_installments_id) as parcelas_count,
+        COALESCE(SUM(ci.creditcard_installments_base_value), 0) as soma_base,
+        COALESCE(SUM(ci.creditcard_installments_fees_taxes), 0) as soma_taxas,
+        COALESCE(BOOL_OR(ci.creditcard_installments_update_alert), FALSE) as has_update_alert
+    FROM transactions.creditcard_transactions ct
+    LEFT JOIN transactions.creditcard_installments ci
+           ON ci.creditcard_installments_transaction_id = ct.creditcard_transactions_id
+    WHERE ct.creditcard_transactions_id = ANY(%s)
+    GROUP BY ct.creditcard_transactions_id, ct.creditcard_transactions_installment_count
+"""
+
+def fetch_transactions_needing_update(conn, batch_transactions: list) -> set:
+    """
+    Avalia em lote quais transações precisam ter parcelas criadas ou atualizadas.
+    
+    Uma única consulta agrupada traz, para todas as transações do lote, o número esperado de
+    parcelas, a contagem e as somas das parcelas existentes e o estado de update_alert. A
+    decisão é tomada em memória por installment_update_required, com as mesmas regras e
+    tolerâncias da verificação individual.
+    """
+    if not batch_transactions:
+        return set()
+    
+    transaction_ids = [tx['creditcard_transactions_id'] for tx in batch_transactions]
+    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        cur.execute(transactions_needing_update_query, (transaction_ids,))
+        summaries = {row['creditcard_transactions_id']: row for row in cur.fetchall()}
+    
+    needing_update = set()
+    for tx in batch_transactions:
+        transaction_id = tx['creditcard_transactions_id']
+        summary = summaries.get(transaction_id)
+        if summary is None:
+            # Transação não encontrada
+            logger.warning(f"Transação {transaction_id} não encontrada ao verificar necessidade de atualização.")
+            continue
+        
+        if installment_update_required(
+            transaction_id,
+            summary['creditcard_transactions_installment_count'],
+            summary['parcelas_count'],
+            summary['soma_base'],
+            summary['soma_taxas'],
+            summary['has_update_alert'],
+            tx['creditcard_transactions_base_value'],
+            tx['creditcard_transactions_fees_taxes']
+        ):
+            needing_update.add(transaction_id)
+    
+    logger.info(f"{len(needing_update)} de {len(batch_transactions)} transações do lote precisam de parcelas.")
+    return needing_update
+
+card_invoices_query = """
+    SELECT 
+        creditcard_invoices_user_creditcard_id, 
+        creditcard_invoices_statement_period,
+        creditcard_invoices_id
+    FROM transactions.creditcard_invoices
+    WHERE creditcard_invoices_user_creditcard_id = ANY(%s)
+    ORDER BY creditcard_invoices_user_creditcard_id, creditcard_invoices_statement_period
+"""
+
+class CardInvoiceCache:
+    """
+    Cache LRU, limitado por número de cartões, das faturas de cada cartão na execução.
+    
+    Como as transações chegam ordenadas por data e não por cartão, o mesmo cartão aparece
+    em vários lotes. Na primeira falta, todo o horizonte de faturas do cartão é carregado
+    em uma única consulta por intervalo; os lotes seguintes resolvem os períodos em memória.
+    Entradas devem ser invalidadas (invalidate) sempre que faturas do cartão forem gravadas.
+    
+    Um cartão também pode ser semeado com as faturas de uma janela de períodos já conhecida
+    (seed_window, usado pelo orquestrador com o estado da etapa de faturas); períodos fora
+    da janela provocam a carga completa do cartão.
+    """
+
+    def __init__(self, max_cards: int):
+        self.max_cards = max_cards
+        # card_id -> (faturas {(ano, mês): invoice_id}, janela (início, fim) ou None se completo)
+        self._cards = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _store(self, card_id, periods: dict, window):
+        """Armazena as faturas do cartão e aplica o limite de cartões do cache."""
+        self._cards[card_id] = (periods, window)
+        self._cards.move_to_end(card_id)
+        while len(self._cards) > self.max_cards:
+            self._cards.popitem(last=False)
+            self.evictions += 1
+
+    def _load_cards(self, conn, card_ids: list):
+        """Carrega, em uma única consulta, todas as faturas dos cartões informados."""
+        loaded = {card_id: {} for card_id in card_ids}
+        with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+            cur.execute(card_invoices_query, (card_ids,))
+            for row in cur.fetchall():
+                # Converter período YYYY-MM para tupla (ano, mês)
+                year, month = map(int, row['creditcard_invoices_statement_period'].split('-'))
+                loaded[row['creditcard_invoices_user_creditcard_id']][(year, month)] = row['creditcard_invoices_id']
+        
+        for card_id, periods in loaded.items():
+            self._store(card_id, periods, None)
+
+    def _covers(self, card_id, year_months: list) -> bool:
+        """Verifica se as faturas em cache do cartão cobrem todos os períodos pedidos."""
+        entry = self._cards.get(card_id)
+        if entry is None:
+            return False
+        window = entry[1]
+        if window is None:
+            return True
+        return all(window[0] <= f"{year}-{month:02d}" <= window[1] for (year, month) in year_months)
+
+    def get_invoices(self, conn, period_keys) -> dict:
+        """
+        Retorna {card_id: {(ano, mês): invoice_id}} para os cartões dos períodos informados.
+        
+        Cartões ausentes do cache (ou semeados com janela que não cobre os períodos pedidos)
+        são carregados juntos em uma única consulta.
+        
+        :param period_keys: Chaves (user_card_id, ano, mês) necessárias
+        """
+        periods_by_card = {}
+        for (card_id, year, month) in period_keys:
+            periods_by_card.setdefault(card_id, []).append((year, month))
+        
+        missing_cards = [card_id for card_id, year_months in periods_by_card.items()
+                         if not self._covers(card_id, year_months)]
+        self.hits += len(periods_by_card) - len(missing_cards)
+        self.misses += len(missing_cards)
+        if missing_cards:
+            self._load_cards(conn, missing_cards)
+        
+        result = {}
+        for card_id in periods_by_card:
+            entry = self._cards.get(card_id)
+            if entry is None:
+                # Cartão removido por limite do cache na própria carga: recarregar isoladamente
+                self._load_cards(conn, [card_id])
+                entry = self._cards[card_id]
+            self._cards.move_to_end(card_id)
+            result[card_id] = entry[0]
+        return result
+
+    def seed_window(self, card_id, periods: dict, window_start: str, window_end: str):
+        """
+        Registra as faturas conhecidas de um cartão para a janela de períodos informada.
+        
+        Se o cartão já estiver carregado por completo, apenas incorpora as faturas recebidas.
+        """
+        entry = self._cards.get(card_id)
+        if entry is not None and entry[1] is None:
+            entry[0].update(periods)
+            return
+        self._store(card_id, dict(periods), (window_start, window_end))
+
+    def invalidate(self, card_ids):
+        """Descarta as faturas em cache dos cartões cujas faturas foram gravadas."""
+        for card_id in card_ids:
+            self._cards.pop(card_id, None)
+
+    def log_stats(self):
+        """Registra as estatísticas de acerto do cache de faturas."""
+        total = self.hits + self.misses
+        hit_rate = (self.hits / total * 100) if total else 0.0
+        logger.info(f"Cache de faturas: {len(self._cards)} cartões em memória, "
+                    f"{self.hits} acertos, {self.misses} falhas ({hit_rate:.2f}% de acerto), "
+                    f"{self.evictions} descartes por limite.")
+
+def fetch_invoice_card_details(conn, card_ids: list) -> dict:
+    """Busca a configuração de cobrança dos cartões ativos informados, indexada por ID."""
+    query = """
+        SELECT
+            uc.user_creditcards_id,
+            uc.user_creditcards_user_id,
+            uc.user_creditcards_closing_day,
+            uc.user_creditcards_due_day,
+            cc.creditcards_postpone_due_date_to_business_day
+        FROM core.user_creditcards uc
+        JOIN core.creditcards cc ON uc.user_creditcards_creditcard_id = cc.creditcards_id
+        WHERE uc.user_creditcards_id = ANY(%s)
+          AND uc.user_creditcards_status = TRUE
+    """
+    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        cur.execute(query, (card_ids,))
+        return {row['user_creditcards_id']: row for row in cur.fetchall()}
+
+previous_closing_dates_query = """
+    SELECT
+        inv.creditcard_invoices_user_creditcard_id,
+        inv.creditcard_invoices_statement_period,
+        inv.creditcard_invoices_closing_date
+    FROM transactions.creditcard_invoices inv
+    JOIN unnest(%s::text[], %s::text[]) AS p(card_id, statement_period)
+      ON inv.creditcard_invoices_user_creditcard_id = p.card_id
+     AND inv.creditcard_invoices_statement_period = p.statement_period
+"""
+
+def fetch_previous_closing_dates(conn, period_keys: list) -> dict:
+    """
+    Busca o fechamento das faturas existentes nos períodos informados.
+    
+    :param period_keys: Lista de chaves (user_card_id, ano, mês)
+    :return: Dicionário (user_card_id, ano, mês) -> data de fechamento
+    """
+    card_ids = [card_id for (card_id, _, _) in period_keys]
+    periods = [f"{year}-{month:02d}" for (_, year, month) in period_keys]
+    with conn.cursor() as cur:
+        cur.execute(previous_closing_dates_query, (card_ids, periods))
+        closing_dates = {}
+        for card_id, statement_period, closing_date in cur.fetchall():
+            year, month = map(int, statement_period.split('-'))
+            closing_dates[(card_id, year, month)] = closing_date
+        return closing_dates
+
+def materialize_missing_invoices(conn, missing_periods: list, business_calendar: BusinessDayCalendar, now_brt: datetime) -> int:
+    """
+    Cria em lote, na transação do lote atual, as faturas ausentes de cartões ativos.
+    
+    As datas seguem calculate_invoice_dates, com a abertura de cada fatura encadeada no
+    fechamento da fatura do mês anterior (a existente no banco, a criada neste lote ou, na
+    falta de ambas, a estimada), como no cronograma de manage_invoices.py. A situação é
+    derivada das datas (invoice_status_for_dates). A inserção ignora períodos criados
+    concorrentemente. Retorna o total de faturas criadas.
+    
+    :param missing_periods: Lista de chaves (user_card_id, ano, mês) sem fatura
+    """
+    card_details = fetch_invoice_card_details(conn, list({card_id for (card_id, _, _) in missing_periods}))
+    
+    def previous_key(period_key):
+        card_id, year, month = period_key
+        previous_dt = date(year, month, 1) - relativedelta(months=1)
+        return (card_id, previous_dt.year, previous_dt.month)
+    
+    previous_closings = fetch_previous_closing_dates(
+        conn, [previous_key(p) for p in missing_periods if p[0] in card_details]
+    )
+    today = now_brt.date()
+    
+    values_to_insert = []
+    for period_key in sorted(missing_periods):
+        card_id, year, month = period_key
+        card = card_details.get(card_id)
+        if card is None:
+            # Cartão inativo: faturas não são criadas (ver cleanup de manage_invoices.py)
+            continue
+        try:
+            dates = calculate_invoice_dates(card, year, month, previous_closings.get(previous_key(period_key)), business_calendar)
+        except Exception as e:
+            logger.error(f"Erro no cálculo de datas para user_card {card_id} período {year}-{month:02d}: {e}")
+            continue
+        # Períodos ordenados: a fatura seguinte do mesmo cartão encadeia neste fechamento
+        previous_closings[period_key] = dates["closing"]
+        values_to_insert.append((
+            None, card_id, card['user_creditcards_user_id'], now_brt,
+            dates["opening"], dates["closing"], dates["due"], f"{year}-{month:02d}",
+            0.00, 0.00, dates["due"], invoice_status_for_dates(dates, today), None, now_brt
+        ))
+    
+    if not values_to_insert:
+        return 0
+    
+    with conn.cursor() as cur:
+        new_ids = allocate_ids(
+            cur, invoice_id_sequence, 'transactions.creditcard_invoices', 'creditcard_invoices_id', 'F', len(values_to_insert)
+        )
+    values_to_insert = [(new_id,) + values[1:] for new_id, values in zip(new_ids, values_to_insert)]
+    
+    insert_query = """
+        INSERT INTO transactions.creditcard_invoices (
+            creditcard_invoices_id, creditcard_invoices_user_creditcard_id,
+            creditcard_invoices_user_id, creditcard_invoices_creation_datetime,
+            creditcard_invoices_opening_date, creditcard_invoices_closing_date,
+            creditcard_invoices_due_date, creditcard_invoices_statement_period,
+            creditcard_invoices_amount, creditcard_invoices_paid_amount,
+            creditcard_invoices_payment_date, creditcard_invoices_status,
+            creditcard_invoices_file_url, creditcard_invoices_last_update
+        )
+        SELECT data.*
+        FROM (VALUES %s) AS data(invoice_id, user_card_id, user_id, creation_dt, opening_dt, closing_dt,
+                                 due_dt, statement_period, amount, paid_amount, payment_dt, status,
+                                 file_url, last_updt)
+        WHERE NOT EXISTS (
+            SELECT 1
+            FROM transactions.creditcard_invoices inv
+            WHERE inv.creditcard_invoices_user_creditcard_id = data.user_card_id
+              AND inv.creditcard_invoices_statement_period = data.statement_period
+        );
+    """
+    template = ("(%s, %s, %s, %s::timestamp, %s::date, %s::date, %s::date, %s, %s::numeric, %s::numeric, "
+                "%s::date, %s::transactions.invoice_status, %s::text, %s::timestamp)")
+    
+    with conn.cursor() as cur:
+        try:
+            psycopg2.extras.execute_values(cur, insert_query, values_to_insert, template=template,
+                                           page_size=len(values_to_insert))
+            count = cur.rowcount
+            logger.info(f"Criadas sob demanda {count} faturas ausentes para as parcelas do lote.")
+            return count
+        except psycopg2.Error as e:
+            logger.error(f"Erro na criação em lote de faturas ausentes: {e}")
+            raise
+
+def find_or_create_invoices(conn, installment_periods: dict, invoice_cache: CardInvoiceCache, business_calendar: BusinessDayCalendar, now_brt: datetime) -> dict:
     """
-    Busca faturas existentes para os períodos necessários.
+    Busca faturas existentes para os períodos necessários e cria as ausentes.
     
-    Em vez de criar faturas automaticamente, apenas identifica quais já existem e 
-    alerta sobre as ausentes. Isso garante que parcelas só serão associadas a faturas
-    previamente criadas e configuradas corretamente.
+    As faturas de cada cartão são resolvidas pelo cache da execução (CardInvoiceCache).
+    Períodos sem fatura de cartões ativos (inclusive além do horizonte de manage_invoices.py,
+    já que parcelamentos chegam a 420 meses) são criados em lote por
+    materialize_missing_invoices, na mesma transação do lote; apenas os que continuarem
+    ausentes (ex.: cartões inativos) são alertados.
     
     :param installment_periods: Dicionário com chave (user_card_id, ano, mês) e 
                                 valor contendo informações de parcela/período
+    :param invoice_cache: Cache de faturas por cartão da execução
+    :param business_calendar: Calendário de dias úteis usado no cálculo das datas das faturas
     :return: Dicionário mapeando período para ID da fatura
     """
     invoices_map = {}
     
-    # Primeiro verificamos quais faturas já existem
     periods_to_check = list(installment_periods.keys())
     
     if not periods_to_check:
         return {}
     
-    query_existing = """
-        SELECT 
-            creditcard_invoices_user_creditcard_id, 
-            creditcard_invoices_statement_period,
-            creditcard_invoices_id,
-            creditcard_invoices_status
-        FROM transactions.creditcard_invoices
-        WHERE (creditcard_invoices_user_creditcard_id, creditcard_invoices_statement_period) = ANY(%s)
-    """
-    
-    # Preparar os parâmetros para a consulta (pares de user_card_id e período)
-    params = [(card_id, f"{year}-{month:02d}") 
-             for (card_id, year, month) in periods_to_check]
-    
-    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-        # Buscar faturas existentes
-        cur.execute(query_existing, (params,))
-        for row in cur.fetchall():
-            card_id = row['creditcard_invoices_user_creditcard_id']
-            period = row['creditcard_invoices_statement_period']
-            # Converter período YYYY-MM para tupla (card_id, ano, mês)
-            year, month = map(int, period.split('-'))
-            period_key = (card_id, year, month)
+    def resolve_periods(period_keys):
+        card_invoices = invoice_cache.get_invoices(conn, period_keys)
+        for period_key in period_keys:
+            card_id, year, month = period_key
+            invoice_id = card_invoices[card_id].get((year, month))
+            if invoice_id:
+                invoices_map[period_key] = invoice_id
+    
+    resolve_periods(periods_to_check)
+    
+    # Criar as faturas ausentes e recarregar os cartões afetados (inclusive as criadas
+    # concorrentemente, que a inserção ignora)
+    missing_periods = [p for p in periods_to_check if p not in invoices_map]
+    if missing_periods:
+        materialize_missing_invoices(conn, missing_periods, business_calendar, now_brt)
+        invoice_cache.invalidate({card_id for (card_id, _, _) in missing_periods})
+        resolve_periods(missing_periods)
+        missing_periods = [p for p in missing_periods if p not in invoices_map]
+    
+    if missing_periods:
+        missing_info = ", ".join([f"Cartão: {p[0]}, Período: {p[1]}-{p[2]:02d}" for p in missing_periods[:5]])
+        if len(missing_periods) > 5:
+            missing_info += f" e mais {len(missing_periods) - 5} períodos"
             
-            invoices_map[period_key] = row['creditcard_invoices_id']
-        
-        # Determinar quais faturas estão ausentes
-        missing_periods = [p for p in periods_to_check if p not in invoices_map]
-        
-        if missing_periods:
-            missing_info = ", ".join([f"Cartão: {p[0]}, Período: {p[1]}-{p[2]:02d}" for p in missing_periods[:5]])
-            if len(missing_periods) > 5:
-                missing_info += f" e mais {len(missing_periods) - 5} períodos"
-                
-            logger.warning(f"Não foram encontradas {len(missing_periods)} faturas necessárias: {missing_info}. "
-                          f"Execute o script manage_invoices.py para criar as faturas ausentes.")
+        logger.warning(f"Não foram encontradas {len(missing_periods)} faturas necessárias: {missing_info}. "
+                      f"Execute o script manage_invoices.py para criar as faturas ausentes.")
     
     return invoices_map
 
@@ -422,6 +769,14 @@ def execute_installments_batch(conn, installments_to_create: list, now_brt: date
     if not installments_to_create:
         return 0
     
+    with conn.cursor() as cur:
+        new_ids = allocate_ids(
+            cur, installment_id_sequence, 'transactions.creditcard_installments', 'creditcard_installments_id',
+            'P', len(installments_to_create)
+        )
+    for installment, new_id in zip(installments_to_create, new_ids):
+        installment['id'] = new_id
+    
     insert_query = """
         INSERT INTO transactions.creditcard_installments (
             creditcard_installments_id,
@@ -465,9 +820,54 @@ def execute_installments_batch(conn, installments_to_create: list, now_brt: date
     
     return 0
 
+def execute_installment_value_updates(conn, installments_to_update: list, now_brt: datetime) -> int:
+    """
+    Executa a atualização em lote dos valores das parcelas.
+    
+    Aplica todas as redistribuições do lote em um único UPDATE ... FROM (VALUES ...),
+    limpando creditcard_installments_update_alert na mesma instrução.
+    """
+    if not installments_to_update:
+        return 0
+    
+    update_query = """
+        UPDATE transactions.creditcard_installments AS ci
+        SET
+            creditcard_installments_base_value = data.base_value,
+            creditcard_installments_fees_taxes = data.fees_taxes,
+            creditcard_installments_update_alert = FALSE,
+            creditcard_installments_last_update = data.last_updt
+        FROM (VALUES %s) AS data(installment_id, base_value, fees_taxes, last_updt)
+        WHERE ci.creditcard_installments_id = data.installment_id;
+    """
+    
+    values_to_update = [
+        (
+            inst['id'],
+            inst['base_value'],
+            inst['fees_taxes'],
+            now_brt
+        ) for inst in installments_to_update
+    ]
+    
+    with conn.cursor() as cur:
+        try:
+            # page_size do tamanho do lote: uma única instrução UPDATE por lote
+            psycopg2.extras.execute_values(
+                cur, update_query, values_to_update,
+                template="(%s, %s::numeric, %s::numeric, %s::timestamp)",
+                page_size=len(values_to_update)
+            )
+            count = cur.rowcount
+            logger.info(f"Atualizados com sucesso os valores de {count} parcelas no banco de dados.")
+            return count
+        except psycopg2.Error as e:
+            logger.error(f"Erro na atualização em lote de parcelas: {e}")
+            raise
+
 # --- Lógica de negócio ---
 
-def calculate_installment_distribution(transaction: dict, existing_installments: dict, invoices: dict) -> list:
+def calculate_installment_distribution(transaction: dict, existing_installments: dict, invoices: dict, distribution: tuple) -> list:
     """
     Calcula a distribuição adequada de parcelas para uma transação.
     
@@ -477,6 +877,7 @@ def calculate_installment_distribution(transaction: dict, existing_installments:
     :param transaction: Dados da transação parcelada
     :param existing_installments: Parcelas já existentes para esta transação
     :param invoices: Mapeamento de períodos para IDs de faturas
+    :param distribution: Valores base e de taxas por parcela (calculate_batch_distributions)
     :return: Lista de parcelas a serem criadas
     """
     transaction_id = transaction['creditcard_transactions_id']
@@ -497,19 +898,8 @@ def calculate_installment_distribution(transaction: dict, existing_installments:
     }
     initial_month_num = month_to_number[initial_month]
     
-    # Valor total da transação
-    total_value = transaction['creditcard_transactions_base_value']
-    total_fees = transaction['creditcard_transactions_fees_taxes']
-    
-    # Calcular valores por parcela (distribuição proporcional)
-    base_values = distribute_value(total_value, total_installments)
-    
-    # Distribuir as taxas (se houver)
-    fees_values = []
-    if total_fees > 0:
-        fees_values = distribute_value(total_fees, total_installments)
-    else:
-        fees_values = [0] * total_installments
+    # Valores por parcela já distribuídos para o lote inteiro
+    base_values, fees_values = distribution
     
     # Descrição base para as parcelas
     transaction_desc = transaction['creditcard_transactions_description'] or "Compra parcelada"
@@ -573,7 +963,7 @@ def calculate_installment_distribution(transaction: dict, existing_installments:
         
         # Criar dados da parcela
         installment = {
-            'id': generate_installment_id(),
+            'id': None,  # Reservado em bloco na inserção (execute_installments_batch)
             'transaction_id': transaction_id,
             'invoice_id': invoice_id,
             'number': i,
@@ -588,9 +978,43 @@ def calculate_installment_distribution(transaction: dict, existing_installments:
     
     return installments_to_create
 
-def process_transaction_batch(conn, batch_transactions: list, now_brt: datetime) -> int:
+def calculate_installment_value_updates(transaction: dict, existing_installments: dict, distribution: tuple) -> list:
     """
-    Processa um lote de transações parceladas, criando as parcelas necessárias.
+    Recalcula os valores das parcelas existentes de uma transação cujo total foi alterado.
+    
+    Usa a mesma distribuição da criação de parcelas (calculate_batch_distributions), de modo
+    que as parcelas atualizadas fiquem idênticas às que seriam criadas para o novo total.
+    
+    :param transaction: Dados da transação parcelada
+    :param existing_installments: Parcelas já existentes, por transação e número
+    :param distribution: Valores base e de taxas por parcela (calculate_batch_distributions)
+    :return: Lista de parcelas (ID e novos valores) a serem atualizadas
+    """
+    transaction_id = transaction['creditcard_transactions_id']
+    total_installments = transaction['creditcard_transactions_installment_count']
+    transaction_existing = existing_installments.get(transaction_id, {})
+    
+    base_values, fees_values = distribution
+    
+    installments_to_update = []
+    for number, installment_id in transaction_existing.items():
+        # Parcelas além da quantidade atual da transação não são redistribuídas
+        if number > total_installments:
+            continue
+        installments_to_update.append({
+            'id': installment_id,
+            'transaction_id': transaction_id,
+            'number': number,
+            'base_value': base_values[number-1],
+            'fees_taxes': fees_values[number-1]
+        })
+    
+    return installments_to_update
+
+def process_transaction_batch(conn, batch_transactions: list, now_brt: datetime, invoice_cache: CardInvoiceCache, business_calendar: BusinessDayCalendar) -> int:
+    """
+    Processa um lote de transações parceladas, criando as parcelas necessárias e
+    atualizando os valores das parcelas de transações cujo total foi alterado.
     
     Implementa o workflow completo de processamento em lote, combinando passos
     preparatórios e de execução com otimizações para reduzir acessos ao BD.
@@ -598,6 +1022,9 @@ def process_transaction_batch(conn, batch_transactions: list, now_brt: datetime)
     if not batch_transactions:
         return 0
     
+    # Escritas deste lote não devem reenfileirar as transações processadas
+    enable_installments_queue_bypass(conn)
+    
     # Extrair IDs das transações para buscar parcelas existentes
     transaction_ids = [tx['creditcard_transactions_id'] for tx in batch_transactions]
     
@@ -640,103 +1067,286 @@ def process_transaction_batch(conn, batch_transactions: list, now_brt: datetime)
                     'month': target_date.month
                 }
     
-    # Buscar faturas existentes para todos os períodos necessários
-    invoices_map = find_or_create_invoices(conn, required_invoice_periods)
+    # Buscar (ou criar, se ausentes) as faturas de todos os períodos necessários
+    invoices_map = find_or_create_invoices(conn, required_invoice_periods, invoice_cache, business_calendar, now_brt)
+    
+    # Avaliar em lote quais transações precisam de atualização de parcelas
+    transactions_needing_update = fetch_transactions_needing_update(conn, batch_transactions)
+    
+    # Distribuir de uma só vez os valores de todas as transações que precisam de parcelas
+    distributions = calculate_batch_distributions(
+        [tx for tx in batch_transactions if tx['creditcard_transactions_id'] in transactions_needing_update]
+    )
     
-    # Preparar todas as parcelas para inserção
+    # Preparar todas as parcelas para inserção ou atualização de valores
     all_installments_to_create = []
+    all_installments_to_update = []
     
     for tx in batch_transactions:
+        transaction_id = tx['creditcard_transactions_id']
+        
         # Verificar se esta transação precisa de atualização de parcelas
-        if not needs_installment_update(conn, 
-                                      tx['creditcard_transactions_id'], 
-                                      tx['creditcard_transactions_base_value'], 
-                                      tx['creditcard_transactions_fees_taxes']):
+        if transaction_id not in transactions_needing_update:
+            continue
+        
+        # Com todas as parcelas já criadas, a pendência é de valor (update_alert): redistribuir
+        if len(existing_installments.get(transaction_id, {})) >= tx['creditcard_transactions_installment_count']:
+            all_installments_to_update.extend(
+                calculate_installment_value_updates(tx, existing_installments, distributions[transaction_id])
+            )
             continue
             
         # Calcular parcelas para esta transação
         installments = calculate_installment_distribution(
             tx, 
             existing_installments, 
-            invoices_map
+            invoices_map,
+            distributions[transaction_id]
         )
         all_installments_to_create.extend(installments)
     
-    # Executar a inserção em lote
+    # Executar a inserção e a atualização em lote
     inserted_count = execute_installments_batch(conn, all_installments_to_create, now_brt)
+    updated_count = execute_installment_value_updates(conn, all_installments_to_update, now_brt)
     
-    return inserted_count
+    return inserted_count + updated_count
 
-def process_all_installments(conn):
+def process_all_installments(conn, now_brt: datetime = None, invoice_cache: CardInvoiceCache = None, business_calendar: BusinessDayCalendar = None):
     """
     Processa todas as transações parceladas pendentes em lotes.
     
     Implementa a estratégia completa de processamento em lotes, com
-    balanceamento de carga, controle de transações e recursos.
+    balanceamento de carga, controle de transações e recursos. O orquestrador pode
+    compartilhar o instante de referência, o cache de faturas (já semeado pela etapa de
+    faturas) e o calendário de dias úteis; sem eles, cada execução cria os seus.
     """
-    now_brt = datetime.now(db_timezone).replace(tzinfo=None)
+    if now_brt is None:
+        now_brt = datetime.now(db_timezone).replace(tzinfo=None)
     logger.info(f"Iniciando processamento de parcelamentos em {now_brt}")
     
-    # Contar o total de transações pendentes para definir lotes
-    total_transactions = count_total_unprocessed_transactions(conn)
+    # Uma fila vazia custa apenas uma leitura do índice da fila
+    total_transactions = count_queued_transactions(conn)
     
     if total_transactions == 0:
         logger.info("Nenhuma transação parcelada pendente para processamento.")
         return
     
-    # Calcular tamanho do lote
+    # Calcular tamanho inicial do lote (ajustado a cada lote pelo controlador adaptativo)
     batch_size = calculate_batch_size(total_transactions)
-    
-    # Calcular o número de lotes
-    total_batches = math.ceil(total_transactions / batch_size)
+    batch_sizer = AdaptiveBatchSizer(
+        batch_size, 50, 5000, installment_batch_target_seconds, installment_batch_max_rows
+    )
     
     total_processed = 0
+    total_visited = 0
+    batch_index = 0
+    retained_ids = set()
+    if invoice_cache is None:
+        invoice_cache = CardInvoiceCache(installment_invoice_cache_cards)
+    if business_calendar is None:
+        business_calendar = prepare_business_calendar(now_brt, installment_calendar_months)
     
     # Processar cada lote
-    for batch_index in range(total_batches):
+    while True:
         t0 = time.time()
-        batch_start = batch_index * batch_size
-        
-        logger.info(f"Processando lote {batch_index + 1}/{total_batches} "
-                   f"(offset: {batch_start}, limit: {batch_size})...")
+        batch_size = batch_sizer.size
         
         try:
-            # Buscar transações para este lote
+            # Retirar transações da fila para este lote
             batch_transactions = fetch_unprocessed_installment_transactions(
-                conn, batch_start, batch_size
+                conn, list(retained_ids), batch_size
             )
-            
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Erro ao buscar o próximo lote da fila: {e}")
+            break
+        
+        if not batch_transactions:
+            break
+        
+        batch_index += 1
+        total_visited += len(batch_transactions)
+        batch_ids = [tx['creditcard_transactions_id'] for tx in batch_transactions]
+        pending_transactions = [tx for tx in batch_transactions if tx['is_pending']]
+        t_fetch = time.time()
+        
+        logger.info(f"Processando lote {batch_index} ({len(pending_transactions)} pendentes de "
+                   f"{len(batch_transactions)} retiradas; {total_visited}/{total_transactions} da fila)...")
+        
+        try:
             # Processar o lote atual
-            inserted_count = process_transaction_batch(conn, batch_transactions, now_brt)
+            inserted_count = process_transaction_batch(conn, pending_transactions, now_brt, invoice_cache, business_calendar)
+            t_process = time.time()
             total_processed += inserted_count
             
+            # Remover da fila o que foi concluído; o restante fica para a próxima execução
+            acknowledged_ids = acknowledge_queued_transactions(conn, batch_ids)
+            retained_ids.update(set(batch_ids) - acknowledged_ids)
+            
             # Commit após cada lote bem-sucedido
             conn.commit()
+            t_commit = time.time()
             
-            batch_time = time.time() - t0
-            logger.info(f"Lote {batch_index + 1} processado em {batch_time:.2f}s "
-                       f"({inserted_count} parcelas criadas).")
+            logger.info(f"Lote {batch_index} processado em {t_commit - t0:.2f}s "
+                       f"({inserted_count} parcelas criadas ou atualizadas, {len(acknowledged_ids)} transações concluídas).")
+            
+            batch_sizer.record(
+                len(batch_transactions),
+                {"busca": t_fetch - t0, "processamento": t_process - t_fetch, "commit": t_commit - t_process},
+                len(batch_transactions) + inserted_count
+            )
             
         except Exception as e:
             conn.rollback()
-            logger.error(f"Erro no processamento do lote {batch_index + 1}: {e}")
+            retained_ids.update(batch_ids)
+            # Faturas criadas no lote desfeito podem ter sido carregadas no cache
+            invoice_cache.invalidate({tx['creditcard_transactions_user_card_id'] for tx in batch_transactions})
+            logger.error(f"Erro no processamento do lote {batch_index}: {e}")
             # Continuar para o próximo lote mesmo após erro
     
-    logger.info(f"Processamento concluído. Total de {total_processed} parcelas criadas "
-               f"em {total_batches} lotes.")
+    if retained_ids:
+        logger.warning(f"{len(retained_ids)} transações permanecem na fila para a próxima execução.")
+    
+    invoice_cache.log_stats()
+    
+    logger.info(f"Processamento concluído. Total de {total_processed} parcelas criadas ou atualizadas "
+               f"em {batch_index} lotes.")
+
+def collect_notifications(listen_conn, coalesce_seconds: float) -> set:
+    """
+    Agrupa as notificações recebidas em uma janela curta em um único micro-lote.
+    
+    Após a primeira notificação, continua lendo o canal por coalesce_seconds para que
+    rajadas de alterações (ex.: edição de várias transações no AppSheet) sejam
+    processadas juntas. Retorna os IDs de transação notificados.
+    """
+    deadline = time.time() + coalesce_seconds
+    while True:
+        listen_conn.poll()
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        select.select([listen_conn], [], [], remaining)
+    
+    notified_ids = {notify.payload for notify in listen_conn.notifies}
+    listen_conn.notifies.clear()
+    return notified_ids
+
+def process_notified_transactions(conn, transaction_ids: list, invoice_cache: CardInvoiceCache, business_calendar: BusinessDayCalendar) -> int:
+    """
+    Processa um micro-lote de transações notificadas, em uma única transação do banco.
+    
+    Apenas as transações notificadas são retiradas (e bloqueadas) da fila e repassadas a
+    process_transaction_batch; as que continuarem pendentes permanecem na fila para a
+    drenagem periódica. Retorna o total de parcelas criadas ou atualizadas.
+    """
+    now_brt = datetime.now(db_timezone).replace(tzinfo=None)
+    batch_transactions = []
+    try:
+        batch_transactions = fetch_notified_installment_transactions(conn, transaction_ids)
+        batch_ids = [tx['creditcard_transactions_id'] for tx in batch_transactions]
+        pending_transactions = [tx for tx in batch_transactions if tx['is_pending']]
+        
+        processed_count = process_transaction_batch(conn, pending_transactions, now_brt, invoice_cache, business_calendar)
+        acknowledged_ids = acknowledge_queued_transactions(conn, batch_ids)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        # Faturas criadas no micro-lote desfeito podem ter sido carregadas no cache
+        invoice_cache.invalidate({tx['creditcard_transactions_user_card_id'] for tx in batch_transactions})
+        raise
+    
+    logger.info(f"Micro-lote concluído: {processed_count} parcelas criadas ou atualizadas, "
+               f"{len(acknowledged_ids)} de {len(batch_ids)} transações retiradas da fila.")
+    return processed_count
+
+def run_installments_daemon(conn):
+    """
+    Executa o script continuamente, processando parcelas a partir de notificações do banco.
+    
+    Escuta o canal disparado pelas triggers da fila de parcelamentos e agrupa as
+    notificações em micro-lotes, processados por process_notified_transactions com apenas as
+    transações notificadas. O cache de faturas e o calendário de dias úteis são criados uma
+    única vez e reutilizados durante toda a execução. Uma drenagem periódica da fila
+    (process_all_installments) cobre notificações perdidas enquanto o daemon estava
+    desconectado e retenta transações que permaneceram pendentes. Encerra ao receber
+    SIGTERM ou Ctrl+C.
+    """
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    
+    invoice_cache = CardInvoiceCache(installment_invoice_cache_cards)
+    business_calendar = prepare_business_calendar(
+        datetime.now(db_timezone).replace(tzinfo=None), installment_calendar_months
+    )
+    
+    def drain_queue():
+        process_all_installments(conn, invoice_cache=invoice_cache, business_calendar=business_calendar)
+    
+    # Conexão dedicada ao LISTEN, em autocommit para receber notificações imediatamente
+    listen_conn = get_db_connection()
+    listen_conn.set_session(autocommit=True)
+    try:
+        with listen_conn.cursor() as cur:
+            cur.execute(f"LISTEN {installments_notify_channel};")
+        logger.info(f"Modo daemon: escutando o canal '{installments_notify_channel}' "
+                   f"(janela de agrupamento: {installment_daemon_coalesce_seconds}s).")
+        
+        # Drenar o que acumulou na fila enquanto o daemon estava parado
+        drain_queue()
+        last_drain = time.time()
+        
+        while not stop_event.is_set():
+            if time.time() - last_drain >= installment_daemon_poll_seconds:
+                drain_queue()
+                last_drain = time.time()
+            
+            if select.select([listen_conn], [], [], 1.0) == ([], [], []):
+                continue
+            
+            listen_conn.poll()
+            if not listen_conn.notifies:
+                continue
+            
+            notified_ids = sorted(collect_notifications(listen_conn, installment_daemon_coalesce_seconds))
+            logger.info(f"Micro-lote com {len(notified_ids)} transações notificadas.")
+            for start in range(0, len(notified_ids), installment_daemon_max_batch):
+                try:
+                    process_notified_transactions(
+                        conn, notified_ids[start:start + installment_daemon_max_batch], invoice_cache, business_calendar
+                    )
+                except Exception as e:
+                    # As transações do micro-lote permanecem na fila para a drenagem periódica
+                    logger.error(f"Erro no processamento do micro-lote: {e}")
+                    if conn.closed:
+                        raise
+    except KeyboardInterrupt:
+        logger.info("Modo daemon interrompido pelo usuário.")
+    finally:
+        invoice_cache.log_stats()
+        listen_conn.close()
+        logger.info("Conexão de escuta fechada; modo daemon encerrado.")
 
 # --- Execução principal ---
 
 def main():
     """Função principal que executa o processamento de parcelamentos de cartão de crédito."""
+    parser = argparse.ArgumentParser(description="Gestão de parcelamentos de cartão de crédito.")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Executa continuamente, processando parcelas a partir de LISTEN/NOTIFY.")
+    args = parser.parse_args()
+    
     logger.info("Iniciando script de gestão de parcelamentos de cartão de crédito...")
     conn = None
     try:
         # Obter conexão com o banco (será reutilizada em todo o processo)
         conn = get_db_connection()
         
-        # Processar todas as transações parceladas pendentes
-        process_all_installments(conn)
+        if args.daemon:
+            run_installments_daemon(conn)
+        else:
+            # Processar todas as transações parceladas pendentes
+            process_all_installments(conn)
         
     except psycopg2.Error as db_err:
         logger.error(f"Erro de banco de dados durante a execução: {db_err}")
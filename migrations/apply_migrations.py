@@ -0,0 +1,142 @@
+import os
+import re
+import argparse
+import psycopg2
+import logging
+from dotenv import load_dotenv
+
+# --- Configuração de logging ---
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(module)s - %(funcName)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# --- Constantes e configuração ---
+load_dotenv()
+
+db_name = os.getenv("DB_NAME")
+db_user = os.getenv("DB_USER")
+db_password = os.getenv("DB_PASSWORD")
+db_host = os.getenv("DB_HOST", "localhost")
+db_port = os.getenv("DB_PORT", "5432")
+
+migrations_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "versions")
+migration_file_pattern = re.compile(r"^(\d{4})_([a-z0-9_]+)\.sql$")
+
+# --- Conexão com o banco de dados ---
+
+def get_db_connection() -> psycopg2.extensions.connection:
+    """Estabelece e retorna uma conexão com o banco de dados."""
+    try:
+        conn = psycopg2.connect(
+            dbname=db_name,
+            user=db_user,
+            password=db_password,
+            host=db_host,
+            port=db_port
+        )
+        logger.info("Conexão com o banco de dados estabelecida.")
+        return conn
+    except psycopg2.Error as e:
+        logger.error(f"Erro ao conectar ao banco de dados: {e}")
+        raise
+
+# --- Migrações ---
+
+def list_migrations() -> list:
+    """
+    Lista as migrações da pasta versions em ordem de versão.
+
+    Cada arquivo segue o padrão NNNN_descricao.sql; arquivos fora do padrão são ignorados
+    com aviso e versões repetidas interrompem a execução.
+    """
+    migrations = []
+    seen_versions = set()
+    for file_name in sorted(os.listdir(migrations_dir)):
+        match = migration_file_pattern.match(file_name)
+        if not match:
+            logger.warning(f"Arquivo ignorado (fora do padrão NNNN_descricao.sql): {file_name}")
+            continue
+        version = int(match.group(1))
+        if version in seen_versions:
+            raise ValueError(f"Versão de migração repetida: {version:04d}")
+        seen_versions.add(version)
+        migrations.append((version, match.group(2), os.path.join(migrations_dir, file_name)))
+    return migrations
+
+def ensure_migrations_table(conn):
+    """Cria a tabela de controle das migrações aplicadas, se ainda não existir."""
+    with conn.cursor() as cur:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS core.schema_migrations (
+                schema_migrations_version integer PRIMARY KEY,
+                schema_migrations_name text NOT NULL,
+                schema_migrations_applied_at timestamp NOT NULL DEFAULT now()
+            );
+        """)
+    conn.commit()
+
+def fetch_applied_versions(conn) -> set:
+    """Busca as versões de migração já aplicadas."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT schema_migrations_version FROM core.schema_migrations;")
+        versions = {row[0] for row in cur.fetchall()}
+    conn.rollback()
+    return versions
+
+def apply_migration(conn, version: int, name: str, path: str):
+    """
+    Aplica uma migração e registra sua versão na mesma transação.
+
+    Em caso de erro, a transação é desfeita por completo e a versão não é registrada.
+    """
+    with open(path, encoding="utf-8") as migration_file:
+        migration_sql = migration_file.read()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(migration_sql)
+            cur.execute("""
+                INSERT INTO core.schema_migrations (schema_migrations_version, schema_migrations_name)
+                VALUES (%s, %s);
+            """, (version, name))
+        conn.commit()
+        logger.info(f"Migração {version:04d} ({name}) aplicada.")
+    except psycopg2.Error as e:
+        conn.rollback()
+        logger.error(f"Erro ao aplicar a migração {version:04d} ({name}): {e}")
+        raise
+
+def apply_pending_migrations(conn, dry_run: bool = False) -> list:
+    """Aplica, em ordem, as migrações ainda não registradas e retorna as versões aplicadas."""
+    ensure_migrations_table(conn)
+    applied_versions = fetch_applied_versions(conn)
+    pending = [m for m in list_migrations() if m[0] not in applied_versions]
+    if not pending:
+        logger.info("Nenhuma migração pendente.")
+        return []
+
+    for version, name, path in pending:
+        if dry_run:
+            logger.info(f"Migração pendente: {version:04d} ({name}).")
+            continue
+        apply_migration(conn, version, name, path)
+    return [m[0] for m in pending]
+
+# --- Execução principal ---
+
+def main():
+    """Aplica as migrações pendentes do banco de dados."""
+    parser = argparse.ArgumentParser(description="Aplica as migrações versionadas do banco de dados.")
+    parser.add_argument("--dry-run", action="store_true", help="Apenas lista as migrações pendentes.")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        apply_pending_migrations(conn, args.dry_run)
+    finally:
+        conn.close()
+        logger.info("Conexão com o banco de dados fechada.")
+
+if __name__ == "__main__":
+    main()
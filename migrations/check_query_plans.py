@@ -0,0 +1,220 @@
+import os
+import sys
+import json
+from datetime import datetime, date
+from dateutil.relativedelta import relativedelta
+
+# Os scripts dos jobs permanecem autônomos em suas pastas; a verificação reutiliza suas consultas
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(base_dir, "creditcard_invoices"))
+sys.path.insert(0, os.path.join(base_dir, "manage_installments"))
+sys.path.insert(0, os.path.join(base_dir, "invoice_amounts"))
+sys.path.insert(0, os.path.join(base_dir, "creditcard_recurrence"))
+
+import manage_invoices
+import manage_installments
+import manage_invoice_amounts
+import manage_recurrences
+from apply_migrations import logger, get_db_connection
+from maintain_partitions import month_start, db_timezone
+
+# --- Consultas dos jobs e índices esperados ---
+# As consultas são as constantes exportadas pelos próprios jobs. Cada verificação roda EXPLAIN
+# (sem executar a consulta, inclusive o UPDATE de promote_due_occurrences) com enable_seqscan
+# desligado: em bancos pequenos o planejador prefere varreduras sequenciais, então o que se
+# verifica é que o índice é aplicável ao predicado do job, e não a escolha do planejador para
+# o volume atual.
+
+plan_checks = [
+    (
+        "fetch_existing_invoices (manage_invoices)",
+        manage_invoices.existing_invoices_query,
+        (['000-000-000-000-001-C'], '2000-01', '2002-01'),
+        "idx_ccinvoices_card_period"
+    ),
+    (
+        "CardInvoiceCache._load_cards (manage_installments)",
+        manage_installments.card_invoices_query,
+        (['000-000-000-000-001-C'],),
+        "idx_ccinvoices_card_period"
+    ),
+    (
+        "fetch_previous_closing_dates (manage_installments)",
+        manage_installments.previous_closing_dates_query,
+        (['000-000-000-000-001-C'], ['2000-01']),
+        "idx_ccinvoices_card_period"
+    ),
+    (
+        # Sem ordenação explícita, a ordem da fila só pode vir do índice (com a fila quase vazia
+        # o planejador preferiria ordenar a fila inteira)
+        "fetch_unprocessed_installment_transactions - ordem da fila (manage_installments)",
+        manage_installments.unprocessed_transactions_query,
+        ([], 1000),
+        "idx_ccinstall_queue_enqueued_at",
+        {"enable_sort": "off"}
+    ),
+    (
+        "fetch_unprocessed_installment_transactions - is_pending com update_alert (manage_installments)",
+        manage_installments.unprocessed_transactions_query,
+        ([], 1000),
+        "idx_ccinstall_update_alert"
+    ),
+    (
+        # Com a fila quase vazia o planejador lê a fila na ordem de enfileiramento e filtra os
+        # IDs notificados; com a fila cheia, busca os IDs pela chave primária e ordena
+        "fetch_notified_installment_transactions (manage_installments)",
+        manage_installments.notified_transactions_query,
+        (['000-000-000-000-001-T'],),
+        ("creditcard_installments_queue_pkey", "idx_ccinstall_queue_enqueued_at")
+    ),
+    (
+        "fetch_transactions_needing_update (manage_installments)",
+        manage_installments.transactions_needing_update_query,
+        (['000-000-000-000-001-T'],),
+        "uq_ccinstall_trans_num"
+    ),
+    (
+        "iter_card_detail_batches (manage_invoices)",
+        manage_invoices.active_card_details_page_query,
+        ('', 1000),
+        "idx_user_creditcards_active"
+    ),
+    (
+        "fetch_changed_invoice_amounts - transações à vista (manage_invoice_amounts)",
+        manage_invoice_amounts.invoice_amounts_query,
+        {"invoice_ids": ['000-000-000-000-001-F']},
+        "idx_cctrans_invoice_effective"
+    ),
+    (
+        "fetch_changed_invoice_amounts - parcelas (manage_invoice_amounts)",
+        manage_invoice_amounts.invoice_amounts_query,
+        {"invoice_ids": ['000-000-000-000-001-F']},
+        "idx_ccinstall_invoice"
+    ),
+    (
+        "fetch_active_recurrences - última ocorrência gerada (manage_recurrences)",
+        manage_recurrences.active_recurrences_query,
+        {"horizon": date(2000, 12, 31), "floor": date(2000, 1, 1)},
+        "uq_cctrans_recurrence_occurrence"
+    ),
+    (
+        "promote_due_occurrences (manage_recurrences)",
+        manage_recurrences.promote_due_occurrences_query,
+        {"now": datetime(2000, 1, 1)},
+        "idx_cctrans_pending_recurrence"
+    ),
+]
+
+def build_partition_checks(now_brt: datetime) -> list:
+    """
+    Monta as verificações de poda de partições do log de auditoria.
+
+    A consulta verificada é a de fetch_touched_invoice_ids (manage_invoice_amounts), com a
+    marca d'água no início do próximo mês (partição criada pela migração 0002 ou pela rotina
+    de manutenção): as leituras por changed_at >= marca d'água devem começar na partição
+    daquele mês, sem ler as partições anteriores. A busca da versão anterior de cada
+    registro (changed_at < marca d'água) lê as partições antigas por definição e não entra
+    na verificação.
+    """
+    next_date = date(now_brt.year, now_brt.month, 1) + relativedelta(months=1)
+    return [(
+        "fetch_touched_invoice_ids - changed_at >= marca d'água (manage_invoice_amounts)",
+        manage_invoice_amounts.touched_invoice_ids_query,
+        {"since": month_start(next_date.year, next_date.month)},
+        'auditoria.transactions_audit_log',
+        next_date
+    )]
+
+def collect_range_scan_relations(plan_node: dict, table_name: str) -> set:
+    """
+    Coleta, recursivamente, as partições de table_name lidas com o predicado changed_at >=.
+    """
+    relation_names = set()
+    relation_name = plan_node.get('Relation Name', '')
+    conditions = " ".join(plan_node.get(key, '') for key in ('Index Cond', 'Recheck Cond', 'Filter'))
+    if relation_name.startswith(f"{table_name}_") and "changed_at >=" in conditions:
+        relation_names.add(relation_name)
+    for child in plan_node.get('Plans', []):
+        relation_names |= collect_range_scan_relations(child, table_name)
+    return relation_names
+
+def collect_plan_indexes(plan_node: dict) -> set:
+    """Coleta, recursivamente, os nomes de índices usados em um nó do plano e seus filhos."""
+    index_names = set()
+    if 'Index Name' in plan_node:
+        index_names.add(plan_node['Index Name'])
+    for child in plan_node.get('Plans', []):
+        index_names |= collect_plan_indexes(child)
+    return index_names
+
+def explain_plan(conn, query: str, params, disable_seqscan: bool = False, planner_settings: dict = None) -> dict:
+    """Retorna o nó raiz do plano da consulta (sem executá-la); a transação é sempre desfeita."""
+    try:
+        with conn.cursor() as cur:
+            if disable_seqscan:
+                cur.execute("SET LOCAL enable_seqscan = off;")
+            for setting, value in (planner_settings or {}).items():
+                cur.execute("SELECT set_config(%s, %s, true);", (setting, value))
+            cur.execute("EXPLAIN (FORMAT JSON) " + query, params)
+            plan = cur.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]['Plan']
+    finally:
+        conn.rollback()
+
+def run_plan_checks(conn, now_brt: datetime = None) -> list:
+    """Executa as verificações de índices e de poda de partições e retorna as que falharam."""
+    if now_brt is None:
+        now_brt = datetime.now(db_timezone).replace(tzinfo=None)
+    failures = []
+    for check_name, query, params, expected_index, *planner_settings in plan_checks:
+        # Uma verificação pode aceitar índices alternativos e ajustar o planejador (ex.: sem ordenação)
+        expected_indexes = (expected_index,) if isinstance(expected_index, str) else expected_index
+        plan = explain_plan(conn, query, params, disable_seqscan=True,
+                            planner_settings=planner_settings[0] if planner_settings else None)
+        index_names = collect_plan_indexes(plan)
+        used_expected = [name for name in expected_indexes if name in index_names]
+        if used_expected:
+            logger.info(f"OK - {check_name}: usa {used_expected[0]}.")
+        else:
+            used = ", ".join(sorted(index_names)) or "nenhum índice"
+            logger.error(f"FALHA - {check_name}: esperado {' ou '.join(expected_indexes)}, plano usa {used}.")
+            failures.append(check_name)
+
+    for check_name, query, params, parent_table, since_date in build_partition_checks(now_brt):
+        table_name = parent_table.split('.')[1]
+        expected_partition = f"{table_name}_p{since_date.strftime('%Y_%m')}"
+        relation_names = collect_range_scan_relations(explain_plan(conn, query, params), table_name)
+        # Partições anteriores à marca d'água: a legada e as mensais de meses anteriores
+        older_partitions = {
+            name for name in relation_names
+            if name == f"{table_name}_legacy"
+            or (name.startswith(f"{table_name}_p") and name[-7:] < since_date.strftime('%Y_%m'))
+        }
+        if expected_partition in relation_names and not older_partitions:
+            logger.info(f"OK - {check_name}: começa em {expected_partition} ({len(relation_names)} partições lidas).")
+        else:
+            used = ", ".join(sorted(relation_names)) or "nenhuma partição"
+            logger.error(f"FALHA - {check_name}: esperado a partir de {expected_partition}, plano lê {used}.")
+            failures.append(check_name)
+    return failures
+
+# --- Execução principal ---
+
+def main():
+    """Verifica, via EXPLAIN, os índices e a poda de partições das migrações."""
+    conn = get_db_connection()
+    try:
+        failures = run_plan_checks(conn)
+    finally:
+        conn.close()
+        logger.info("Conexão com o banco de dados fechada.")
+
+    if failures:
+        logger.error(f"{len(failures)} verificação(ões) de plano falharam.")
+        sys.exit(1)
+    logger.info("Todas as consultas verificadas usam os índices esperados.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import os
+import argparse
+import psycopg2
+import psycopg2.extras
+from datetime import datetime, date
+from dateutil.relativedelta import relativedelta
+import pytz
+
+from apply_migrations import logger, get_db_connection
+
+# --- Constantes e configuração ---
+# As variáveis de ambiente do banco são carregadas por apply_migrations (load_dotenv)
+
+partition_months_ahead = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+audit_retention_months = int(os.getenv("AUDIT_RETENTION_MONTHS", "24"))
+partition_lock_timeout = os.getenv("PARTITION_LOCK_TIMEOUT", "5s")
+partitioned_audit_logs = ['auditoria.core_audit_log', 'auditoria.transactions_audit_log']
+audit_archive_schema = 'auditoria_arquivo'
+db_timezone_str = 'America/Sao_Paulo'
+db_timezone = pytz.timezone(db_timezone_str)
+
+# --- Consultas ao catálogo ---
+
+def fetch_partitions(conn, parent_table: str) -> list:
+    """
+    Busca as partições de uma tabela particionada por intervalo.
+
+    Retorna uma lista com nome, limite superior (None para MAXVALUE ou DEFAULT) e se a
+    partição é a DEFAULT, ordenada pelo limite superior.
+    """
+    with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+        cur.execute("""
+            SELECT
+                child.relname AS partition_name,
+                pg_get_expr(child.relpartbound, child.oid) = 'DEFAULT' AS is_default,
+                substring(pg_get_expr(child.relpartbound, child.oid) FROM 'TO \\(''([^'']+)''\\)')::timestamptz AS upper_bound
+            FROM pg_inherits i
+            JOIN pg_class child ON child.oid = i.inhrelid
+            WHERE i.inhparent = %s::regclass
+            ORDER BY upper_bound NULLS LAST;
+        """, (parent_table,))
+        partitions = cur.fetchall()
+    conn.rollback()
+    return partitions
+
+def is_partitioned(conn, parent_table: str) -> bool:
+    """Verifica se a tabela existe e é particionada."""
+    with conn.cursor() as cur:
+        cur.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s);", (parent_table,))
+        row = cur.fetchone()
+    conn.rollback()
+    return bool(row and row[0])
+
+# --- Manutenção ---
+
+def month_start(year: int, month: int) -> datetime:
+    """Retorna o início do mês informado no fuso do banco."""
+    return db_timezone.localize(datetime(year, month, 1))
+
+def create_future_partitions(conn, parent_table: str, now_brt: datetime, months_ahead: int) -> list:
+    """
+    Cria as partições mensais ausentes até months_ahead meses após o mês corrente.
+
+    As novas partições começam no maior limite superior existente, mantendo os intervalos
+    contíguos mesmo quando a partição legada cobre meses recentes. Falhas (ex.: registros do
+    intervalo já gravados na partição DEFAULT) são registradas e não interrompem as demais.
+    """
+    partitions = fetch_partitions(conn, parent_table)
+    bounds = [p['upper_bound'] for p in partitions if p['upper_bound'] is not None]
+    horizon_date = date(now_brt.year, now_brt.month, 1) + relativedelta(months=months_ahead + 1)
+    horizon = month_start(horizon_date.year, horizon_date.month)
+
+    if bounds:
+        next_bound = max(bounds).astimezone(db_timezone)
+        next_date = date(next_bound.year, next_bound.month, 1)
+    else:
+        next_date = date(now_brt.year, now_brt.month, 1)
+
+    schema_name, table_name = parent_table.split('.')
+    created = []
+    while month_start(next_date.year, next_date.month) < horizon:
+        following_date = next_date + relativedelta(months=1)
+        partition_name = f"{table_name}_p{next_date.strftime('%Y_%m')}"
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"SET LOCAL lock_timeout = '{partition_lock_timeout}';")
+                cur.execute(
+                    f'CREATE TABLE {schema_name}.{partition_name} PARTITION OF {parent_table} '
+                    f'FOR VALUES FROM (%s) TO (%s);',
+                    (month_start(next_date.year, next_date.month), month_start(following_date.year, following_date.month))
+                )
+                cur.execute(f'ALTER TABLE {schema_name}.{partition_name} OWNER TO "SisFinance-adm";')
+            conn.commit()
+            created.append(partition_name)
+            logger.info(f"Partição {schema_name}.{partition_name} criada.")
+        except psycopg2.Error as e:
+            conn.rollback()
+            logger.error(f"Erro ao criar a partição {schema_name}.{partition_name}: {e}")
+            break
+        next_date = following_date
+    return created
+
+def archive_old_partitions(conn, parent_table: str, now_brt: datetime, retention_months: int) -> list:
+    """
+    Desanexa as partições inteiramente anteriores ao prazo de retenção.
+
+    Cada partição desanexada é movida para o schema de arquivo, saindo das consultas e
+    escritas do log sem perda de dados. Com retenção 0, nada é desanexado.
+    """
+    if retention_months <= 0:
+        return []
+    cutoff_date = date(now_brt.year, now_brt.month, 1) - relativedelta(months=retention_months)
+    cutoff = month_start(cutoff_date.year, cutoff_date.month)
+
+    schema_name = parent_table.split('.')[0]
+    archived = []
+    for partition in fetch_partitions(conn, parent_table):
+        if partition['is_default'] or partition['upper_bound'] is None or partition['upper_bound'] > cutoff:
+            continue
+        partition_name = partition['partition_name']
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"SET LOCAL lock_timeout = '{partition_lock_timeout}';")
+                cur.execute(f'ALTER TABLE {parent_table} DETACH PARTITION {schema_name}.{partition_name};')
+                cur.execute(f'ALTER TABLE {schema_name}.{partition_name} SET SCHEMA {audit_archive_schema};')
+            conn.commit()
+            archived.append(partition_name)
+            logger.info(f"Partição {schema_name}.{partition_name} desanexada e movida para {audit_archive_schema}.")
+        except psycopg2.Error as e:
+            conn.rollback()
+            logger.error(f"Erro ao arquivar a partição {schema_name}.{partition_name}: {e}")
+    return archived
+
+def warn_default_partition_rows(conn, parent_table: str):
+    """Alerta quando a partição DEFAULT recebeu registros (partições futuras em atraso)."""
+    for partition in fetch_partitions(conn, parent_table):
+        if not partition['is_default']:
+            continue
+        schema_name = parent_table.split('.')[0]
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT EXISTS (SELECT 1 FROM {schema_name}.{partition['partition_name']});")
+            has_rows = cur.fetchone()[0]
+        conn.rollback()
+        if has_rows:
+            logger.warning(f"A partição {schema_name}.{partition['partition_name']} contém registros; "
+                           f"as partições mensais desse intervalo não poderão ser criadas até que sejam movidos.")
+
+def maintain_partitions(conn, now_brt: datetime = None, months_ahead: int = None, retention_months: int = None):
+    """Cria as partições futuras e arquiva as antigas de cada log de auditoria particionado."""
+    if now_brt is None:
+        now_brt = datetime.now(db_timezone).replace(tzinfo=None)
+    if months_ahead is None:
+        months_ahead = partition_months_ahead
+    if retention_months is None:
+        retention_months = audit_retention_months
+
+    for parent_table in partitioned_audit_logs:
+        if not is_partitioned(conn, parent_table):
+            logger.warning(f"{parent_table} não é particionada (migração 0002 pendente?). Ignorando.")
+            continue
+        created = create_future_partitions(conn, parent_table, now_brt, months_ahead)
+        archived = archive_old_partitions(conn, parent_table, now_brt, retention_months)
+        warn_default_partition_rows(conn, parent_table)
+        logger.info(f"{parent_table}: {len(created)} partição(ões) criada(s), {len(archived)} arquivada(s).")
+
+# --- Execução principal ---
+
+def main():
+    """Executa a manutenção das partições dos logs de auditoria."""
+    parser = argparse.ArgumentParser(description="Manutenção das partições dos logs de auditoria.")
+    parser.add_argument("--months-ahead", type=int, default=partition_months_ahead, help="Meses futuros com partição criada.")
+    parser.add_argument("--retention-months", type=int, default=audit_retention_months, help="Meses mantidos no log (0 desativa o arquivamento).")
+    args = parser.parse_args()
+
+    conn = get_db_connection()
+    try:
+        maintain_partitions(conn, months_ahead=args.months_ahead, retention_months=args.retention_months)
+    finally:
+        conn.close()
+        logger.info("Conexão com o banco de dados fechada.")
+
+if __name__ == "__main__":
+    main()
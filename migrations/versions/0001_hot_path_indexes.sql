@@ -0,0 +1,29 @@
+-- =============================================================================
+-- 0001 - ÍNDICES DOS PREDICADOS MAIS USADOS PELOS SCRIPTS DE AUTOMAÇÃO
+-- =============================================================================
+
+-- Faturas por cartão e período: fetch_existing_invoices, fetch_changed_card_ids e
+-- cleanup_inactive_card_invoices (manage_invoices) e CardInvoiceCache /
+-- materialize_missing_invoices (manage_installments)
+CREATE INDEX IF NOT EXISTS idx_ccinvoices_card_period
+    ON transactions.creditcard_invoices (creditcard_invoices_user_creditcard_id, creditcard_invoices_statement_period)
+    INCLUDE (creditcard_invoices_id);
+COMMENT ON INDEX transactions.idx_ccinvoices_card_period IS 'Busca de faturas por cartão e período (scripts manage_invoices e manage_installments).';
+
+-- Parcelas com alerta de atualização (parcial: apenas update_alert = TRUE). A busca de
+-- parcelas por transação já é atendida pela restrição uq_ccinstall_trans_num.
+CREATE INDEX IF NOT EXISTS idx_ccinstall_update_alert
+    ON transactions.creditcard_installments (creditcard_installments_transaction_id)
+    WHERE creditcard_installments_update_alert = TRUE;
+COMMENT ON INDEX transactions.idx_ccinstall_update_alert IS 'Parcelas com update_alert = TRUE por transação (regra de pendência de manage_installments).';
+
+-- Cartões ativos (parcial): paginação por chave de iter_card_detail_batches (manage_invoices)
+CREATE INDEX IF NOT EXISTS idx_user_creditcards_active
+    ON core.user_creditcards (user_creditcards_id)
+    WHERE user_creditcards_status;
+COMMENT ON INDEX core.idx_user_creditcards_active IS 'Cartões ativos em ordem de ID (paginação por chave de manage_invoices).';
+
+ANALYZE transactions.creditcard_invoices;
+ANALYZE transactions.creditcard_installments;
+ANALYZE transactions.creditcard_transactions;
+ANALYZE core.user_creditcards;
@@ -0,0 +1,77 @@
+-- =============================================================================
+-- 0002 - PARTICIONAMENTO MENSAL DOS LOGS DE AUDITORIA (changed_at)
+-- =============================================================================
+-- Cada log de auditoria passa a ser particionado por mês de changed_at (fuso de Brasília).
+-- A tabela atual é renomeada para <log>_legacy e anexada como primeira partição, cobrindo
+-- todo o histórico até o fim do mês corrente; as partições mensais seguintes e a partição
+-- DEFAULT são criadas aqui e mantidas por migrations/maintain_partitions.py, que também
+-- desanexa as partições antigas para o schema auditoria_arquivo.
+--
+-- transactions.creditcard_invoices não é particionada: creditcard_transactions e
+-- creditcard_installments a referenciam por creditcard_invoices_id, e uma chave única em
+-- tabela particionada precisa conter a chave de partição. A busca por período das faturas é
+-- atendida pelo índice idx_ccinvoices_card_period (0001).
+
+CREATE SCHEMA IF NOT EXISTS auditoria_arquivo;
+ALTER SCHEMA auditoria_arquivo OWNER TO "SisFinance-adm";
+COMMENT ON SCHEMA auditoria_arquivo IS 'Partições antigas dos logs de auditoria, desanexadas pela rotina de manutenção de partições.';
+
+DO $$
+DECLARE
+    log_table TEXT;
+    next_month TIMESTAMP WITH TIME ZONE := (date_trunc('month', now() AT TIME ZONE 'America/Sao_Paulo') + INTERVAL '1 month') AT TIME ZONE 'America/Sao_Paulo';
+    partition_start TIMESTAMP WITH TIME ZONE;
+    partition_name TEXT;
+BEGIN
+    FOREACH log_table IN ARRAY ARRAY['core_audit_log', 'transactions_audit_log'] LOOP
+        -- Já particionada: nada a fazer
+        IF EXISTS (
+            SELECT 1
+            FROM pg_partitioned_table pt
+            JOIN pg_class c ON c.oid = pt.partrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = 'auditoria' AND c.relname = log_table
+        ) THEN
+            CONTINUE;
+        END IF;
+
+        EXECUTE format('ALTER TABLE auditoria.%I RENAME TO %I', log_table, log_table || '_legacy');
+        -- A chave primária de uma tabela particionada precisa conter a chave de partição; a
+        -- partição anexada deve ter a mesma chave primária que a tabela particionada
+        EXECUTE format('ALTER TABLE auditoria.%I DROP CONSTRAINT %I, ADD CONSTRAINT %I PRIMARY KEY (audit_id, changed_at)',
+                       log_table || '_legacy', log_table || '_pkey', log_table || '_legacy_pkey');
+
+        EXECUTE format(
+            'CREATE TABLE auditoria.%I (
+                LIKE auditoria.%I INCLUDING DEFAULTS INCLUDING COMMENTS,
+                CONSTRAINT %I PRIMARY KEY (audit_id, changed_at)
+            ) PARTITION BY RANGE (changed_at)',
+            log_table, log_table || '_legacy', log_table || '_pkey'
+        );
+        EXECUTE format('ALTER TABLE auditoria.%I OWNER TO "SisFinance-adm"', log_table);
+        EXECUTE format('COMMENT ON TABLE auditoria.%I IS %L', log_table,
+                       CASE log_table
+                           WHEN 'core_audit_log' THEN 'Log de auditoria para todas as tabelas do schema core (particionado por mês de changed_at).'
+                           ELSE 'Log de auditoria para todas as tabelas do schema transactions (particionado por mês de changed_at).'
+                       END);
+
+        -- Histórico existente (inclusive o mês corrente) como primeira partição
+        EXECUTE format('ALTER TABLE auditoria.%I ATTACH PARTITION auditoria.%I FOR VALUES FROM (MINVALUE) TO (%L)',
+                       log_table, log_table || '_legacy', next_month);
+
+        -- Partições mensais dos próximos 3 meses
+        FOR month_offset IN 0..2 LOOP
+            partition_start := ((next_month AT TIME ZONE 'America/Sao_Paulo') + make_interval(months => month_offset)) AT TIME ZONE 'America/Sao_Paulo';
+            partition_name := log_table || '_p' || to_char(partition_start AT TIME ZONE 'America/Sao_Paulo', 'YYYY_MM');
+            EXECUTE format('CREATE TABLE auditoria.%I PARTITION OF auditoria.%I FOR VALUES FROM (%L) TO (%L)',
+                           partition_name, log_table, partition_start,
+                           ((partition_start AT TIME ZONE 'America/Sao_Paulo') + INTERVAL '1 month') AT TIME ZONE 'America/Sao_Paulo');
+            EXECUTE format('ALTER TABLE auditoria.%I OWNER TO "SisFinance-adm"', partition_name);
+        END LOOP;
+
+        -- Partição de segurança para registros fora das partições mensais (deve permanecer vazia)
+        EXECUTE format('CREATE TABLE auditoria.%I PARTITION OF auditoria.%I DEFAULT', log_table || '_default', log_table);
+        EXECUTE format('ALTER TABLE auditoria.%I OWNER TO "SisFinance-adm"', log_table || '_default');
+    END LOOP;
+END;
+$$;
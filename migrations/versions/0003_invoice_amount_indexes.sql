@@ -0,0 +1,30 @@
+-- =============================================================================
+-- 0003 - ÍNDICES DO CÁLCULO DE VALORES DE FATURAS (manage_invoice_amounts)
+-- =============================================================================
+
+-- Transações à vista efetivadas por fatura (parcial), com o valor efetivo para leitura só do índice
+CREATE INDEX IF NOT EXISTS idx_cctrans_invoice_effective
+    ON transactions.creditcard_transactions (creditcard_transactions_invoice_id)
+    INCLUDE (creditcard_transactions_total_effective)
+    WHERE creditcard_transactions_is_installment = FALSE
+      AND creditcard_transactions_status = 'Efetuado';
+COMMENT ON INDEX transactions.idx_cctrans_invoice_effective IS 'Transações à vista efetivadas por fatura (agregação de fetch_changed_invoice_amounts).';
+
+-- Parcelas por fatura, com a transação e os valores para leitura só do índice
+CREATE INDEX IF NOT EXISTS idx_ccinstall_invoice
+    ON transactions.creditcard_installments (creditcard_installments_invoice_id)
+    INCLUDE (creditcard_installments_transaction_id, creditcard_installments_base_value, creditcard_installments_fees_taxes);
+COMMENT ON INDEX transactions.idx_ccinstall_invoice IS 'Parcelas por fatura (agregação de fetch_changed_invoice_amounts).';
+
+-- Alterações recentes de transações e parcelas no log de auditoria (criado em cada partição)
+CREATE INDEX IF NOT EXISTS idx_transactions_audit_log_table_changed_at
+    ON auditoria.transactions_audit_log (table_name, changed_at);
+COMMENT ON INDEX auditoria.idx_transactions_audit_log_table_changed_at IS 'Alterações por tabela e instante (fetch_touched_invoice_ids de manage_invoice_amounts).';
+
+-- Última versão de cada registro anterior à marca d'água (fatura de origem de linhas movidas)
+CREATE INDEX IF NOT EXISTS idx_transactions_audit_log_record_changed_at
+    ON auditoria.transactions_audit_log (table_name, record_id, changed_at);
+COMMENT ON INDEX auditoria.idx_transactions_audit_log_record_changed_at IS 'Histórico de cada registro por instante (fatura anterior em fetch_touched_invoice_ids de manage_invoice_amounts).';
+
+ANALYZE transactions.creditcard_transactions;
+ANALYZE transactions.creditcard_installments;
@@ -0,0 +1,53 @@
+-- =============================================================================
+-- 0004 - OCORRÊNCIAS DE RECORRÊNCIAS DE CARTÃO (manage_recurrences)
+-- =============================================================================
+
+-- Data nominal da ocorrência (antes do adiamento para dia útil) que gerou a transação
+ALTER TABLE transactions.creditcard_transactions
+    ADD COLUMN IF NOT EXISTS creditcard_transactions_recurrence_occurrence_date date;
+COMMENT ON COLUMN transactions.creditcard_transactions.creditcard_transactions_recurrence_occurrence_date IS 'Data nominal da ocorrência da recorrência que gerou esta transação (antes do adiamento para dia útil), se aplicável.';
+
+-- Carga inicial: uma transação por (recorrência, data agendada), as demais permanecem sem data de ocorrência
+UPDATE transactions.creditcard_transactions ct
+SET creditcard_transactions_recurrence_occurrence_date = first_rows.occurrence_date
+FROM (
+    SELECT DISTINCT ON (creditcard_transactions_recurrence_id, occurrence_date)
+        creditcard_transactions_id,
+        occurrence_date
+    FROM (
+        SELECT
+            creditcard_transactions_id,
+            creditcard_transactions_recurrence_id,
+            (COALESCE(creditcard_transactions_schedule_datetime, creditcard_transactions_implementation_datetime) AT TIME ZONE 'America/Sao_Paulo')::date AS occurrence_date
+        FROM transactions.creditcard_transactions
+        WHERE creditcard_transactions_recurrence_id IS NOT NULL
+          AND creditcard_transactions_recurrence_occurrence_date IS NULL
+    ) candidates
+    ORDER BY creditcard_transactions_recurrence_id, occurrence_date, creditcard_transactions_id
+) first_rows
+WHERE ct.creditcard_transactions_id = first_rows.creditcard_transactions_id;
+
+-- Chave de idempotência da geração de ocorrências
+CREATE UNIQUE INDEX IF NOT EXISTS uq_cctrans_recurrence_occurrence
+    ON transactions.creditcard_transactions (creditcard_transactions_recurrence_id, creditcard_transactions_recurrence_occurrence_date)
+    WHERE creditcard_transactions_recurrence_id IS NOT NULL
+      AND creditcard_transactions_recurrence_occurrence_date IS NOT NULL;
+COMMENT ON INDEX transactions.uq_cctrans_recurrence_occurrence IS 'Uma transação por ocorrência de recorrência (ON CONFLICT de manage_recurrences).';
+
+-- Ocorrências geradas ainda pendentes, por data agendada (efetivação de manage_recurrences)
+CREATE INDEX IF NOT EXISTS idx_cctrans_pending_recurrence
+    ON transactions.creditcard_transactions (creditcard_transactions_schedule_datetime)
+    WHERE creditcard_transactions_recurrence_occurrence_date IS NOT NULL
+      AND creditcard_transactions_status = 'Pendente';
+COMMENT ON INDEX transactions.idx_cctrans_pending_recurrence IS 'Ocorrências de recorrências pendentes por data agendada (efetivação de manage_recurrences).';
+
+-- Sequence: creditcard_transactions_id_seq (IDs NNN-NNN-NNN-NNN-NNN-T)
+CREATE SEQUENCE IF NOT EXISTS transactions.creditcard_transactions_id_seq
+    AS bigint
+    MINVALUE 1
+    MAXVALUE 999999999999999
+    NO CYCLE;
+ALTER SEQUENCE transactions.creditcard_transactions_id_seq OWNER TO "SisFinance-adm";
+COMMENT ON SEQUENCE transactions.creditcard_transactions_id_seq IS 'Numeração dos IDs de transações gerados em bloco pelos scripts de automação (formato NNN-NNN-NNN-NNN-NNN-T).';
+
+ANALYZE transactions.creditcard_transactions;
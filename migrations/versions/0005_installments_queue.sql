@@ -0,0 +1,108 @@
+-- =============================================================================
+-- 0005 - FILA DE TRABALHO DO SCRIPT DE PARCELAMENTOS (manage_installments)
+-- =============================================================================
+-- As triggers observam as colunas de valor de creditcard_transactions e
+-- creditcard_installments (base_value e fees_taxes), lidas pelos scripts de automação.
+
+-- Tabela: creditcard_installments_queue
+CREATE TABLE IF NOT EXISTS transactions.creditcard_installments_queue (
+    creditcard_installments_queue_transaction_id character varying(50) NOT NULL,
+    creditcard_installments_queue_enqueued_at timestamp with time zone NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT creditcard_installments_queue_pkey PRIMARY KEY (creditcard_installments_queue_transaction_id),
+    CONSTRAINT fk_ccinstall_queue_transaction FOREIGN KEY (creditcard_installments_queue_transaction_id) REFERENCES transactions.creditcard_transactions(creditcard_transactions_id) ON DELETE CASCADE ON UPDATE NO ACTION
+);
+CREATE INDEX IF NOT EXISTS idx_ccinstall_queue_enqueued_at ON transactions.creditcard_installments_queue (creditcard_installments_queue_enqueued_at, creditcard_installments_queue_transaction_id);
+ALTER TABLE transactions.creditcard_installments_queue OWNER TO "SisFinance-adm";
+COMMENT ON TABLE transactions.creditcard_installments_queue IS 'Fila de transações parceladas cujas parcelas precisam ser reavaliadas pelo script manage_installments. Mantida por triggers e consumida com FOR UPDATE SKIP LOCKED.';
+COMMENT ON COLUMN transactions.creditcard_installments_queue.creditcard_installments_queue_transaction_id IS 'Transação parcelada a ser reavaliada (PK, FK para creditcard_transactions).';
+COMMENT ON COLUMN transactions.creditcard_installments_queue.creditcard_installments_queue_enqueued_at IS 'Timestamp da primeira inclusão pendente da transação na fila (ordem de consumo).';
+
+-- Função para enfileirar transações parceladas alteradas
+CREATE OR REPLACE FUNCTION transactions.enqueue_creditcard_installments_work()
+RETURNS TRIGGER AS $$
+DECLARE
+    v_transaction_id character varying(50);
+BEGIN
+    -- Escritas do próprio script de parcelamentos (SET LOCAL na transação do lote) não
+    -- reenfileiram a transação
+    IF COALESCE(current_setting('sisfinance.installments_queue_bypass', true), '') = 'on' THEN
+        RETURN NULL;
+    END IF;
+
+    IF TG_TABLE_NAME = 'creditcard_transactions' THEN
+        v_transaction_id := NEW.creditcard_transactions_id;
+    ELSIF TG_OP = 'DELETE' THEN
+        v_transaction_id := OLD.creditcard_installments_transaction_id;
+        -- Exclusão em cascata da transação principal: nada a reavaliar
+        IF NOT EXISTS (
+            SELECT 1 FROM transactions.creditcard_transactions
+            WHERE creditcard_transactions_id = v_transaction_id
+        ) THEN
+            RETURN NULL;
+        END IF;
+    ELSE
+        v_transaction_id := NEW.creditcard_installments_transaction_id;
+    END IF;
+
+    -- DO UPDATE (e não DO NOTHING) aguarda o lote que estiver consumindo a mesma transação,
+    -- garantindo que a alteração não seja descartada pela confirmação desse lote
+    INSERT INTO transactions.creditcard_installments_queue (
+        creditcard_installments_queue_transaction_id,
+        creditcard_installments_queue_enqueued_at
+    ) VALUES (
+        v_transaction_id,
+        CURRENT_TIMESTAMP
+    )
+    ON CONFLICT (creditcard_installments_queue_transaction_id) DO UPDATE
+    SET creditcard_installments_queue_enqueued_at = transactions.creditcard_installments_queue.creditcard_installments_queue_enqueued_at;
+
+    -- Aviso ao modo daemon do script (entregue somente após o commit da transação)
+    PERFORM pg_notify('creditcard_installments_queue', v_transaction_id);
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+ALTER FUNCTION transactions.enqueue_creditcard_installments_work() OWNER TO "SisFinance-adm";
+COMMENT ON FUNCTION transactions.enqueue_creditcard_installments_work() IS 'Enfileira em creditcard_installments_queue a transação parcelada cuja quantidade, valor ou alerta de atualização das parcelas foi alterado e notifica o canal creditcard_installments_queue.';
+
+-- Trigger para enfileirar transações parceladas criadas ou alteradas
+DROP TRIGGER IF EXISTS trigger_enqueue_creditcard_transactions_installments ON transactions.creditcard_transactions;
+CREATE TRIGGER trigger_enqueue_creditcard_transactions_installments
+    AFTER INSERT OR UPDATE OF creditcard_transactions_is_installment, creditcard_transactions_installment_count, creditcard_transactions_base_value, creditcard_transactions_fees_taxes, creditcard_transactions_procedure, creditcard_transactions_status ON transactions.creditcard_transactions
+    FOR EACH ROW
+    WHEN (NEW.creditcard_transactions_is_installment = true)
+    EXECUTE FUNCTION transactions.enqueue_creditcard_installments_work();
+COMMENT ON TRIGGER trigger_enqueue_creditcard_transactions_installments ON transactions.creditcard_transactions IS 'Enfileira a transação parcelada para reavaliação das parcelas quando quantidade, valor ou status mudam.';
+
+-- Trigger para enfileirar transações cujas parcelas foram criadas, alteradas ou removidas
+DROP TRIGGER IF EXISTS trigger_enqueue_creditcard_installments ON transactions.creditcard_installments;
+CREATE TRIGGER trigger_enqueue_creditcard_installments
+    AFTER INSERT OR DELETE OR UPDATE OF creditcard_installments_transaction_id, creditcard_installments_base_value, creditcard_installments_fees_taxes, creditcard_installments_update_alert ON transactions.creditcard_installments
+    FOR EACH ROW
+    EXECUTE FUNCTION transactions.enqueue_creditcard_installments_work();
+COMMENT ON TRIGGER trigger_enqueue_creditcard_installments ON transactions.creditcard_installments IS 'Enfileira a transação principal quando contagem, valores ou update_alert das parcelas mudam.';
+
+-- Carga inicial da fila com as transações atualmente pendentes (regra de pendência de manage_installments)
+INSERT INTO transactions.creditcard_installments_queue (creditcard_installments_queue_transaction_id)
+SELECT ct.creditcard_transactions_id
+FROM transactions.creditcard_transactions ct
+WHERE ct.creditcard_transactions_is_installment = TRUE
+  AND ct.creditcard_transactions_status = 'Efetuado'
+  AND (
+      NOT EXISTS (
+          SELECT 1
+          FROM transactions.creditcard_installments ci
+          WHERE ci.creditcard_installments_transaction_id = ct.creditcard_transactions_id
+          GROUP BY ci.creditcard_installments_transaction_id
+          HAVING COUNT(*) = ct.creditcard_transactions_installment_count
+      )
+      OR EXISTS (
+          SELECT 1
+          FROM transactions.creditcard_installments ci
+          WHERE ci.creditcard_installments_transaction_id = ct.creditcard_transactions_id
+            AND ci.creditcard_installments_update_alert = TRUE
+      )
+  )
+ON CONFLICT (creditcard_installments_queue_transaction_id) DO NOTHING;
+
+ANALYZE transactions.creditcard_installments_queue;
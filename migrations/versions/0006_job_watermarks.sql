@@ -0,0 +1,16 @@
+-- =============================================================================
+-- 0006 - MARCAS D'ÁGUA DOS SCRIPTS DE AUTOMAÇÃO (manage_invoices e manage_invoice_amounts)
+-- =============================================================================
+
+-- Tabela: job_watermarks
+CREATE TABLE IF NOT EXISTS core.job_watermarks (
+    job_watermarks_job_name character varying(100) NOT NULL,
+    job_watermarks_last_run timestamp with time zone NOT NULL,
+    job_watermarks_last_update timestamp with time zone NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT job_watermarks_pkey PRIMARY KEY (job_watermarks_job_name)
+);
+ALTER TABLE core.job_watermarks OWNER TO "SisFinance-adm";
+COMMENT ON TABLE core.job_watermarks IS 'Marca d''água da última execução bem-sucedida de cada script de automação, usada no processamento incremental.';
+COMMENT ON COLUMN core.job_watermarks.job_watermarks_job_name IS 'Nome do script de automação (PK, Ex: manage_invoices).';
+COMMENT ON COLUMN core.job_watermarks.job_watermarks_last_run IS 'Instante de início (relógio do banco) da última execução concluída com sucesso.';
+COMMENT ON COLUMN core.job_watermarks.job_watermarks_last_update IS 'Timestamp da última atualização deste registro.';
@@ -0,0 +1,21 @@
+-- =============================================================================
+-- 0007 - SEQUENCES DE IDS DE FATURAS E PARCELAS (manage_invoices e manage_installments)
+-- =============================================================================
+
+-- Sequence: creditcard_invoices_id_seq (IDs NNN-NNN-NNN-NNN-NNN-F)
+CREATE SEQUENCE IF NOT EXISTS transactions.creditcard_invoices_id_seq
+    AS bigint
+    MINVALUE 1
+    MAXVALUE 999999999999999
+    NO CYCLE;
+ALTER SEQUENCE transactions.creditcard_invoices_id_seq OWNER TO "SisFinance-adm";
+COMMENT ON SEQUENCE transactions.creditcard_invoices_id_seq IS 'Numeração dos IDs de faturas gerados em bloco pelos scripts de automação (formato NNN-NNN-NNN-NNN-NNN-F).';
+
+-- Sequence: creditcard_installments_id_seq (IDs NNN-NNN-NNN-NNN-NNN-P)
+CREATE SEQUENCE IF NOT EXISTS transactions.creditcard_installments_id_seq
+    AS bigint
+    MINVALUE 1
+    MAXVALUE 999999999999999
+    NO CYCLE;
+ALTER SEQUENCE transactions.creditcard_installments_id_seq OWNER TO "SisFinance-adm";
+COMMENT ON SEQUENCE transactions.creditcard_installments_id_seq IS 'Numeração dos IDs de parcelas gerados em bloco pelos scripts de automação (formato NNN-NNN-NNN-NNN-NNN-P).';
@@ -0,0 +1,121 @@
+import os
+import sys
+import logging
+import threading
+from datetime import datetime
+import psycopg2
+
+# Os scripts de cada etapa permanecem autônomos em suas pastas; o orquestrador os importa
+base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(base_dir, "creditcard_invoices"))
+sys.path.insert(0, os.path.join(base_dir, "manage_installments"))
+sys.path.insert(0, os.path.join(base_dir, "invoice_amounts"))
+sys.path.insert(0, os.path.join(base_dir, "creditcard_recurrence"))
+sys.path.insert(0, os.path.join(base_dir, "shared"))
+
+import job_common
+import manage_invoices
+import manage_installments
+import manage_invoice_amounts
+import manage_recurrences
+
+# --- Configuração de logging ---
+logger = logging.getLogger(__name__)
+
+# --- Repasse de estado entre as etapas ---
+
+def build_invoice_handoff(invoice_cache, window_start: str, window_end: str):
+    """
+    Cria o observador de lotes da etapa de faturas que semeia o cache da etapa de parcelas.
+
+    Para cada lote commitado, as faturas existentes lidas e as inseridas pela etapa de
+    faturas formam a visão completa da janela [window_start, window_end] de cada cartão do
+    lote, repassada ao CardInvoiceCache sem nova leitura do banco. O observador é seguro
+    para o modo paralelo da etapa de faturas.
+    """
+    lock = threading.Lock()
+
+    def observe(card_details: list, existing_invoices: dict, inserts: list):
+        periods_by_card = {card['user_creditcards_id']: {} for card in card_details}
+        for (card_id, period), invoice in existing_invoices.items():
+            year, month = map(int, period.split('-'))
+            periods_by_card.setdefault(card_id, {})[(year, month)] = invoice['creditcard_invoices_id']
+        for invoice in inserts:
+            year, month = map(int, invoice['creditcard_invoices_statement_period'].split('-'))
+            periods_by_card.setdefault(invoice['creditcard_invoices_user_creditcard_id'], {})[(year, month)] = invoice['creditcard_invoices_id']
+
+        with lock:
+            for card_id, periods in periods_by_card.items():
+                invoice_cache.seed_window(card_id, periods, window_start, window_end)
+
+    return observe
+
+# --- Execução principal ---
+
+def main():
+    """Executa a manutenção de faturas, a geração de recorrências e de parcelas e o cálculo dos valores das faturas em um único processo."""
+    logger.info("Iniciando orquestração: faturas, recorrências, parcelamentos e valores de faturas...")
+    pool = None
+    conn = None
+    try:
+        # Um único pool atende a conexão principal e os modos paralelo/pipeline das faturas
+        pool = manage_invoices.get_db_connection_pool(max(manage_invoices.invoice_workers, 1) + 2)
+        conn = pool.getconn()
+
+        # Estado compartilhado entre as etapas
+        now_brt = datetime.now(manage_invoices.db_timezone).replace(tzinfo=None)
+        _, start_period_str, end_period_str = manage_invoices.build_period_range(now_brt, manage_invoices.lookahead_months)
+        business_calendar = job_common.prepare_business_calendar(now_brt, manage_invoices.lookahead_months)
+        invoice_cache = manage_installments.CardInvoiceCache(manage_installments.installment_invoice_cache_cards)
+
+        try:
+            logger.info("Etapa 1/4: manutenção de faturas.")
+            manage_invoices.run_invoice_maintenance(
+                conn,
+                now_brt,
+                business_calendar,
+                pool,
+                build_invoice_handoff(invoice_cache, start_period_str, end_period_str)
+            )
+        except Exception as e:
+            # As parcelas ainda podem ser geradas: faturas ausentes são criadas sob demanda
+            logger.exception(f"Erro na etapa de faturas; seguindo para os parcelamentos: {e}")
+            conn.rollback()
+
+        logger.info("Etapa 2/4: geração de transações recorrentes.")
+        manage_recurrences.run_recurrence_expansion(conn, now_brt, business_calendar)
+
+        logger.info("Etapa 3/4: geração de parcelamentos.")
+        manage_installments.process_all_installments(
+            conn,
+            now_brt,
+            invoice_cache,
+            business_calendar
+        )
+
+        # Por último: os valores incluem as transações e parcelas geradas nas etapas anteriores
+        logger.info("Etapa 4/4: cálculo dos valores das faturas.")
+        manage_invoice_amounts.run_invoice_amounts(conn, now_brt)
+
+    except psycopg2.Error as db_err:
+        logger.error(f"Erro de banco de dados durante a execução: {db_err}")
+        if conn:
+            conn.rollback()
+            logger.warning("Rollback da transação atual (se houver) realizado devido a erro de DB.")
+    except Exception as e:
+        logger.exception(f"Erro inesperado durante a execução do orquestrador: {e}")
+        if conn:
+            try:
+                conn.rollback()
+                logger.warning("Rollback da transação atual (se houver) realizado devido a erro inesperado.")
+            except psycopg2.Error as rb_err:
+                logger.error(f"Erro ao tentar realizar rollback: {rb_err}")
+    finally:
+        if pool:
+            if conn:
+                pool.putconn(conn)
+            pool.closeall()
+            logger.info("Pool de conexões com o banco de dados fechado.")
+
+if __name__ == "__main__":
+    main()
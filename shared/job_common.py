@@ -0,0 +1,205 @@
+import logging
+import threading
+from datetime import datetime, timedelta, date
+from dateutil.relativedelta import relativedelta
+import holidays
+from array import array
+
+# --- Código compartilhado pelos scripts de automação ---
+# Importado por manage_invoices, manage_installments, manage_recurrences e pelo orquestrador
+# (cada um inclui a pasta shared no sys.path). A configuração de logging fica a cargo do
+# script que importa o módulo.
+
+logger = logging.getLogger(__name__)
+
+# --- Calendário de dias úteis ---
+
+def is_business_day(target_date: date, holidays_obj) -> bool:
+    """Verifica se a data é um dia útil (não fim de semana nem feriado)."""
+    if target_date.weekday() >= 5:
+        return False
+    if target_date in holidays_obj:
+        return False
+    return True
+
+def get_next_business_day(target_date: date, holidays_obj) -> date:
+    """Retorna a data fornecida ou o próximo dia útil subsequente."""
+    adjusted_date = target_date
+    while not is_business_day(adjusted_date, holidays_obj):
+        adjusted_date += timedelta(days=1)
+    return adjusted_date
+
+class BusinessDayCalendar:
+    """
+    Calendário de dias úteis pré-computado para uma janela de datas.
+
+    Armazena, para cada dia da janela, o deslocamento (em dias) até o próximo dia útil,
+    de modo que o ajuste de vencimentos seja uma consulta O(1). Datas fora da janela
+    recorrem ao cálculo dia a dia com o objeto de feriados original.
+    """
+
+    def __init__(self, holidays_obj, start_date: date, end_date: date):
+        self.holidays_obj = holidays_obj
+        self.start_date = start_date
+        self.end_date = end_date
+        total_days = (end_date - start_date).days + 1
+
+        self._business = bytearray(total_days)
+        for offset in range(total_days):
+            if is_business_day(start_date + timedelta(days=offset), holidays_obj):
+                self._business[offset] = 1
+
+        # Deslocamento até o próximo dia útil, calculado de trás para frente
+        self._next_offset = array('H', bytes(2 * total_days))
+        tail_gap = (get_next_business_day(end_date, holidays_obj) - end_date).days
+        self._next_offset[total_days - 1] = tail_gap
+        for offset in range(total_days - 2, -1, -1):
+            if not self._business[offset]:
+                self._next_offset[offset] = self._next_offset[offset + 1] + 1
+
+    def _index(self, target_date: date):
+        """Retorna o índice da data na janela ou None se estiver fora dela."""
+        offset = (target_date - self.start_date).days
+        if 0 <= offset < len(self._business):
+            return offset
+        return None
+
+    def is_business_day(self, target_date: date) -> bool:
+        """Verifica se a data é um dia útil."""
+        offset = self._index(target_date)
+        if offset is None:
+            return is_business_day(target_date, self.holidays_obj)
+        return bool(self._business[offset])
+
+    def next_business_day(self, target_date: date) -> date:
+        """Retorna a data fornecida ou o próximo dia útil subsequente."""
+        offset = self._index(target_date)
+        if offset is None:
+            return get_next_business_day(target_date, self.holidays_obj)
+        return target_date + timedelta(days=self._next_offset[offset])
+
+def prepare_holidays(now_brt: datetime, months_ahead: int):
+    """Prepara e retorna objeto de feriados nacionais para o período de interesse."""
+    current_year = now_brt.year
+    years_for_holidays = list(range(current_year - 1, current_year + (months_ahead // 12) + 2))
+    br_holidays = holidays.BR(years=years_for_holidays)
+    logger.info(f"Cache de feriados preparado para anos: {years_for_holidays}")
+    return br_holidays
+
+def prepare_business_calendar(now_brt: datetime, months_ahead: int) -> BusinessDayCalendar:
+    """Prepara o calendário de dias úteis cobrindo os anos do cache de feriados."""
+    br_holidays = prepare_holidays(now_brt, months_ahead)
+    start_date = date(min(br_holidays.years), 1, 1)
+    end_date = date(max(br_holidays.years), 12, 31)
+    business_calendar = BusinessDayCalendar(br_holidays, start_date, end_date)
+    logger.info(f"Calendário de dias úteis preparado de {start_date} a {end_date}.")
+    return business_calendar
+
+# --- Datas das faturas ---
+
+def calculate_invoice_dates(card_details: dict, target_year: int, target_month: int, last_closing_date, business_calendar: BusinessDayCalendar) -> dict:
+    """
+    Calcula as datas de abertura, fechamento e vencimento de uma fatura.
+    """
+    due_day = card_details['user_creditcards_due_day']
+    days_between_due_closing = card_details['user_creditcards_closing_day']
+    postpone = card_details.get('creditcards_postpone_due_date_to_business_day', True)
+
+    try:
+        nominal_due_date = date(target_year, target_month, due_day)
+    except ValueError:
+        last_day_of_month = (date(target_year, target_month, 1) + relativedelta(months=1) - timedelta(days=1)).day
+        logger.warning(f"Dia de vencimento {due_day} inválido para {target_year}-{target_month:02d} para user_card {card_details['user_creditcards_id']}. Usando último dia: {last_day_of_month}.")
+        nominal_due_date = date(target_year, target_month, last_day_of_month)
+
+    effective_due_date = business_calendar.next_business_day(nominal_due_date)
+    reference_date_for_closing = effective_due_date if postpone else nominal_due_date
+    closing_date = reference_date_for_closing - timedelta(days=days_between_due_closing)
+
+    if last_closing_date:
+        opening_date = last_closing_date + timedelta(days=1)
+    else:
+        estimated_previous_closing = closing_date - relativedelta(months=1)
+        opening_date = estimated_previous_closing + timedelta(days=1)
+
+    return {
+        "opening": opening_date,
+        "closing": closing_date,
+        "due": effective_due_date
+    }
+
+# --- Tamanho adaptativo dos lotes ---
+
+class AdaptiveBatchSizer:
+    """
+    Controlador adaptativo do tamanho dos lotes.
+
+    Mede a duração de cada fase (busca, planejamento e escrita) e as linhas processadas por
+    lote e ajusta o tamanho do próximo lote em direção à duração-alvo, respeitando um teto
+    de linhas por lote (aproximação do uso de memória) e os limites mínimo e máximo. A
+    variação entre lotes consecutivos é limitada para evitar oscilações.
+    """
+
+    def __init__(self, initial_size: int, min_size: int, max_size: int, target_seconds: float, max_rows: int):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_seconds = target_seconds
+        self.max_rows = max_rows
+        self.size = max(min_size, min(max_size, initial_size))
+        self._lock = threading.Lock()
+
+    def record(self, batch_items: int, phase_durations: dict, rows: int) -> int:
+        """Registra as métricas de um lote concluído e retorna o tamanho do próximo lote."""
+        if batch_items <= 0:
+            return self.size
+
+        elapsed = sum(phase_durations.values())
+        with self._lock:
+            previous_size = self.size
+            seconds_per_item = elapsed / batch_items
+            ideal_size = self.target_seconds / seconds_per_item if seconds_per_item > 0 else self.max_size
+
+            rows_per_item = rows / batch_items
+            if rows_per_item > 0:
+                ideal_size = min(ideal_size, self.max_rows / rows_per_item)
+
+            # Suavização: move metade do caminho, com variação máxima de 2x para cima ou para baixo
+            next_size = int((previous_size + ideal_size) / 2)
+            next_size = max(previous_size // 2, min(previous_size * 2, next_size))
+            self.size = max(self.min_size, min(self.max_size, next_size))
+
+        phases = ", ".join(f"{name} {duration:.2f}s" for name, duration in phase_durations.items())
+        logger.info(f"Lote de {batch_items} itens em {elapsed:.2f}s ({phases}; {rows} linhas). "
+                    f"Tamanho do lote: {previous_size} -> {self.size} (alvo: {self.target_seconds:.1f}s, "
+                    f"teto: {self.max_rows} linhas).")
+        return self.size
+
+# --- IDs sequenciais ---
+
+def format_sequential_id(number: int, suffix: str) -> str:
+    """Formata um número sequencial no padrão de IDs NNN-NNN-NNN-NNN-NNN-<sufixo>."""
+    digits = f"{number:015d}"
+    parts = [digits[i:i + 3] for i in range(0, 15, 3)]
+    return "-".join(parts) + "-" + suffix
+
+def allocate_ids(cursor, sequence_name: str, table_name: str, id_column: str, suffix: str, count: int) -> list:
+    """
+    Reserva em bloco `count` IDs únicos no formato NNN-NNN-NNN-NNN-NNN-<sufixo>.
+
+    Os números vêm de uma sequence do banco (exclusivos entre execuções concorrentes e
+    crescentes, o que favorece a localidade do índice da PK). Como a tabela ainda contém
+    IDs legados aleatórios, o bloco é conferido em uma única consulta e eventuais colisões
+    são substituídas por novos números antes da escrita, de modo que a inserção em lote
+    nunca falha por chave duplicada.
+    """
+    ids = []
+    while len(ids) < count:
+        needed = count - len(ids)
+        cursor.execute("SELECT nextval(%s) FROM generate_series(1, %s);", (sequence_name, needed))
+        candidates = [format_sequential_id(row[0], suffix) for row in cursor.fetchall()]
+        cursor.execute(f"SELECT {id_column} FROM {table_name} WHERE {id_column} = ANY(%s);", (candidates,))
+        taken = {row[0] for row in cursor.fetchall()}
+        if taken:
+            logger.warning(f"{len(taken)} IDs reservados em {sequence_name} já existiam em {table_name}; substituindo.")
+        ids.extend(candidate for candidate in candidates if candidate not in taken)
+    return ids
@@ -3528,4 +3528,144 @@ GROUP BY
     acc_type.account_types_name;
 
 ALTER VIEW transactions.view_brl_balance_per_account OWNER TO "SisFinance-adm";
-COMMENT ON VIEW transactions.view_brl_balance_per_account IS 'Balanço consolidado de saldo em BRL por conta bancária e usuário, exceto contas do tipo "Conta de Custódia".';
\ No newline at end of file
+COMMENT ON VIEW transactions.view_brl_balance_per_account IS 'Balanço consolidado de saldo em BRL por conta bancária e usuário, exceto contas do tipo "Conta de Custódia".';
+
+-- =============================================================================
+-- CONTROLE DE EXECUÇÃO DOS SCRIPTS DE AUTOMAÇÃO
+-- =============================================================================
+
+-- Tabela: job_watermarks
+CREATE TABLE IF NOT EXISTS core.job_watermarks (
+    job_watermarks_job_name character varying(100) NOT NULL,
+    job_watermarks_last_run timestamp with time zone NOT NULL,
+    job_watermarks_last_update timestamp with time zone NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    CONSTRAINT job_watermarks_pkey PRIMARY KEY (job_watermarks_job_name)
+);
+ALTER TABLE core.job_watermarks OWNER TO "SisFinance-adm";
+COMMENT ON TABLE core.job_watermarks IS 'Marca d''água da última execução bem-sucedida de cada script de automação, usada no processamento incremental.';
+COMMENT ON COLUMN core.job_watermarks.job_watermarks_job_name IS 'Nome do script de automação (PK, Ex: manage_invoices).';
+COMMENT ON COLUMN core.job_watermarks.job_watermarks_last_run IS 'Instante de início (relógio do banco) da última execução concluída com sucesso.';
+COMMENT ON COLUMN core.job_watermarks.job_watermarks_last_update IS 'Timestamp da última atualização deste registro.';
+
+-- =============================================================================
+-- SEQUENCES DE RESERVA DE IDS DOS SCRIPTS DE AUTOMAÇÃO
+-- =============================================================================
+
+-- Sequence: creditcard_invoices_id_seq (IDs NNN-NNN-NNN-NNN-NNN-F)
+CREATE SEQUENCE IF NOT EXISTS transactions.creditcard_invoices_id_seq
+    AS bigint
+    MINVALUE 1
+    MAXVALUE 999999999999999
+    NO CYCLE;
+ALTER SEQUENCE transactions.creditcard_invoices_id_seq OWNER TO "SisFinance-adm";
+COMMENT ON SEQUENCE transactions.creditcard_invoices_id_seq IS 'Numeração dos IDs de faturas gerados em bloco pelos scripts de automação (formato NNN-NNN-NNN-NNN-NNN-F).';
+
+-- Sequence: creditcard_installments_id_seq (IDs NNN-NNN-NNN-NNN-NNN-P)
+CREATE SEQUENCE IF NOT EXISTS transactions.creditcard_installments_id_seq
+    AS bigint
+    MINVALUE 1
+    MAXVALUE 999999999999999
+    NO CYCLE;
+ALTER SEQUENCE transactions.creditcard_installments_id_seq OWNER TO "SisFinance-adm";
+COMMENT ON SEQUENCE transactions.creditcard_installments_id_seq IS 'Numeração dos IDs de parcelas gerados em bloco pelos scripts de automação (formato NNN-NNN-NNN-NNN-NNN-P).';
+
+-- =============================================================================
+-- AUDITORIA EM NÍVEL DE INSTRUÇÃO (TABELAS DE TRANSIÇÃO)
+-- =============================================================================
+
+-- Função de auditoria do schema core em nível de instrução
+CREATE OR REPLACE FUNCTION public.log_core_audit_statement()
+RETURNS TRIGGER AS $$
+DECLARE
+    pk_column_name TEXT := TG_ARGV[0];
+BEGIN
+    -- Um único INSERT ... SELECT por instrução, a partir da tabela de transição
+    IF TG_OP = 'DELETE' THEN
+        EXECUTE format(
+            'INSERT INTO auditoria.core_audit_log (audit_id, table_name, record_id, action_type, old_values, new_values, changed_by, changed_at)
+             SELECT gen_random_uuid()::TEXT, %L, (r.%I)::TEXT, %L::auditoria.action_type, row_to_json(r), NULL, current_user, CURRENT_TIMESTAMP
+             FROM old_rows AS r',
+            TG_TABLE_NAME, pk_column_name, TG_OP
+        );
+    ELSE
+        EXECUTE format(
+            'INSERT INTO auditoria.core_audit_log (audit_id, table_name, record_id, action_type, old_values, new_values, changed_by, changed_at)
+             SELECT gen_random_uuid()::TEXT, %L, (r.%I)::TEXT, %L::auditoria.action_type, NULL, row_to_json(r), current_user, CURRENT_TIMESTAMP
+             FROM new_rows AS r',
+            TG_TABLE_NAME, pk_column_name, TG_OP
+        );
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+ALTER FUNCTION public.log_core_audit_statement() OWNER TO "SisFinance-adm";
+COMMENT ON FUNCTION public.log_core_audit_statement() IS 'Log de auditoria do schema core em nível de instrução: grava todas as linhas afetadas (tabelas de transição new_rows/old_rows) com um único INSERT, mesmo conteúdo de log_core_audit.';
+
+-- Função de auditoria do schema transactions em nível de instrução
+CREATE OR REPLACE FUNCTION public.log_transactions_audit_statement()
+RETURNS TRIGGER AS $$
+DECLARE
+    pk_column_name TEXT := TG_ARGV[0];
+BEGIN
+    -- Um único INSERT ... SELECT por instrução, a partir da tabela de transição
+    IF TG_OP = 'DELETE' THEN
+        EXECUTE format(
+            'INSERT INTO auditoria.transactions_audit_log (audit_id, table_name, record_id, action_type, old_values, new_values, changed_by, changed_at)
+             SELECT gen_random_uuid()::TEXT, %L, (r.%I)::TEXT, %L::auditoria.action_type, row_to_json(r), NULL, current_user, CURRENT_TIMESTAMP
+             FROM old_rows AS r',
+            TG_TABLE_NAME, pk_column_name, TG_OP
+        );
+    ELSE
+        EXECUTE format(
+            'INSERT INTO auditoria.transactions_audit_log (audit_id, table_name, record_id, action_type, old_values, new_values, changed_by, changed_at)
+             SELECT gen_random_uuid()::TEXT, %L, (r.%I)::TEXT, %L::auditoria.action_type, NULL, row_to_json(r), current_user, CURRENT_TIMESTAMP
+             FROM new_rows AS r',
+            TG_TABLE_NAME, pk_column_name, TG_OP
+        );
+    END IF;
+
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+ALTER FUNCTION public.log_transactions_audit_statement() OWNER TO "SisFinance-adm";
+COMMENT ON FUNCTION public.log_transactions_audit_statement() IS 'Log de auditoria do schema transactions em nível de instrução: grava todas as linhas afetadas (tabelas de transição new_rows/old_rows) com um único INSERT, mesmo conteúdo de log_transactions_audit.';
+
+-- Substituição das triggers de auditoria por linha pelas triggers por instrução.
+-- Tabelas de transição exigem uma trigger por evento: cada trigger_audit_<tabela> dá lugar
+-- a trigger_audit_<tabela>_insert, _update e _delete, com a mesma coluna de PK.
+DO $$
+DECLARE
+    audit_trigger RECORD;
+    statement_function TEXT;
+BEGIN
+    FOR audit_trigger IN
+        SELECT
+            t.tgname,
+            t.tgrelid::regclass AS audited_table,
+            p.proname,
+            split_part(encode(t.tgargs, 'escape'), '\000', 1) AS pk_column_name
+        FROM pg_trigger t
+        JOIN pg_proc p ON p.oid = t.tgfoid
+        WHERE NOT t.tgisinternal
+          AND p.pronamespace = 'public'::regnamespace
+          AND p.proname IN ('log_core_audit', 'log_transactions_audit')
+    LOOP
+        statement_function := 'public.' || audit_trigger.proname || '_statement';
+
+        EXECUTE format('DROP TRIGGER %I ON %s', audit_trigger.tgname, audit_trigger.audited_table);
+        EXECUTE format(
+            'CREATE TRIGGER %I AFTER INSERT ON %s REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION %s(%L)',
+            audit_trigger.tgname || '_insert', audit_trigger.audited_table, statement_function, audit_trigger.pk_column_name
+        );
+        EXECUTE format(
+            'CREATE TRIGGER %I AFTER UPDATE ON %s REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION %s(%L)',
+            audit_trigger.tgname || '_update', audit_trigger.audited_table, statement_function, audit_trigger.pk_column_name
+        );
+        EXECUTE format(
+            'CREATE TRIGGER %I AFTER DELETE ON %s REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION %s(%L)',
+            audit_trigger.tgname || '_delete', audit_trigger.audited_table, statement_function, audit_trigger.pk_column_name
+        );
+    END LOOP;
+END;
+$$;